@@ -0,0 +1,94 @@
+# chat_load_test.py - N concurrent /chat calls should take about as long as the slowest one, not their sum
+#
+#   python -m backend.chat_load_test [--requests 32] [--min-ms 500] [--max-ms 1500] [--supabase-ms 50]
+#
+# Runs the real FastAPI app in-process. The Modal call (chat_with_lora.remote.aio) is replaced by an async
+# sleep of a random length per request, and the two Supabase lookups by blocking sleeps, so the result
+# shows whether anything on the request path still blocks the event loop or serializes requests.
+
+import argparse
+import asyncio
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+import httpx
+
+from backend import main
+
+class FakeChatMethod:
+    def __init__(self, delays: list[float]):
+        self.delays = delays
+        self.calls = 0
+
+    async def aio(self, **kwargs) -> str:
+        delay = self.delays[self.calls % len(self.delays)]
+        self.calls += 1
+        await asyncio.sleep(delay)
+        return f"reply after {delay:.2f}s"
+
+class FakeChatWorker:
+    def __init__(self, delays: list[float]):
+        self.chat_with_lora = SimpleNamespace(remote=FakeChatMethod(delays))
+
+def install_stubs(delays: list[float], supabase_seconds: float):
+    """ Patches the Modal worker and the Supabase lookups on the imported main module. """
+    def env_vars_for_lora(lora_id: str) -> dict:
+        time.sleep(supabase_seconds)
+        return {"hf_token": "hf_test", "hf_username": "load-test"}
+
+    def dataset_analysis(supabase, lora_id: str) -> tuple[int, str, list[str]]:
+        time.sleep(supabase_seconds)
+        return 64, "", []
+
+    main.chat_worker = FakeChatWorker(delays)
+    main.get_env_vars_for_lora = env_vars_for_lora
+    main.get_dataset_analysis_from_supabase = dataset_analysis
+    main.get_supabase = lambda: None
+
+async def run(requests: int) -> tuple[float, list[float]]:
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://load-test", timeout=None) as client:
+        async def one(i: int) -> float:
+            started = time.perf_counter()
+            response = await client.post("/chat", json={
+                "loraid": f"lora-{i}",
+                "chatHistory": [{"sender": "user", "message": f"hello {i}"}],
+            })
+            response.raise_for_status()
+            return time.perf_counter() - started
+
+        started = time.perf_counter()
+        latencies = await asyncio.gather(*(one(i) for i in range(requests)))
+        return time.perf_counter() - started, latencies
+
+def main_cli(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Concurrent /chat load test against a stubbed Modal worker")
+    parser.add_argument("--requests", type=int, default=main.CHAT_CONCURRENCY_LIMIT)
+    parser.add_argument("--min-ms", type=float, default=500)
+    parser.add_argument("--max-ms", type=float, default=1500)
+    parser.add_argument("--supabase-ms", type=float, default=50, help="blocking latency of each Supabase lookup")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="fail if wall time > tolerance x slowest reply")
+    args = parser.parse_args(argv)
+
+    rng = random.Random(0)
+    delays = [rng.uniform(args.min_ms, args.max_ms) / 1000 for _ in range(args.requests)]
+    install_stubs(delays, args.supabase_ms / 1000)
+
+    wall, latencies = asyncio.run(run(args.requests))
+    slowest, total = max(latencies), sum(delays)
+    print(f"📊 {args.requests} concurrent /chat calls (limit {main.CHAT_CONCURRENCY_LIMIT} in flight)")
+    print(f"⏱️ wall time:       {wall:.2f}s")
+    print(f"🐢 slowest request: {slowest:.2f}s (slowest stubbed reply {max(delays):.2f}s)")
+    print(f"➕ sum of replies:  {total:.2f}s (what a blocking handler would take)")
+
+    if wall > args.tolerance * slowest:
+        print(f"❌ Wall time is more than {args.tolerance}x the slowest request: requests are being serialized",
+              file=sys.stderr)
+        return 1
+    print("✅ Concurrent chats overlap", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
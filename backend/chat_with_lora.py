@@ -1,12 +1,19 @@
 # chat_with_lora.py - TODO: Rewrite for llama 3.1 8B instruct
 
 import modal
-from transformers import AutoTokenizer, AutoModelForCausalLM, StoppingCriteria, StoppingCriteriaList
-from peft import PeftModel
+from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig, DynamicCache, StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+from peft import PeftModel, get_peft_model_state_dict, set_peft_model_state_dict
 import torch
+import gc
 import json
+import os
+import queue
 import re
-from huggingface_hub import login
+import shutil
+import time
+from collections import Counter, OrderedDict, deque
+from threading import Event, Lock, RLock, Thread
+from huggingface_hub import login, snapshot_download
 
 # ANSI color codes for debug outputs
 GREEN = "\033[92m"      # Success
@@ -20,40 +27,347 @@ RESET = "\033[0m"
 
 app = modal.App("phi2-lora-chat")
 model_volume = modal.Volume.from_name("hf-cache", create_if_missing=True)
+# Optional secret providing HF_TOKEN, to load the base model at container start before any creator's
+# token is known. phi-2 is public, so without it the eager load runs anonymously.
+HF_SERVICE_SECRET_NAME = os.environ.get("HF_SERVICE_SECRET_NAME")
+service_secrets = [modal.Secret.from_name(HF_SERVICE_SECRET_NAME)] if HF_SERVICE_SECRET_NAME else []
 
 image = (
     modal.Image.debian_slim()
     .run_commands(["apt-get update", "apt-get install -y git build-essential cmake"])
-    .pip_install("torch", "transformers", "accelerate", "peft", "sentencepiece")
+    .pip_install("torch", "transformers", "accelerate", "peft", "sentencepiece", "bitsandbytes", "hqq")
 )
 
-@app.cls(gpu="A100-80GB", image=image, timeout=900, volumes={"/cache": model_volume})
+# Inputs one container accepts at once; they are merged into shared generate() batches
+MAX_CONCURRENT_INPUTS = 32
+# Where ChatWorker places the model, adapters and merged copies; backend/chat_worker_benchmark.py passes "cpu"
+# without a GPU
+DEVICE = "cuda"
+
+# The fp16 base model with the resized tokenizer is saved to the volume once (first cold start)
+# and every later container mmap-loads those safetensors straight onto the GPU
+BASE_MODEL_ID = "microsoft/phi-2"
+SNAPSHOT_DIR = "/cache/snapshots/phi-2-fp16"
+SNAPSHOT_MARKER = "snapshot.json"
+SNAPSHOT_FORMAT = 1
+BASE_MODEL_PATTERNS = ["*.json", "*.safetensors", "*.txt", "*.model"]
+# Adapters are downloaded into the volume; one a container loads ADAPTER_SNAPSHOT_MIN_LOADS times is committed
+ADAPTER_CACHE_DIR = "/cache/adapters"
+# Only the adapter itself; the {lora_id}-model repo may also hold checkpoints and optimizer state
+ADAPTER_PATTERNS = ["adapter_config.json", "adapter_model.*"]
+
+# Precision of the base model weights and of the KV cache, picked per deployment through the class parameters.
+# The adapters were trained against an NF4 base (lora_training_config_phi2.yaml); int8/nf4 weights leave room
+# for many more sequences and adapters per GPU, or fit phi-2 on a smaller GPU class.
+PRECISION_MODES = ("fp16", "int8", "nf4")
+KV_CACHE_MODES = ("fp16", "int8")
+# transformers' quanto cache only supports 2/4 bits; HQQ is the backend that quantizes the KV cache to 8 bits
+INT8_KV_CACHE_CONFIG = {"backend": "HQQ", "nbits": 8}
+
+def quantization_config(precision: str) -> BitsAndBytesConfig | None:
+    """ bitsandbytes settings for a precision mode; None for plain fp16. nf4 matches the training config. """
+    if precision not in PRECISION_MODES:
+        raise ValueError(f"Unknown precision '{precision}', expected one of {PRECISION_MODES}")
+    if precision == "int8":
+        return BitsAndBytesConfig(load_in_8bit=True)
+    if precision == "nf4":
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.float16,
+            bnb_4bit_use_double_quant=True
+        )
+    return None
+
+def add_missing_special_tokens(tokenizer) -> dict:
+    """ Gives the tokenizer ChatML bos/eos/pad tokens where it has none. Returns the ones added. """
+    special_tokens = {"bos_token": "<|im_start|>", "eos_token": "<|im_end|>", "pad_token": "<|im_end|>"}
+    added = {}
+    for k, v in special_tokens.items():
+        if getattr(tokenizer, k) is None:
+            tokenizer.add_special_tokens({k: v})
+            added[k] = v
+    return added
+
+@app.cls(gpu="A100-80GB", image=image, timeout=900, volumes={"/cache": model_volume}, secrets=service_secrets)
+@modal.concurrent(max_inputs=MAX_CONCURRENT_INPUTS)
 class Phi2Chat:
+    """ The Modal deployment of ChatWorker: one worker per container, every method forwards to it. """
+    precision: str = modal.parameter(default="fp16")
+    kv_cache: str = modal.parameter(default="fp16")
 
     @modal.enter()
     def setup(self):
         """
-        Lifecycle hook. Runs ONCE when the container starts.
-        Initializes empty state. The base model will be loaded on first request.
+        Lifecycle hook. Runs ONCE when the container starts, before it accepts inputs.
+        Builds the worker on the /cache volume and starts it, which loads the base model.
         """
-        print(f"{GREEN}[LIFECYCLE] Container spawned. Initializing empty state.{RESET}")
-        self.loaded_loras = {}
+        print(f"{GREEN}[LIFECYCLE] Container spawned. Starting the batching thread and loading the base model.{RESET}")
+        self.worker = ChatWorker(self.precision, self.kv_cache, commit_volume=model_volume.commit)
+        self.worker.start()
+
+    @modal.method()
+    def shutdown(self):
+        """
+        Manually clear state & free memory.
+        This gives a callable way to 'terminate' early.
+        """
+        return self.worker.shutdown()
+
+    @modal.method()
+    def adapter_stats(self) -> dict:
+        return self.worker.adapter_stats()
+
+    @modal.method()
+    def precision_stats(self) -> dict:
+        return self.worker.precision_stats()
+
+    @modal.method()
+    def speculative_stats(self) -> dict:
+        return self.worker.speculative_stats()
+
+    @modal.method()
+    def merged_stats(self) -> dict:
+        return self.worker.merged_stats()
+
+    @modal.method()
+    def prefix_cache_stats(self) -> dict:
+        return self.worker.prefix_cache_stats()
+
+    @modal.method()
+    def prefetch_adapters(self, adapters: list[dict]) -> dict:
+        return self.worker.prefetch_adapters(adapters)
+
+    @modal.method()
+    def load_stats(self) -> dict:
+        return self.worker.load_stats()
+
+    @modal.method()
+    def chat_with_lora(
+        self,
+        hf_token: str,
+        lora_repo: str,
+        chat_history: str, # json string of [{sender, message}, ...]
+        max_new_tokens: int,
+        end_prompt: str = None,
+        participants: dict = None,
+        speculative: bool = False
+    ) -> str:
+        return self.worker.chat_with_lora(
+            hf_token, lora_repo, chat_history, max_new_tokens, end_prompt, participants, speculative
+        )
+
+    @modal.method()
+    def chat_with_lora_stream(
+        self,
+        hf_token: str,
+        lora_repo: str,
+        chat_history: str, # json string of [{sender, message}, ...]
+        max_new_tokens: int,
+        end_prompt: str = None,
+        participants: dict = None
+    ):
+        """ Streaming variant of chat_with_lora (call with .remote_gen). """
+        yield from self.worker.chat_with_lora_stream(
+            hf_token, lora_repo, chat_history, max_new_tokens, end_prompt, participants
+        )
+
+class ChatWorker:
+    """
+    Everything one chat container does: the base model, the adapter and merged-model caches, the
+    batching thread and the generation paths. A plain class, so tests and backend/chat_worker_benchmark.py
+    run it in-process; Phi2Chat is its Modal deployment. snapshot_dir, adapter_cache_dir and device default
+    to the container's volume and GPU; commit_volume persists the volume after a snapshot or adapter download.
+    """
+    def __init__(
+        self,
+        precision: str = "fp16",
+        kv_cache: str = "fp16",
+        snapshot_dir: str = SNAPSHOT_DIR,
+        adapter_cache_dir: str = ADAPTER_CACHE_DIR,
+        device: str = DEVICE,
+        commit_volume=None
+    ):
+        if precision not in PRECISION_MODES:
+            raise ValueError(f"Unknown precision '{precision}', expected one of {PRECISION_MODES}")
+        if kv_cache not in KV_CACHE_MODES:
+            raise ValueError(f"Unknown kv_cache '{kv_cache}', expected one of {KV_CACHE_MODES}")
+        print(f"{CYAN}[INFO] Precision: weights {precision}, KV cache {kv_cache}{RESET}")
+        self.precision = precision
+        self.kv_cache = kv_cache
+        self.snapshot_dir = snapshot_dir
+        self.adapter_cache_dir = adapter_cache_dir
+        self.device = device
+        self.commit_volume = commit_volume or (lambda: None)
+
+        self.loaded_loras = AdapterCache(
+            max_adapters=int(os.environ.get("LORA_CACHE_MAX_ADAPTERS", "16")),
+            max_gpu_bytes=int(float(os.environ.get("LORA_CACHE_MAX_GPU_GB", "8")) * 1024**3),
+            max_cpu_bytes=int(float(os.environ.get("LORA_CACHE_MAX_CPU_GB", "16")) * 1024**3),
+            offload_fn=self._offload_lora,
+            restore_fn=self._restore_lora,
+            drop_fn=self._drop_lora
+        )
         self._base_model_loaded = False
+        self.load_timings = {}
+        self._load_started = None
+        self._first_token_pending = False
+        self.adapter_snapshot_min_loads = int(os.environ.get("ADAPTER_SNAPSHOT_MIN_LOADS", "2"))
+        self._adapter_loads = Counter()
+        self._adapter_paths = {}  # lora_repo -> local files of every adapter downloaded so far
+        # Which tier served each request's adapter: resident (GPU), warm (CPU copy) or cold (disk / Hub)
+        self.adapter_requests = Counter()
+        self.adapters_prefetched = 0
         self.tokenizer = None
         self.base_model = None
+        self.peft_model = None  # one PeftModel holding every loaded LoRA as a named adapter
+
+        # Inputs run concurrently in threads. _load_lock guards base model loading,
+        # _gpu_lock guards adapter switching/loading and every generate() call.
+        self._load_lock = Lock()
+        self._gpu_lock = RLock()
+
+        # Cross-request batching: chat_with_lora and chat_with_lora_stream enqueue, one worker thread generates
+        self.batch_window = float(os.environ.get("BATCH_WINDOW_MS", "15")) / 1000
+        self.max_batch_size = int(os.environ.get("MAX_BATCH_SIZE", "16"))
+        self._batch_queue = queue.Queue()
+        self._batch_carry_over = []
+
+        # ChatML turn -> token ids, shared across requests so history is not re-tokenized
+        self.max_cached_turns = int(os.environ.get("TURN_TOKEN_CACHE_SIZE", "50000"))
+        self._turn_ids = OrderedDict()
+        self._turn_ids_lock = Lock()
+
+        # Merged copies (base + LoRA folded in) of the hottest adapters; off unless given GPU memory.
+        # They are built from the fp16 snapshot, so quantized modes never merge.
+        merged_max_gb = float(os.environ.get("MERGED_MODELS_MAX_GPU_GB", "0")) if self.precision == "fp16" else 0
+        self.merged_models = MergedModelCache(
+            max_bytes=int(merged_max_gb * 1024**3),
+            promote_rpm=float(os.environ.get("MERGE_PROMOTE_RPM", "30")),
+            demote_rpm=float(os.environ.get("MERGE_DEMOTE_RPM", "10"))
+        )
+        self.base_model_nbytes = 0
+
+        # KV caches of recent single-row generate() calls, reused as the prefix of the next prompt of the same
+        # model: the next turn of a conversation resends the same history, so only its new turns are prefilled
+        self.prefix_cache = PrefixKVCache(
+            max_entries=int(os.environ.get("KV_CACHE_MAX_ENTRIES", "256")),
+            max_bytes=int(float(os.environ.get("KV_CACHE_MAX_GPU_GB", "4")) * 1024**3),
+            min_reuse_tokens=int(os.environ.get("KV_CACHE_MIN_REUSE_TOKENS", "32"))
+        )
+
+        # Opt-in speculative decoding: draft tokens looked up in the prompt, verified by the model
+        self.prompt_lookup_tokens = int(os.environ.get("PROMPT_LOOKUP_NUM_TOKENS", "10"))
+        self.decode_stats = DecodeStats()
+
+        # Loads the base model in start(), before any creator's token is known
+        self.service_token = os.environ.get("HF_TOKEN")
+
+    def start(self):
+        """
+        Starts the batching thread and loads the base model with the service token, so the first
+        request after a scale-up does not pay for it. Adapters are still loaded on demand (or ahead
+        of time through prefetch_adapters). If the load fails the first request retries it with the
+        creator's token.
+        """
+        Thread(target=self._batch_loop, daemon=True).start()
+        try:
+            self._ensure_base_model_loaded(self.service_token)
+        except Exception as e:
+            print(f"{RED}[ERROR] Eager base model load failed, deferring to first request: {e}{RESET}")
 
-    @modal.method()
     def shutdown(self):
         """
         Manually clear state & free memory.
         This gives a callable way to 'terminate' early.
         """
-        self.loaded_loras.clear()
-        self.base_model = None
-        self.tokenizer = None
+        with self._gpu_lock:
+            self.loaded_loras.clear()
+            self.merged_models.clear()
+            self.prefix_cache.clear()
+            self.peft_model = None
+            self.base_model = None
+            self.tokenizer = None
+            self._base_model_loaded = False
+            gc.collect()
+            torch.cuda.empty_cache()
         print("[LIFECYCLE] Manual shutdown triggered")
         return "[INFO] Chat worker shut down manually."
-    
+
+    def adapter_stats(self) -> dict:
+        """ Resident/warm adapters, cache counters, and how often a request found its adapter cold. """
+        requests = sum(self.adapter_requests.values())
+        return {
+            **self.loaded_loras.stats(),
+            "requests": dict(self.adapter_requests),
+            "cold_request_rate": self.adapter_requests["cold"] / requests if requests else 0.0,
+            "prefetched": self.adapters_prefetched,
+        }
+
+    def precision_stats(self) -> dict:
+        """
+        Memory and throughput report of this container's precision mode. Quality is checked
+        offline against fp16/fp32 with backend/precision_check.py.
+        """
+        with self._gpu_lock:
+            return {
+                "precision": self.precision,
+                "kv_cache": self.kv_cache,
+                "weights_gb": self.base_model_nbytes / 1024**3,
+                "gpu_allocated_gb": torch.cuda.memory_allocated() / 1024**3,
+                "gpu_peak_gb": torch.cuda.max_memory_allocated() / 1024**3,
+                "gpu_total_gb": torch.cuda.get_device_properties(0).total_memory / 1024**3,
+                "prefix_kv_cache_gb": self.prefix_cache.total_bytes() / 1024**3,
+                "resident_adapters": len(self.loaded_loras.resident),
+                "throughput": self.decode_stats.stats(),
+            }
+
+    def speculative_stats(self) -> dict:
+        """ Tokens per decoding step, accepted drafts and ms/token of standard, speculative and batched generate() calls. """
+        with self._gpu_lock:
+            return self.decode_stats.stats()
+
+    def merged_stats(self) -> dict:
+        """ Merged LoRAs, request rates, promotions/demotions and per-token latency merged vs unmerged. """
+        with self._gpu_lock:
+            return self.merged_models.stats()
+
+    def prefix_cache_stats(self) -> dict:
+        """ Entries, bytes and reuse counters of the prefix KV cache. """
+        with self._gpu_lock:
+            return self.prefix_cache.stats()
+
+    def prefetch_adapters(self, adapters: list[dict]) -> dict:
+        """
+        Downloads and activates adapters before traffic arrives, e.g. the backend's recently active LoRAs.
+        adapters: [{"hf_token": ..., "lora_repo": ...}, ...], most important first; at most max_adapters
+        of them are made resident. Returns lora_repo -> "resident" | "loaded" | "error: ...".
+        """
+        self._ensure_base_model_loaded(self.service_token)
+
+        results = {}
+        for adapter in adapters[:self.loaded_loras.max_adapters]:
+            lora_repo, hf_token = adapter["lora_repo"], adapter.get("hf_token")
+            if lora_repo in self.loaded_loras.resident:
+                results[lora_repo] = "resident"
+                continue
+            try:
+                adapter_path = self._fetch_adapter(hf_token, lora_repo)
+                with self._gpu_lock:
+                    self._activate_lora(hf_token, lora_repo, adapter_path)
+                self.adapters_prefetched += 1
+                results[lora_repo] = "loaded"
+            except Exception as e:
+                print(f"{RED}[ERROR] Prefetch of LoRA {lora_repo} failed: {e}{RESET}")
+                results[lora_repo] = f"error: {e}"
+
+        print(f"{GREEN}[CACHE] Prefetched adapters: {results}{RESET}")
+        return results
+
+    def load_stats(self) -> dict:
+        """ Cold/warm start breakdown of the base model load (seconds) and the first token after it. """
+        return dict(self.load_timings)
+
     def _ensure_base_model_loaded(self, hf_token: str):
         """
         Internal method to load the base model and tokenizer.
@@ -64,101 +378,348 @@ class Phi2Chat:
             print(f"{YELLOW}[INFO] Base model already loaded. Skipping.{RESET}")
             return
 
-        print(f"{YELLOW}[INFO] Logging in to Hugging Face Hub...{RESET}")
-        login(token=hf_token)
-        print(f"{GREEN}[SUCCESS] Logged in successfully{RESET}")
+        with self._load_lock:
+            if not self._base_model_loaded:
+                self._load_base_model(hf_token)
+
+    def _load_base_model(self, hf_token: str):
+        self._load_started = time.perf_counter()
+        timings = {}
+
+        # phi-2 is public, so the load also works without a token
+        if hf_token:
+            print(f"{YELLOW}[INFO] Logging in to Hugging Face Hub...{RESET}")
+            login(token=hf_token)
+            print(f"{GREEN}[SUCCESS] Logged in successfully{RESET}")
+
+        # Warm start: the snapshot already holds the fp16 weights with resized embeddings
+        warm = self._read_snapshot_marker() is not None
+        timings["mode"] = "warm" if warm else "cold"
+        timings["precision"] = self.precision
+        t = time.perf_counter()
+        if warm:
+            source = self.snapshot_dir
+            print(f"{GREEN}[INFO] Warm start from snapshot {self.snapshot_dir}{RESET}")
+        else:
+            print(f"{YELLOW}[INFO] Cold start: downloading '{BASE_MODEL_ID}' into the volume...{RESET}")
+            source = snapshot_download(
+                BASE_MODEL_ID, token=hf_token, cache_dir="/cache", allow_patterns=BASE_MODEL_PATTERNS
+            )
+        timings["download_s"] = time.perf_counter() - t
 
         # Load tokenizer
-        print(f"{YELLOW}[INFO] Loading tokenizer from repo 'microsoft/phi-2'...{RESET}")
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            "microsoft/phi-2",
-            use_fast=True,
-            token=hf_token,
-            cache_dir="/cache",
-            trust_remote_code=False,
-            force_download=False
-        )
+        print(f"{YELLOW}[INFO] Loading tokenizer from '{source}'...{RESET}")
+        t = time.perf_counter()
+        self.tokenizer = AutoTokenizer.from_pretrained(source, use_fast=True, trust_remote_code=False)
         print(f"{GREEN}[SUCCESS] Tokenizer loaded. Original vocab size: {len(self.tokenizer)}{RESET}")
 
-        # Add missing special tokens
-        special_tokens = {"bos_token": "<|im_start|>", "eos_token": "<|im_end|>", "pad_token": "<|im_end|>"}
-        added = {}
-        for k, v in special_tokens.items():
-            if getattr(self.tokenizer, k) is None:
-                self.tokenizer.add_special_tokens({k: v})
-                added[k] = v
+        added = add_missing_special_tokens(self.tokenizer)
         if added:
             print(f"{GREEN}[INFO] Added missing special tokens: {added}. New vocab size: {len(self.tokenizer)}{RESET}")
         else:
             print(f"{GREEN}[INFO] All special tokens already present. No changes made.{RESET}")
+        timings["tokenizer_s"] = time.perf_counter() - t
 
-        # Load base model WITHOUT resizing embeddings yet
-        print(f"{YELLOW}[INFO] Loading base model from repo 'microsoft/phi-2'...{RESET}")
+        # Load base model: safetensors shards are memory-mapped and each tensor is placed on the GPU
+        # as it is read, already in fp16, so the weights are neither materialized on the CPU nor copied twice.
+        # int8/nf4 quantize each linear layer on the way in; embeddings and lm_head stay fp16.
+        print(f"{YELLOW}[INFO] Loading base model from '{source}' ({self.precision})...{RESET}")
+        t = time.perf_counter()
         self.base_model = AutoModelForCausalLM.from_pretrained(
-            "microsoft/phi-2",
+            source,
             torch_dtype=torch.float16,
-            device_map="auto",
-            token=hf_token,
-            cache_dir="/cache",
-            trust_remote_code=False,
-            force_download=True
-        ).half().to("cuda")
+            quantization_config=quantization_config(self.precision),
+            device_map=self.device,
+            low_cpu_mem_usage=True,
+            use_safetensors=True,
+            trust_remote_code=False
+        )
+        if self.device == "cuda":
+            torch.cuda.synchronize()
+        # Deserialization and host->device transfer overlap per tensor, so they are timed together
+        timings["deserialize_to_device_s"] = time.perf_counter() - t
         print(f"{GREEN}[SUCCESS] Base model loaded.{RESET}")
         print(f"{BLUE}[DEBUG] Base model embedding matrix shape: {self.base_model.get_input_embeddings().weight.shape}{RESET}")
 
+        # Resize embeddings once here, before any adapter wraps the base model,
+        # instead of resizing (and copying) them again for every LoRA.
+        tokenizer_size = len(self.tokenizer)
+        if tokenizer_size > self.base_model.get_input_embeddings().weight.shape[0]:
+            print(f"{MAGENTA}[WARN] Resizing embeddings to match tokenizer ({tokenizer_size}){RESET}")
+            self.base_model.resize_token_embeddings(tokenizer_size)
+            print(f"{GREEN}[SUCCESS] Embeddings resized.{RESET}")
+
+        # Size of one merged copy, for the merged-model memory ceiling (packed bytes in quantized modes)
+        self.base_model_nbytes = sum(p.numel() * p.element_size() for p in self.base_model.parameters())
+        print(f"{CYAN}[INFO] Base model weights: {self.base_model_nbytes / 1024**3:.2f} GB{RESET}")
+
+        # Only fp16 containers can write the fp16 snapshot; quantized ones stay cold until one has
+        if not warm and self.precision == "fp16":
+            t = time.perf_counter()
+            self._save_snapshot()
+            timings["snapshot_s"] = time.perf_counter() - t
+
+        # Built once and shared by every request's stopping criteria
+        self.stop_matcher = KeywordMatcher(self.tokenizer, self.get_stop_convo_endings())
+        self._newline_ids = self.tokenizer("\n", add_special_tokens=False)["input_ids"]
+
+        timings["total_s"] = time.perf_counter() - self._load_started
+        self.load_timings = timings
+        self._first_token_pending = True
         self._base_model_loaded = True
+        print(f"{CYAN}[TIMING] Base model load: " + ", ".join(
+            f"{k}={v:.2f}" if isinstance(v, float) else f"{k}={v}" for k, v in timings.items()
+        ) + f"{RESET}")
         print(f"{GREEN}[INFO] Base model ready for LoRA loading.{RESET}")
 
-    def get_lora_model(self, hf_token: str, lora_repo: str):
+    def _read_snapshot_marker(self) -> dict | None:
+        """ The marker is written last, so its presence means the snapshot is complete. """
+        try:
+            with open(os.path.join(self.snapshot_dir, SNAPSHOT_MARKER), "r") as f:
+                marker = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if marker.get("format") != SNAPSHOT_FORMAT or marker.get("base_model") != BASE_MODEL_ID:
+            return None
+        return marker
+
+    def _save_snapshot(self):
+        """
+        Saves the fp16 base model (embeddings already resized) and the tokenizer to the volume.
+        Written to a temporary directory and renamed, so a container that starts meanwhile
+        never sees half a snapshot; if another container finished first, its copy is kept.
+        """
+        tmp_dir = f"{self.snapshot_dir}.tmp-{os.getpid()}-{int(time.time())}"
+        print(f"{YELLOW}[INFO] Saving warm-start snapshot to {self.snapshot_dir}...{RESET}")
+        try:
+            self.tokenizer.save_pretrained(tmp_dir)
+            self.base_model.save_pretrained(tmp_dir, safe_serialization=True)
+            with open(os.path.join(tmp_dir, SNAPSHOT_MARKER), "w") as f:
+                json.dump({"format": SNAPSHOT_FORMAT, "base_model": BASE_MODEL_ID, "vocab_size": len(self.tokenizer)}, f)
+            if os.path.exists(self.snapshot_dir):
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            else:
+                os.rename(tmp_dir, self.snapshot_dir)
+            self.commit_volume()
+            print(f"{GREEN}[SUCCESS] Snapshot saved.{RESET}")
+        except Exception as e:
+            print(f"{MAGENTA}[WARN] Failed to save snapshot, next start will be cold again: {e}{RESET}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _record_first_token(self):
+        if self._first_token_pending:
+            self._first_token_pending = False
+            self.load_timings["first_token_s"] = time.perf_counter() - self._load_started
+            print(f"{CYAN}[TIMING] First token {self.load_timings['first_token_s']:.2f}s after load start{RESET}")
+
+    def get_lora_model(self, hf_token: str, lora_repo: str, adapter_path: str = None):
+        """
+        Request path of _activate_lora: also counts which cache tier served the adapter and feeds
+        the merge policy. Returns the LoRA's merged copy if it has one, otherwise the shared PeftModel
+        with the adapter active. adapter_path is what _fetch_adapter returned before the lock was taken.
+        Caller must hold _gpu_lock.
         """
-        Gets a LoRA model from the cache, loading it if necessary.
+        self.merged_models.record(lora_repo)
+        self._rebalance_merged(hf_token, lora_repo)
+
+        merged = self.merged_models.get(lora_repo)
+        if merged is not None:
+            self.adapter_requests["merged"] += 1
+            return merged
+
+        if lora_repo in self.loaded_loras.resident:
+            self.adapter_requests["resident"] += 1
+        elif lora_repo in self.loaded_loras:
+            self.adapter_requests["warm"] += 1
+        else:
+            self.adapter_requests["cold"] += 1
+            print(f"{MAGENTA}[CACHE] Cold adapter for request: {lora_repo}{RESET}")
+        return self._activate_lora(hf_token, lora_repo, adapter_path)
+
+    def _fetch_adapter(self, hf_token: str, lora_repo: str) -> str | None:
+        """
+        Downloads a LoRA that is in neither cache tier (nor merged) and returns its local path; None if cached.
+        Called before taking _gpu_lock, so a cold download does not stall the batches and streams of other creators.
+        """
+        if lora_repo in self.loaded_loras or self.merged_models.get(lora_repo) is not None:
+            return None
+        return self._download_adapter(hf_token, lora_repo)
+
+    def _download_adapter(self, hf_token: str, lora_repo: str) -> str:
+        """ Downloads the adapter files into the volume and returns their path. Does not need _gpu_lock. """
+        try:
+            # Only the revision check goes to the Hub when the files are already in the volume
+            t = time.perf_counter()
+            adapter_path = snapshot_download(lora_repo, token=hf_token, cache_dir=self.adapter_cache_dir, allow_patterns=ADAPTER_PATTERNS)
+            print(f"{YELLOW}[INFO] LoRA {lora_repo} downloaded in {time.perf_counter() - t:.2f}s{RESET}")
+            self._adapter_paths[lora_repo] = adapter_path
+        except Exception as e:
+            print(f"{RED}[ERROR] Failed to download LoRA: {e}{RESET}")
+            raise RuntimeError(f"Failed to load LoRA {lora_repo}: {e}")
+
+        # Frequently used adapters are persisted so the next container skips their download
+        self._adapter_loads[lora_repo] += 1
+        if self._adapter_loads[lora_repo] == self.adapter_snapshot_min_loads:
+            try:
+                self.commit_volume()
+                print(f"{GREEN}[CACHE] LoRA {lora_repo} committed to the volume{RESET}")
+            except Exception as e:
+                print(f"{MAGENTA}[WARN] Failed to commit LoRA {lora_repo} to the volume: {e}{RESET}")
+        return adapter_path
+
+    def _activate_lora(self, hf_token: str, lora_repo: str, adapter_path: str = None):
+        """
+        Activates the LoRA as a named adapter on the shared PeftModel, loading it if necessary,
+        and returns that PeftModel. Every LoRA lives on the same wrapped base model, so only
+        the adapter weights (LoRA matrices + modules_to_save) are stored per creator.
+        adapter_path is the LoRA's files, downloaded beforehand without the lock.
         Assumes the base model is already loaded.
         """
-        if lora_repo in self.loaded_loras:
+        adapter_name = self.loaded_loras.get(lora_repo)
+        if adapter_name is not None:
             print(f"{YELLOW}[INFO] LoRA {lora_repo} already loaded. Using cache.{RESET}")
-            return self.loaded_loras[lora_repo]
+            self.peft_model.set_adapter(adapter_name)
+            return self.peft_model
 
-        print(f"{YELLOW}[INFO] Loading LoRA from repo: {lora_repo}...{RESET}")
+        if adapter_path is None:
+            # Cached when the caller checked, evicted since: its files are still in the volume
+            adapter_path = self._adapter_paths.get(lora_repo)
+        if adapter_path is None:
+            print(f"{MAGENTA}[CACHE] LoRA {lora_repo} was not fetched ahead, downloading under the GPU lock{RESET}")
+            adapter_path = self._download_adapter(hf_token, lora_repo)
+
+        adapter_name = self._adapter_name(lora_repo)
+        print(f"{YELLOW}[INFO] Loading LoRA from repo: {lora_repo} as adapter '{adapter_name}'...{RESET}")
         try:
-            lora_model = PeftModel.from_pretrained(
-                self.base_model,
-                lora_repo,
-                token=hf_token
-            )
-            print(f"{GREEN}[SUCCESS] LoRA loaded successfully!{RESET}")
+            t = time.perf_counter()
+            if self.peft_model is None:
+                self.peft_model = PeftModel.from_pretrained(
+                    self.base_model,
+                    adapter_path,
+                    adapter_name=adapter_name,
+                    torch_device=self.device
+                )
+            else:
+                self.peft_model.load_adapter(adapter_path, adapter_name=adapter_name, torch_device=self.device)
+            print(f"{GREEN}[SUCCESS] LoRA loaded successfully! (load {time.perf_counter() - t:.2f}s){RESET}")
         except Exception as e:
             print(f"{RED}[ERROR] Failed to load LoRA: {e}{RESET}")
             raise RuntimeError(f"Failed to load LoRA {lora_repo}: {e}")
 
-        # Debug info about embeddings
-        base_emb = self.base_model.get_input_embeddings().weight.shape
-        lora_emb = lora_model.get_input_embeddings().weight.shape
-        print(f"{CYAN}[INFO] Base model embedding shape: {base_emb}{RESET}")
-        print(f"{CYAN}[INFO] LoRA embedding shape: {lora_emb}{RESET}")
-
-        # Resize tokenizer / embeddings if needed
-        tokenizer_size = len(self.tokenizer)
-        if tokenizer_size > lora_emb[0]:
-            print(f"{MAGENTA}[WARN] Resizing embeddings to match tokenizer ({tokenizer_size}){RESET}")
-            lora_model.resize_token_embeddings(tokenizer_size)
-            with torch.no_grad():
-                lora_model.get_input_embeddings().weight[:lora_emb[0], :] = self.base_model.get_input_embeddings().weight
-            print(f"{GREEN}[SUCCESS] Embeddings resized and overlapping weights copied.{RESET}")
+        self.peft_model.set_adapter(adapter_name)
+        self.peft_model.eval()
 
         print(f"{GREEN}[INFO] LoRA model ready for generation.{RESET}")
-        self.loaded_loras[lora_repo] = lora_model
-        return lora_model
+        self.loaded_loras.put(lora_repo, adapter_name, self._adapter_nbytes(adapter_name))
+        return self.peft_model
+
+    def _rebalance_merged(self, hf_token: str, lora_repo: str):
+        """ Drops merged copies that cooled down and starts merging lora_repo if it is hot. Caller holds _gpu_lock. """
+        if self.merged_models.max_bytes <= 0:
+            return
+        demote, promote = self.merged_models.plan(lora_repo, self.base_model_nbytes)
+        for key in demote:
+            print(f"{MAGENTA}[MERGE] Demoting {key} ({self.merged_models.rate(key):.1f} req/min){RESET}")
+            self.merged_models.remove(key)
+            gc.collect()
+            torch.cuda.empty_cache()
+        # Merged copies are built from the on-volume snapshot, not by copying the adapter-injected base model
+        if promote and self._read_snapshot_marker() is not None:
+            self.merged_models.pending = lora_repo
+            Thread(target=self._promote_merged, args=(hf_token, lora_repo), daemon=True).start()
+
+    def _promote_merged(self, hf_token: str, lora_repo: str):
+        """
+        Background thread: builds a plain model with the LoRA folded into its weights (merge_and_unload),
+        so its requests skip the extra LoRA matmuls. Only copying the adapter weights holds _gpu_lock.
+        """
+        try:
+            print(f"{YELLOW}[MERGE] Promoting {lora_repo} ({self.merged_models.rate(lora_repo):.1f} req/min)...{RESET}")
+            t = time.perf_counter()
+            adapter_path = self._fetch_adapter(hf_token, lora_repo)
+            with self._gpu_lock:
+                self._activate_lora(hf_token, lora_repo, adapter_path)
+                adapter_name = self._adapter_name(lora_repo)
+                config = self.peft_model.peft_config[adapter_name]
+                state = {
+                    k: v.detach().clone()
+                    for k, v in get_peft_model_state_dict(self.peft_model, adapter_name=adapter_name).items()
+                }
+
+            model_copy = AutoModelForCausalLM.from_pretrained(
+                self.snapshot_dir,
+                torch_dtype=torch.float16,
+                device_map=self.device,
+                low_cpu_mem_usage=True,
+                use_safetensors=True
+            )
+            merged = PeftModel(model_copy, config, adapter_name=adapter_name)
+            set_peft_model_state_dict(merged, state, adapter_name=adapter_name)
+            merged = merged.merge_and_unload()
+            merged.eval()
+
+            with self._gpu_lock:
+                self.merged_models.add(lora_repo, merged, self.base_model_nbytes)
+            print(f"{GREEN}[MERGE] {lora_repo} merged in {time.perf_counter() - t:.1f}s{RESET}")
+        except Exception as e:
+            print(f"{RED}[ERROR] Merging {lora_repo} failed: {e}{RESET}")
+        finally:
+            self.merged_models.pending = None
 
-    def format_chatml_conversation(
+    @staticmethod
+    def _adapter_name(lora_repo: str) -> str:
+        # Adapter names become module keys, which may not contain '.'
+        return lora_repo.replace("/", "__").replace(".", "_")
+
+    def _adapter_nbytes(self, adapter_name: str) -> int:
+        """ GPU bytes owned by the adapter itself (LoRA matrices + modules_to_save). """
+        state = get_peft_model_state_dict(self.peft_model, adapter_name=adapter_name)
+        return sum(t.numel() * t.element_size() for t in state.values())
+
+    def _offload_lora(self, lora_repo: str, adapter_name: str):
+        """ Copy adapter weights to CPU RAM and remove the adapter from the GPU. Returns the warm copy. """
+        print(f"{MAGENTA}[CACHE] Offloading LoRA {lora_repo} to CPU{RESET}")
+        state = get_peft_model_state_dict(self.peft_model, adapter_name=adapter_name)
+        state = {k: v.detach().to("cpu", copy=True) for k, v in state.items()}
+        config = self.peft_model.peft_config[adapter_name]
+        self._drop_lora(lora_repo, adapter_name)
+        return config, state
+
+    def _restore_lora(self, lora_repo: str, warm):
+        """ Re-add an adapter from its CPU copy, skipping the Hugging Face download. """
+        print(f"{YELLOW}[CACHE] Restoring LoRA {lora_repo} from CPU{RESET}")
+        config, state = warm
+        adapter_name = self._adapter_name(lora_repo)
+        self.peft_model.add_adapter(adapter_name, config)
+        set_peft_model_state_dict(
+            self.peft_model,
+            {k: v.to(self.base_model.device) for k, v in state.items()},
+            adapter_name=adapter_name
+        )
+        return adapter_name
+
+    def _drop_lora(self, lora_repo: str, adapter_name: str):
+        print(f"{MAGENTA}[CACHE] Dropping LoRA {lora_repo}{RESET}")
+        self.peft_model.delete_adapter(adapter_name)
+        gc.collect()
+        torch.cuda.empty_cache()
+
+    def build_chatml_input_ids(
         self,
         history: list,
         end_prompt: str = None,
         participants: dict = None,
         max_tokens: int = 1800
-    ) -> str:
+    ) -> list[int]:
         """
-        Build a ChatML-style conversation string from chat history,
+        Build the token ids of a ChatML-style prompt from chat history,
         keeping only the most recent turns that fit within max_tokens.
+
+        Turns are tokenized in batches, newest first, and only until the budget is spent.
+        Their ids are memoized, so the next message of the same conversation only tokenizes
+        the new turns. The ids are concatenated directly: every piece starts with '<|im_start|>'
+        and is joined by a newline, which are pre-tokenizer boundaries, so the result equals
+        tokenizing the joined prompt string.
         
         Args:
             history: [{ "sender": "You", "message": "..."}, {...}]
@@ -168,55 +729,86 @@ class Phi2Chat:
             max_tokens: rough token budget for history
         
         Returns:
-            str: ChatML-formatted prompt ready for tokenization.
+            list[int]: prompt token ids ready for generate().
         """
         if participants is None:
             participants = {"user": "You", "assistant": "Assistant"}
-        
-        lines = []
 
-        # Optional: add a system prompt at the very start
+        # Walk backwards through history (most recent first), tokenizing a growing chunk at a time
+        selected = []
+        total_tokens = 0
+        end = len(history)
+        chunk_size = 16
+        budget_left = True
+        while end > 0 and budget_left:
+            start = max(0, end - chunk_size)
+            entries = [self._chatml_entry(turn, participants) for turn in reversed(history[start:end])]
+            for ids in self._encode_turns(entries):
+                if total_tokens + len(ids) > max_tokens:
+                    budget_left = False
+                    break
+                total_tokens += len(ids)
+                selected.append(ids)
+            end = start
+            chunk_size *= 2
+
+        # Same layout as the original string prompt: history turns, then the optional
+        # system prompt, then the assistant cue (its trailing newline was always stripped)
+        pieces = selected[::-1]
         if end_prompt:
-            lines.append(f"<|im_start|>system\n{end_prompt}<|im_end|>")
+            pieces.append(self._encode_turns([f"<|im_start|>system\n{end_prompt}<|im_end|>"])[0])
 
-        total_tokens = 0
+        # Only add assistant prompt if last turn was user
+        if history and history[-1]["sender"] == participants.get("user", "You"):
+            pieces.append(self._encode_turns(["<|im_start|>assistant"])[0])
 
-        # Walk backwards through history (most recent first)
-        for turn in reversed(history):
-            # Map sender -> ChatML role
-            if turn["sender"] == participants.get("user", "You"):
-                role = "user"
-            elif turn["sender"] == participants.get("assistant", "Assistant"):
-                role = "assistant"
-            else:
-                role = "user"  # default fallback
+        input_ids = []
+        for i, ids in enumerate(pieces):
+            if i:
+                input_ids.extend(self._newline_ids)
+            input_ids.extend(ids)
+        return input_ids
 
-            entry = f"<|im_start|>{role}\n{turn['message']}<|im_end|>"
+    @staticmethod
+    def _chatml_entry(turn: dict, participants: dict) -> str:
+        # Map sender -> ChatML role
+        if turn["sender"] == participants.get("user", "You"):
+            role = "user"
+        elif turn["sender"] == participants.get("assistant", "Assistant"):
+            role = "assistant"
+        else:
+            role = "user"  # default fallback
+        return f"<|im_start|>{role}\n{turn['message']}<|im_end|>"
 
-            # Estimate tokens
-            tokens = len(self.tokenizer.encode(entry))
-            if total_tokens + tokens > max_tokens:
-                break
-            total_tokens += tokens
+    def _encode_turns(self, entries: list[str]) -> list[tuple]:
+        """ Token ids per entry; unseen entries are tokenized in one batch call and memoized. """
+        with self._turn_ids_lock:
+            cached = [self._turn_ids.get(entry) for entry in entries]
+            for entry, ids in zip(entries, cached):
+                if ids is not None:
+                    self._turn_ids.move_to_end(entry)
 
-            # Prepend so order is correct
-            lines.insert(0, entry)
+        missing = [entry for entry, ids in zip(entries, cached) if ids is None]
+        if not missing:
+            return cached
 
-        # Only add assistant prompt if last turn was user
-        if history and history[-1]["sender"] == participants.get("user", "You"):
-            lines.append("<|im_start|>assistant\n")
-        
-        return "\n".join(lines)
+        encoded = dict(zip(missing, (
+            tuple(ids) for ids in self.tokenizer(missing, add_special_tokens=False)["input_ids"]
+        )))
+        with self._turn_ids_lock:
+            for entry, ids in encoded.items():
+                self._turn_ids[entry] = ids
+            while len(self._turn_ids) > self.max_cached_turns:
+                self._turn_ids.popitem(last=False)
+
+        return [ids if ids is not None else encoded[entry] for entry, ids in zip(entries, cached)]
 
     def truncate_to_last_sentence(self, text: str) -> str:
         """
         Truncate text to the last full sentence.
         A sentence ends with '.', '!', or '?'.
         """
-        sentence_endings = [m.end() for m in re.finditer(r'[.!?]', text)]
-        if sentence_endings:
-            return text[:sentence_endings[-1]].strip()
-        return text.strip()
+        return truncate_to_last_sentence(text)
 
     def filter_output(self, text: str) -> str:
         """
@@ -225,34 +817,7 @@ class Phi2Chat:
         - Removes any "<This message was edited…>" artifacts
         - Strips extra whitespace
         """
-        # Remove any <@…> or similar junk
-        text = re.sub(r"<[@:].*?>", "", text)
-
-        # Remove any ChatML-style <|…|> tokens
-        text = re.sub(r"<\|.*?\|>", "", text)
-
-        # Remove edited message artifacts like "<This message was edited by…>"
-        text = re.sub(r"<This message was edited.*?>", "", text, flags=re.IGNORECASE)
-
-        # Collapse multiple whitespaces/newlines to a single space
-        text = re.sub(r"\s+", " ", text)
-
-        return text.strip()
-
-        # Remove junk tokens like <@a>
-        text = re.sub(r"<[@:].*?>", "", text)
-        
-        # Remove ChatML tokens
-        text = re.sub(r"<\|im_(start|end)\|>", "", text)
-        
-        # Remove end-of-message artifacts from chat exports
-        text = re.sub(r"<\|end of message text body\|>", "", text, flags=re.IGNORECASE)
-        text = re.sub(r"<This message was edited.*?>", "", text, flags=re.IGNORECASE)
-
-        # Clean extra whitespace/newlines
-        text = re.sub(r"\s+", " ", text)
-        text = "\n".join(line.strip() for line in text.splitlines() if line.strip())
-        return text.strip()
+        return filter_output(text)
 
     @staticmethod
     def get_stop_convo_endings():
@@ -290,18 +855,18 @@ class Phi2Chat:
             "end of chat",
         ]
     
-    @modal.method()
-    def chat_with_lora(
+    def _prepare_inputs(
         self,
         hf_token: str,
-        lora_repo: str,
-        chat_history: str, # json string of [{sender, message}, ...]
-        max_new_tokens: int,
+        chat_history: str,
         end_prompt: str = None,
         participants: dict = None
-    ) -> str:
-        print(f"{YELLOW}[INFO] chat_with_lora called{RESET}")
-        
+    ):
+        """
+        Shared setup for the blocking and streaming chat paths.
+        Returns the prompt input_ids as a (1, n) CPU tensor, or None if there is no history to answer.
+        Does not touch the LoRA adapters, so it can run while another request is generating.
+        """
         # Deserialize JSON string into a Python list
         try:
             chat_history = json.loads(chat_history)
@@ -311,50 +876,50 @@ class Phi2Chat:
 
         # This ensures the base model is loaded (only happens on first call)
         self._ensure_base_model_loaded(hf_token)
-        # This uses the persistent cache for LoRAs
-        lora_model = self.get_lora_model(hf_token, lora_repo)
 
         if not chat_history or not isinstance(chat_history, list):
             print(f"{MAGENTA}[WARN] Empty or invalid chat_history received{RESET}")
-            return "[INFO] No conversation history provided."
+            return None
 
         # Allocate 80% for history, 20% for new response
-        model_max = getattr(lora_model.config, "max_position_embeddings", 2048)
+        model_max = getattr(self.base_model.config, "max_position_embeddings", 2048)
         history_budget = int(model_max * 0.8)
 
         print(f"{YELLOW}[INFO] Building ChatML conversation prompt...{RESET}")
-        formatted_prompt = self.format_chatml_conversation(
+        input_ids = self.build_chatml_input_ids(
             chat_history, 
             end_prompt, 
             participants, 
             max_tokens=history_budget
         )
 
-        inputs = self.tokenizer(formatted_prompt.strip(), return_tensors="pt").to(lora_model.device)
+        return torch.tensor([input_ids], dtype=torch.long)
 
-        stopping_criteria = StoppingCriteriaList([
-            KeywordStoppingCriteria(self.tokenizer, self.get_stop_convo_endings())
-        ])
-
-        print(f"{YELLOW}[INFO] Generating response...{RESET}")
-        with torch.no_grad():
-            outputs = lora_model.generate(
-                **inputs,
-                max_new_tokens=max_new_tokens,
-                temperature=0.4,
-                top_p=0.9,
-                do_sample=True,
-                repetition_penalty=1.3,
-                pad_token_id=self.tokenizer.eos_token_id,
-                eos_token_id=self.tokenizer.eos_token_id,  # uses the tokenizer-defined EOS consistently
-                stopping_criteria=stopping_criteria
-            )
-
-        # Slice off the input so only new tokens remain
-        generated_ids = outputs[0][inputs["input_ids"].shape[1]:]
+    def _generation_kwargs(self, max_new_tokens: int, stopping_criteria: StoppingCriteriaList = None) -> dict:
+        """ Sampling settings shared by every generate() call. """
+        if stopping_criteria is None:
+            stopping_criteria = StoppingCriteriaList([
+                KeywordStoppingCriteria(self.stop_matcher)
+            ])
+        if self._first_token_pending:
+            stopping_criteria.append(FirstTokenTimer(self._record_first_token))
+        kv_cache_kwargs = {}
+        if self.kv_cache == "int8":
+            # Halves KV memory per token, so more and longer sequences fit in a batch
+            kv_cache_kwargs = dict(cache_implementation="quantized", cache_config=dict(INT8_KV_CACHE_CONFIG))
+        return dict(
+            **kv_cache_kwargs,
+            max_new_tokens=max_new_tokens,
+            temperature=0.4,
+            top_p=0.9,
+            do_sample=True,
+            repetition_penalty=1.3,
+            pad_token_id=self.tokenizer.eos_token_id,
+            eos_token_id=self.tokenizer.eos_token_id,  # uses the tokenizer-defined EOS consistently
+            stopping_criteria=stopping_criteria
+        )
 
-        reply = self.tokenizer.decode(generated_ids, skip_special_tokens=True).strip()
-    
+    def _postprocess_reply(self, reply: str) -> str:
         print(f"{YELLOW}[INFO] Raw reply before filtering: {reply}{RESET}")
         
         reply = self.filter_output(reply)
@@ -367,23 +932,857 @@ class Phi2Chat:
         
         print(f"{GREEN}[SUCCESS] Reply ready: {reply}{RESET}")
         return reply
-    
-class KeywordStoppingCriteria(StoppingCriteria):
+
+    def chat_with_lora(
+        self,
+        hf_token: str,
+        lora_repo: str,
+        chat_history: str, # json string of [{sender, message}, ...]
+        max_new_tokens: int,
+        end_prompt: str = None,
+        participants: dict = None,
+        speculative: bool = False
+    ) -> str:
+        """
+        Generates one reply. Requests are batched together; a request that has its batch to itself
+        reuses the KV cache of the previous turn of its conversation (see _generate_single).
+        speculative=True opts into prompt-lookup decoding, which also only runs for a request alone
+        in its batch; one that shares it is generated as a plain row, so it never holds up the others.
+        """
+        print(f"{YELLOW}[INFO] chat_with_lora called{RESET}")
+
+        input_ids = self._prepare_inputs(hf_token, chat_history, end_prompt, participants)
+        if input_ids is None:
+            return "[INFO] No conversation history provided."
+
+        # A cold adapter is downloaded in this request's own thread, so neither the GPU lock
+        # nor the batching thread waits on the Hub
+        adapter_path = self._fetch_adapter(hf_token, lora_repo)
+
+        # Hand the prompt to the batching worker and wait for this request's row
+        request = GenerationRequest(hf_token, lora_repo, input_ids[0], max_new_tokens, adapter_path, speculative=speculative)
+        self._batch_queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+
+        return self._postprocess_reply(request.reply.strip())
+
+    def _generate_single(self, request):
+        """
+        Single-sequence generate() of a request that has its batch to itself. It starts from the
+        prefix_cache entry of the same model that shares the longest token prefix with the prompt,
+        which for the next turn of a conversation covers its whole previous history, so prefill only
+        runs over the new turns. If the history window slid (the start of the prompt changed) the
+        shared prefix is short and this falls back to a full prefill. The int8 KV cache cannot be
+        cropped to a prefix, so it never reuses one.
+
+        A speculative request drafts up to prompt_lookup_tokens tokens per step by matching the latest
+        n-gram against the prompt (chat history repeats itself a lot) and verifies them in one forward
+        pass. Each draft token is kept only if it equals the token sampled from the model at that
+        position, so replies follow exactly the same distribution as token-by-token sampling.
+        Returns (outputs, prompt_len) like _generate_rows. Caller holds _gpu_lock.
+        """
+        model = request.model
+        merged = model is not self.peft_model
+        input_ids = request.input_ids.unsqueeze(0)
+        prompt_len = input_ids.shape[1]
+
+        # The merged copy and the PeftModel produce different KV, so each keeps its own entries
+        # and a promotion or demotion never feeds one model's prefix to the other
+        cache_model = (request.lora_repo, merged)
+        past_key_values = None
+        if self.kv_cache == "fp16":
+            past_key_values, reused = self.prefix_cache.take(cache_model, request.input_ids)
+            if past_key_values is None:
+                past_key_values = DynamicCache()
+            print(f"{CYAN}[KV CACHE] Reusing {reused}/{prompt_len} prompt tokens for {request.lora_repo}{RESET}")
+
+        # Several tokens can be appended per step, so the keyword scan must start at the prompt end
+        keyword_stop = KeywordStoppingCriteria(self.stop_matcher, prompt_length=prompt_len)
+        stopping_criteria = StoppingCriteriaList([keyword_stop])
+        if request.streamer is not None:
+            stopping_criteria.append(RowStreamers(prompt_len, [request]))
+        generation_kwargs = self._generation_kwargs(request.max_new_tokens, stopping_criteria)
+        if request.speculative:
+            generation_kwargs["prompt_lookup_num_tokens"] = self.prompt_lookup_tokens
+            # Rejected drafts are cropped off the cache, which the int8 cache does not support
+            generation_kwargs.pop("cache_implementation", None)
+            generation_kwargs.pop("cache_config", None)
+        if past_key_values is not None:
+            generation_kwargs["past_key_values"] = past_key_values
+        extra = {} if merged else {"adapter_names": [self._adapter_name(request.lora_repo)]}
+
+        kind = "speculative" if request.speculative else "standard"
+        print(f"{YELLOW}[INFO] Generating {kind} ({'merged ' if merged else ''}{request.lora_repo})...{RESET}")
+        t = time.perf_counter()
+        with torch.no_grad(), ForwardCounter(model) as forwards:
+            outputs = model.generate(
+                input_ids=input_ids.to(self.base_model.device),
+                attention_mask=torch.ones_like(input_ids).to(self.base_model.device),
+                **extra,
+                **generation_kwargs
+            )
+        seconds, new_tokens = time.perf_counter() - t, outputs.shape[1] - prompt_len
+        self.merged_models.record_latency(merged, seconds, new_tokens)
+        self.decode_stats.record(kind, seconds, new_tokens, forwards.count)
+
+        if past_key_values is not None:
+            # The cache covers every token except the last sampled one
+            self.prefix_cache.put(cache_model, outputs[0, :past_key_values.get_seq_length()].cpu(), past_key_values)
+        return self._trim_after_stop(outputs, prompt_len, keyword_stop), prompt_len
+
+    def _trim_after_stop(self, outputs, prompt_len: int, keyword_stop):
+        """
+        An accepted draft chunk can run past a stop phrase or EOS in the middle of it;
+        cut the reply where token-by-token decoding would have stopped.
+        """
+        end = outputs.shape[1]
+        if keyword_stop.stop_lengths and keyword_stop.stop_lengths[0] is not None:
+            end = min(end, keyword_stop.stop_lengths[0])
+        eos_positions = (outputs[0, prompt_len:end] == self.tokenizer.eos_token_id).nonzero()
+        if len(eos_positions):
+            end = prompt_len + int(eos_positions[0]) + 1
+        return outputs[:, :end]
+
+    def _batch_loop(self):
+        """
+        Worker thread behind chat_with_lora and chat_with_lora_stream. Collects the requests that arrive within
+        batch_window of the first one (up to max_batch_size) and generates them together.
+        """
+        while True:
+            if self._batch_carry_over:
+                batch, self._batch_carry_over = self._batch_carry_over, []
+            else:
+                batch = [self._batch_queue.get()]
+
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._batch_queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            # More distinct LoRAs than the adapter cache holds would evict adapters mid-batch
+            adapters = []
+            for request in list(batch):
+                if request.lora_repo not in adapters:
+                    if len(adapters) >= self.loaded_loras.max_adapters:
+                        batch.remove(request)
+                        self._batch_carry_over.append(request)
+                        continue
+                    adapters.append(request.lora_repo)
+
+            try:
+                self._run_batch(batch)
+            except Exception as e:
+                print(f"{RED}[ERROR] Batched generation failed: {e}{RESET}")
+                for request in batch:
+                    if not request.done.is_set():
+                        request.finish(RuntimeError(f"Generation failed: {e}"))
+
+    def _run_batch(self, batch: list):
+        with self._gpu_lock:
+            # Resolve every request's adapter; a LoRA that fails to load only fails its own request
+            ready = []
+            self.loaded_loras.pinned = {request.lora_repo for request in batch}
+            try:
+                for request in batch:
+                    try:
+                        request.model = self.get_lora_model(request.hf_token, request.lora_repo, request.adapter_path)
+                        ready.append(request)
+                    except Exception as e:
+                        request.finish(e)
+            finally:
+                self.loaded_loras.pinned = set()
+
+            # Loading a later adapter can still push an earlier one out when the batch alone exceeds the GPU byte budget
+            evicted = [
+                r for r in ready
+                if r.model is self.peft_model and r.lora_repo not in self.loaded_loras.resident
+            ]
+            self._batch_carry_over.extend(evicted)
+            ready = [r for r in ready if r not in evicted]
+            if not ready:
+                return
+
+            # Rows of merged LoRAs run on their merged copy; all other rows share one multi-adapter generate()
+            groups = {}
+            for request in ready:
+                groups.setdefault(id(request.model), []).append(request)
+            # A request alone on its model runs as a single sequence, which can start from a cached prefix
+            # and decode speculatively; batched with others it is a plain row and does not delay them
+            results = [
+                (rows, *(self._generate_single(rows[0]) if len(rows) == 1 else self._generate_rows(rows)))
+                for rows in groups.values()
+            ]
+
+        for rows, outputs, prompt_len in results:
+            for row, request in enumerate(rows):
+                # Slice off the prompt so only this row's new tokens remain
+                generated_ids = outputs[row, prompt_len:prompt_len + request.max_new_tokens]
+                request.reply = self.tokenizer.decode(generated_ids, skip_special_tokens=True)
+                request.finish()
+
+    def _generate_rows(self, rows: list):
+        """ One generate() over several requests that share a model. Returns (outputs, prompt_len). Caller holds _gpu_lock. """
+        model = rows[0].model
+        merged = model is not self.peft_model
+
+        # Left-pad so every row ends at the same position and new tokens line up
+        pad_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
+        prompt_len = max(len(r.input_ids) for r in rows)
+        input_ids = torch.full((len(rows), prompt_len), pad_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(rows), prompt_len), dtype=torch.long)
+        for row, request in enumerate(rows):
+            input_ids[row, prompt_len - len(request.input_ids):] = request.input_ids
+            attention_mask[row, prompt_len - len(request.input_ids):] = 1
+
+        stopping_criteria = StoppingCriteriaList([
+            KeywordStoppingCriteria(self.stop_matcher),
+            MaxNewTokensPerRowCriteria(prompt_len, [r.max_new_tokens for r in rows]),
+            RowStreamers(prompt_len, rows)
+        ])
+        extra = {} if merged else {"adapter_names": [self._adapter_name(r.lora_repo) for r in rows]}
+
+        print(f"{YELLOW}[INFO] Generating batch of {len(rows)} ({'merged ' + rows[0].lora_repo if merged else str(len(set(r.lora_repo for r in rows))) + ' adapters'})...{RESET}")
+        generation_kwargs = self._generation_kwargs(max(r.max_new_tokens for r in rows), stopping_criteria)
+        t = time.perf_counter()
+        with torch.no_grad(), ForwardCounter(model) as forwards:
+            outputs = model.generate(
+                input_ids=input_ids.to(self.base_model.device),
+                attention_mask=attention_mask.to(self.base_model.device),
+                **extra,
+                **generation_kwargs
+            )
+        seconds = time.perf_counter() - t
+        self.merged_models.record_latency(merged, seconds, outputs.shape[1] - prompt_len)
+        # generate() fills rows that already stopped with its own pad_token_id, not the tokenizer's
+        generated = int((outputs[:, prompt_len:] != generation_kwargs["pad_token_id"]).sum())
+        self.decode_stats.record("batched", seconds, generated, forwards.count)
+        return outputs, prompt_len
+
+    def chat_with_lora_stream(
+        self,
+        hf_token: str,
+        lora_repo: str,
+        chat_history: str, # json string of [{sender, message}, ...]
+        max_new_tokens: int,
+        end_prompt: str = None,
+        participants: dict = None
+    ):
+        """
+        Streaming variant of chat_with_lora.
+        Yields pieces of the reply as soon as they form complete, filtered sentences,
+        so the first piece arrives after the first sentence instead of the whole reply.
+        Concatenating every yielded piece gives the same text chat_with_lora returns.
+        """
+        print(f"{YELLOW}[INFO] chat_with_lora_stream called{RESET}")
+
+        input_ids = self._prepare_inputs(hf_token, chat_history, end_prompt, participants)
+        if input_ids is None:
+            yield "[INFO] No conversation history provided."
+            return
+
+        # A streamed request is one more row of the shared batches; RowStreamers hands its new tokens
+        # to this streamer after every decoding step
+        adapter_path = self._fetch_adapter(hf_token, lora_repo)
+        streamer = TextIteratorStreamer(self.tokenizer, skip_special_tokens=True)
+        request = GenerationRequest(hf_token, lora_repo, input_ids[0], max_new_tokens, adapter_path, streamer=streamer)
+        self._batch_queue.put(request)
+        print(f"{YELLOW}[INFO] Streaming response...{RESET}")
+
+        reply_filter = IncrementalReplyFilter()
+        for new_text in streamer:
+            piece = reply_filter.push(new_text)
+            if piece:
+                yield piece
+
+        request.done.wait()
+        if request.error is not None:
+            print(f"{RED}[ERROR] Streaming generation failed: {request.error}{RESET}")
+            raise RuntimeError(f"Generation failed: {request.error}") from request.error
+
+        piece = reply_filter.finish()
+        if piece:
+            yield piece
+
+        print(f"{GREEN}[SUCCESS] Streamed reply ready: {reply_filter.emitted}{RESET}")
+
+class PrefixKVCache:
+    """
+    generate() KV caches with the token ids they cover, evicted LRU under an entry count and a GPU
+    byte budget. take() hands out the entry of the same model that shares the longest token prefix
+    with the new prompt, cropped to that prefix, and put() stores the grown cache back after the call.
+    The next turn of a conversation finds its previous turn this way, so clients need not send a
+    conversation id. A match shorter than min_reuse_tokens (a common opener, not a shared history)
+    leaves the entry to the conversation it belongs to.
+    model identifies the weights that produced the KV: (lora_repo, whether it ran on the merged copy).
+    """
+    def __init__(self, max_entries: int, max_bytes: int, min_reuse_tokens: int = 32):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.min_reuse_tokens = min_reuse_tokens
+        self.entries = OrderedDict()  # entry id -> (model, token ids, cache, nbytes)
+        self._next_id = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reused_tokens = 0
+        self.prompt_tokens = 0
+
+    def take(self, model: tuple, input_ids: torch.LongTensor):
+        """ Returns (cache cropped to the reusable prefix, prefix length) or (None, 0). input_ids is 1-D, on the CPU. """
+        self.prompt_tokens += len(input_ids)
+        best, common = None, 0
+        for entry_id, (entry_model, cached_ids, _, _) in self.entries.items():
+            if entry_model != model:
+                continue
+            n = min(len(cached_ids), len(input_ids))
+            mismatches = (cached_ids[:n] != input_ids[:n]).nonzero()
+            length = int(mismatches[0]) if len(mismatches) else n
+            if length > common:
+                best, common = entry_id, length
+
+        # generate() needs at least one uncached token to produce the next logits
+        reuse = min(common, len(input_ids) - 1)
+        if best is None or reuse < max(self.min_reuse_tokens, 1):
+            self.misses += 1
+            return None, 0
+
+        _, _, cache, _ = self.entries.pop(best)
+        if cache.get_seq_length() > reuse:
+            cache.crop(reuse - cache.get_seq_length())
+        self.hits += 1
+        self.reused_tokens += reuse
+        return cache, reuse
+
+    def put(self, model: tuple, token_ids: torch.LongTensor, cache):
+        self.entries[self._next_id] = (model, token_ids, cache, self._cache_nbytes(cache))
+        self._next_id += 1
+        while len(self.entries) > 1 and (len(self.entries) > self.max_entries or self.total_bytes() > self.max_bytes):
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def total_bytes(self) -> int:
+        return sum(nbytes for _, _, _, nbytes in self.entries.values())
+
+    def clear(self):
+        self.entries.clear()
+
+    @staticmethod
+    def _cache_nbytes(cache) -> int:
+        if hasattr(cache, "layers"):
+            tensors = [t for layer in cache.layers for t in (layer.keys, layer.values) if t is not None]
+        else:
+            tensors = list(cache.key_cache) + list(cache.value_cache)
+        return sum(t.numel() * t.element_size() for t in tensors)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "gpu_bytes": self.total_bytes(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "reused_tokens": self.reused_tokens,
+            "prompt_tokens": self.prompt_tokens,
+        }
+
+class GenerationRequest:
+    """ One chat_with_lora or chat_with_lora_stream call waiting in the batching queue. """
+    def __init__(
+        self, hf_token: str, lora_repo: str, input_ids: torch.LongTensor, max_new_tokens: int, adapter_path: str = None,
+        streamer: TextIteratorStreamer = None, speculative: bool = False
+    ):
+        self.hf_token = hf_token
+        self.lora_repo = lora_repo
+        self.input_ids = input_ids
+        self.max_new_tokens = max_new_tokens
+        self.adapter_path = adapter_path  # downloaded by the request thread if the adapter was cold
+        self.model = None  # set by _run_batch: the shared PeftModel or the LoRA's merged copy
+        self.done = Event()
+        self.streamer = streamer  # set for chat_with_lora_stream, fed by RowStreamers
+        self.speculative = speculative  # prompt-lookup decoding when the request is alone on its model
+        self.reply = None
+        self.error = None
+
+    def finish(self, error: Exception = None):
+        """ Records the outcome, ends the request's stream and wakes the waiting request thread. """
+        if error is not None:
+            self.error = error
+        if self.streamer is not None:
+            self.streamer.end()
+        self.done.set()
+
+class MergedModelCache:
+    """
+    Merged copies (base model with one LoRA folded into its weights) of the hottest adapters.
+
+    Requests are counted per LoRA over window_seconds. A LoRA at or above promote_rpm is merged
+    if the copies stay under max_bytes, possibly by replacing a merged LoRA that is now colder;
+    a merged LoRA below demote_rpm (lower than promote_rpm, so they don't flap) is dropped.
+    Also keeps per-token generate() latency of merged vs unmerged calls.
+    """
+    def __init__(self, max_bytes: int, promote_rpm: float, demote_rpm: float, window_seconds: float = 60):
+        self.max_bytes = max_bytes
+        self.promote_rpm = promote_rpm
+        self.demote_rpm = demote_rpm
+        self.window_seconds = window_seconds
+        self.requests = {}  # key -> deque of request times
+        self.models = {}    # key -> (merged model, nbytes)
+        self.pending = None  # key being merged in the background
+        self.promotions = 0
+        self.demotions = 0
+        self.latency = {"merged": [0.0, 0], "unmerged": [0.0, 0]}  # kind -> [seconds, generated tokens]
+
+    def record(self, key):
+        now = time.monotonic()
+        times = self.requests.setdefault(key, deque())
+        times.append(now)
+        self._trim(times, now)
+
+    def rate(self, key) -> float:
+        """ Requests per minute over the window. """
+        times = self.requests.get(key)
+        if not times:
+            return 0.0
+        self._trim(times, time.monotonic())
+        return len(times) * 60 / self.window_seconds
+
+    def _trim(self, times: deque, now: float):
+        while times and times[0] <= now - self.window_seconds:
+            times.popleft()
+
+    def get(self, key):
+        entry = self.models.get(key)
+        return entry[0] if entry is not None else None
+
+    def bytes(self) -> int:
+        return sum(nbytes for _, nbytes in self.models.values())
+
+    def plan(self, key, model_nbytes: int) -> tuple[list, bool]:
+        """ Returns (merged keys to drop, whether to start merging key). """
+        for idle in [k for k, times in self.requests.items() if not times and k not in self.models]:
+            del self.requests[idle]
+
+        demote = [k for k in self.models if self.rate(k) < self.demote_rpm]
+        rate = self.rate(key)
+        if key in self.models or self.pending is not None or rate < self.promote_rpm or model_nbytes > self.max_bytes:
+            return demote, False
+
+        free = self.max_bytes - self.bytes() + sum(self.models[k][1] for k in demote)
+        if free < model_nbytes:
+            remaining = [k for k in self.models if k not in demote]
+            coldest = min(remaining, key=self.rate) if remaining else None
+            if coldest is None or self.rate(coldest) >= rate or free + self.models[coldest][1] < model_nbytes:
+                return demote, False
+            demote.append(coldest)
+        return demote, True
+
+    def add(self, key, model, nbytes: int):
+        self.models[key] = (model, nbytes)
+        self.promotions += 1
+
+    def remove(self, key):
+        if self.models.pop(key, None) is not None:
+            self.demotions += 1
+
+    def clear(self):
+        self.models.clear()
+        self.requests.clear()
+
+    def record_latency(self, merged: bool, seconds: float, new_tokens: int):
+        if new_tokens > 0:
+            entry = self.latency["merged" if merged else "unmerged"]
+            entry[0] += seconds
+            entry[1] += new_tokens
+
+    def stats(self) -> dict:
+        return {
+            "merged": {k: {"req_per_min": self.rate(k), "bytes": nbytes} for k, (_, nbytes) in self.models.items()},
+            "pending": self.pending,
+            "bytes": self.bytes(),
+            "max_bytes": self.max_bytes,
+            "promotions": self.promotions,
+            "demotions": self.demotions,
+            "ms_per_token": {
+                kind: 1000 * seconds / tokens if tokens else None
+                for kind, (seconds, tokens) in self.latency.items()
+            },
+        }
+
+class AdapterCache:
+    """
+    Two-tier LRU cache for LoRA adapters.
+
+    The GPU tier holds ready-to-use adapters, bounded by max_adapters and max_gpu_bytes.
+    Adapters pushed out of it go through offload_fn to a warm CPU tier (bounded by
+    max_cpu_bytes); a hit there is brought back with restore_fn instead of re-downloading.
+    Anything pushed out of the warm tier is gone and has to be loaded from the Hub again.
+    Adapters in pinned (those of the batch being prepared) are only pushed out when nothing else is left.
+    """
+    def __init__(self, max_adapters: int, max_gpu_bytes: int, max_cpu_bytes: int, offload_fn, restore_fn, drop_fn):
+        self.max_adapters = max_adapters
+        self.max_gpu_bytes = max_gpu_bytes
+        self.max_cpu_bytes = max_cpu_bytes
+        self.offload_fn = offload_fn
+        self.restore_fn = restore_fn
+        self.drop_fn = drop_fn
+        self.resident = OrderedDict()  # key -> (value, nbytes), least recently used first
+        self.warm = OrderedDict()      # key -> (offloaded value, nbytes)
+        self.pinned = set()
+        self.hits = 0
+        self.warm_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.drops = 0
+
+    def __contains__(self, key) -> bool:
+        return key in self.resident or key in self.warm
+
+    def get(self, key):
+        if key in self.resident:
+            self.resident.move_to_end(key)
+            self.hits += 1
+            return self.resident[key][0]
+
+        if key in self.warm:
+            warm_value, nbytes = self.warm.pop(key)
+            self.warm_hits += 1
+            value = self.restore_fn(key, warm_value)
+            self.put(key, value, nbytes)
+            return value
+
+        self.misses += 1
+        return None
+
+    def put(self, key, value, nbytes: int):
+        self.resident[key] = (value, nbytes)
+        self.resident.move_to_end(key)
+        self._enforce_budget(protect=key)
+
+    def clear(self):
+        self.resident.clear()
+        self.warm.clear()
+
+    def gpu_bytes(self) -> int:
+        return sum(nbytes for _, nbytes in self.resident.values())
+
+    def cpu_bytes(self) -> int:
+        return sum(nbytes for _, nbytes in self.warm.values())
+
+    def _enforce_budget(self, protect):
+        while len(self.resident) > 1 and (
+            len(self.resident) > self.max_adapters or self.gpu_bytes() > self.max_gpu_bytes
+        ):
+            # Least recently used first, sparing the pinned adapters while others can go
+            candidates = [k for k in self.resident if k != protect]
+            key = next((k for k in candidates if k not in self.pinned), candidates[0])
+            value, nbytes = self.resident.pop(key)
+            self.evictions += 1
+
+            if nbytes <= self.max_cpu_bytes:
+                self.warm[key] = (self.offload_fn(key, value), nbytes)
+            else:
+                self.drop_fn(key, value)
+                self.drops += 1
+
+        while self.warm and self.cpu_bytes() > self.max_cpu_bytes:
+            self.warm.popitem(last=False)
+            self.drops += 1
+
+    def stats(self) -> dict:
+        return {
+            "resident": list(self.resident.keys()),
+            "warm": list(self.warm.keys()),
+            "gpu_bytes": self.gpu_bytes(),
+            "cpu_bytes": self.cpu_bytes(),
+            "hits": self.hits,
+            "warm_hits": self.warm_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "drops": self.drops,
+        }
+
+# Tags filter_output strips, in the order it strips them: (openers, closer, regex flags).
+# A tag runs from an opener to the first closer after it on the same line ('.' does not match newlines).
+REPLY_TAGS = [
+    (("<@", "<:"), ">", 0),                               # <@…> or similar junk
+    (("<|",), "|>", 0),                                   # ChatML-style <|…|> tokens
+    (("<This message was edited",), ">", re.IGNORECASE),  # "<This message was edited by…>" artifacts
+]
+REPLY_TAG_PATTERNS = [
+    re.compile("(?:" + "|".join(map(re.escape, openers)) + ").*?" + re.escape(closer), flags)
+    for openers, closer, flags in REPLY_TAGS
+]
+
+def filter_output(text: str) -> str:
+    """ Removes every REPLY_TAGS tag and collapses whitespace/newlines to single spaces. """
+    for pattern in REPLY_TAG_PATTERNS:
+        text = pattern.sub("", text)
+    return collapse_whitespace(text)
+
+def collapse_whitespace(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip()
+
+def truncate_to_last_sentence(text: str) -> str:
+    """ Truncates text to the last full sentence, which ends with '.', '!', or '?'. """
+    sentence_endings = [m.end() for m in re.finditer(r'[.!?]', text)]
+    if sentence_endings:
+        return text[:sentence_endings[-1]].strip()
+    return text.strip()
+
+def settled_length(text: str, openers: tuple, closer: str, flags: int = 0) -> int:
+    """
+    Length of the prefix of text in which one REPLY_TAGS pass is decided, whatever text follows.
+    Scans like re.sub: a complete tag is skipped whole and an opener followed by a newline before
+    any closer never matches; the scan stops at the first opener (or start of one) still waiting for its closer.
+    """
+    position = 0
+    while True:
+        start = text.find("<", position)
+        if start == -1:
+            return len(text)
+        rest = text[start:]
+        opener = next((o for o in openers if re.match(re.escape(o), rest, flags)), None)
+        if opener is None:
+            if any(len(rest) < len(o) and re.fullmatch(re.escape(o[:len(rest)]), rest, flags) for o in openers):
+                return start
+            position = start + 1
+            continue
+
+        body = start + len(opener)
+        end, newline = text.find(closer, body), text.find("\n", body)
+        if end != -1 and (newline == -1 or end < newline):
+            position = end + len(closer)
+        elif newline != -1:
+            position = start + 1
+        else:
+            return start
+
+class IncrementalReplyFilter:
+    """
+    Applies filter_output + truncate_to_last_sentence to a reply that arrives piece by piece.
+
+    Each tag pass only runs over the part of its input where it is settled (no opener is still waiting
+    for its own closer), so its output is a prefix of what it gives on the whole reply, and the next pass
+    sees that prefix the same way. Of the result only text up to the last complete sentence is released,
+    so released text never has to be taken back. finish() releases whatever the one-shot filters add on
+    the full reply; all pieces together equal truncate_to_last_sentence(filter_output(reply)).
+    """
+    def __init__(self):
+        self.raw_text = ""
+        self.emitted = ""
+
+    def push(self, new_text: str) -> str:
+        self.raw_text += new_text
+
+        stable_text = self.raw_text
+        for (openers, closer, flags), pattern in zip(REPLY_TAGS, REPLY_TAG_PATTERNS):
+            stable_text = pattern.sub("", stable_text[:settled_length(stable_text, openers, closer, flags)])
+
+        # Only release text that ends on a sentence boundary
+        filtered = collapse_whitespace(stable_text)
+        if not re.search(r"[.!?]", filtered):
+            return ""
+        return self._release(truncate_to_last_sentence(filtered))
+
+    def finish(self) -> str:
+        return self._release(truncate_to_last_sentence(filter_output(self.raw_text.strip())))
+
+    def _release(self, text: str) -> str:
+        if len(text) <= len(self.emitted) or not text.startswith(self.emitted):
+            return ""
+        piece = text[len(self.emitted):]
+        self.emitted = text
+        return piece
+
+class KeywordMatcher:
+    """
+    Aho-Corasick automaton over the lowercase stop phrases.
+
+    Feeding text one token at a time finds every phrase, including ones split across
+    tokens, in time proportional to the new text only. Built once per container; the
+    per-row state is just an int owned by each KeywordStoppingCriteria.
+    """
     def __init__(self, tokenizer, keywords):
         self.tokenizer = tokenizer
-        self.keywords = [kw.lower() for kw in keywords]
-        self.generated_text = ""
+        self.goto = [{}]   # state -> {char: next state}
+        self.fail = [0]
+        self.output = [None]  # state -> shortest keyword ending here, if any
+        self.token_text = {}  # token id -> lowercase decoded text, filled lazily
+
+        for kw in keywords:
+            state = 0
+            for ch in kw.lower():
+                if ch not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(None)
+                    self.goto[state][ch] = len(self.goto) - 1
+                state = self.goto[state][ch]
+            self.output[state] = kw.lower()
+
+        # Breadth-first pass to set failure links and inherit outputs from suffixes
+        pending = list(self.goto[0].values())
+        while pending:
+            state = pending.pop(0)
+            for ch, child in self.goto[state].items():
+                fallback = self.fail[state]
+                while fallback and ch not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(ch, 0)
+                if self.output[child] is None:
+                    self.output[child] = self.output[self.fail[child]]
+                pending.append(child)
+
+    def text_for(self, token_id: int) -> str:
+        text = self.token_text.get(token_id)
+        if text is None:
+            text = self.tokenizer.decode([token_id], skip_special_tokens=True).lower()
+            self.token_text[token_id] = text
+        return text
+
+    def advance(self, state: int, text: str) -> tuple[int, str | None]:
+        """ Feeds text from the given state. Returns (new state, matched keyword or None). """
+        for ch in text:
+            while state and ch not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(ch, 0)
+            if self.output[state] is not None:
+                return state, self.output[state]
+        return state, None
+
+class KeywordStoppingCriteria(StoppingCriteria):
+    """
+    Per-row stop on any KeywordMatcher phrase; rows that already stopped are not scanned again.
+    Scans every token added since the previous call (speculative decoding adds several per step);
+    pass prompt_length when the first call can already see more than one new token.
+    stop_lengths[row] is the sequence length that ends with the token completing the phrase.
+    """
+    def __init__(self, matcher: KeywordMatcher, prompt_length: int = None):
+        self.matcher = matcher
+        self.seen = prompt_length
+        self.states = None
+        self.done = None
+        self.stop_lengths = None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs):
+        if self.states is None:
+            self.states = [0] * input_ids.shape[0]
+            self.done = [False] * input_ids.shape[0]
+            self.stop_lengths = [None] * input_ids.shape[0]
+            if self.seen is None:
+                self.seen = input_ids.shape[1] - 1
+
+        # One device->host copy per step for the whole batch
+        new_token_ids = input_ids[:, self.seen:].tolist()
+        for row, token_ids in enumerate(new_token_ids):
+            if self.done[row]:
+                continue
+            for offset, token_id in enumerate(token_ids):
+                self.states[row], hit = self.matcher.advance(self.states[row], self.matcher.text_for(token_id))
+                if hit is not None:
+                    print(f"[STOPPING] Row {row} triggered on keyword: {hit}")
+                    self.done[row] = True
+                    self.stop_lengths[row] = self.seen + offset + 1
+                    break
+        self.seen = input_ids.shape[1]
+
+        return torch.tensor(self.done, dtype=torch.bool, device=input_ids.device)
+
+class ForwardCounter:
+    """ Counts forward passes of the underlying causal LM during a generate() call (one per decoding step). """
+    def __init__(self, model):
+        self.model = model.get_base_model() if isinstance(model, PeftModel) else model
+        self.count = 0
+        self.handle = None
+
+    def __enter__(self):
+        self.handle = self.model.register_forward_pre_hook(self._hook)
+        return self
+
+    def _hook(self, module, args):
+        self.count += 1
+
+    def __exit__(self, *exc):
+        self.handle.remove()
+
+class DecodeStats:
+    """
+    generate() totals per kind: standard (a batch of one row) and speculative single-sequence calls, and batched calls.
+    tokens_per_step is new tokens per forward pass (prefill included). A single-sequence step yields
+    one sampled token, so the rest are accepted drafts; for batches it is the effective batch size.
+    """
+    def __init__(self):
+        self.totals = {
+            kind: {"requests": 0, "tokens": 0, "forwards": 0, "seconds": 0.0}
+            for kind in ("standard", "speculative", "batched")
+        }
+
+    def record(self, kind: str, seconds: float, new_tokens: int, forwards: int):
+        entry = self.totals[kind]
+        entry["requests"] += 1
+        entry["tokens"] += new_tokens
+        entry["forwards"] += forwards
+        entry["seconds"] += seconds
+
+    def stats(self) -> dict:
+        result = {}
+        for kind, entry in self.totals.items():
+            tokens_per_step = entry["tokens"] / entry["forwards"] if entry["forwards"] else None
+            result[kind] = {
+                "requests": entry["requests"],
+                "tokens_per_step": tokens_per_step,
+                "accepted_drafts_per_step": tokens_per_step - 1 if tokens_per_step is not None and kind != "batched" else None,
+                "ms_per_token": 1000 * entry["seconds"] / entry["tokens"] if entry["tokens"] else None,
+                "tokens_per_s": entry["tokens"] / entry["seconds"] if entry["seconds"] else None,
+            }
+        standard, speculative = result["standard"]["ms_per_token"], result["speculative"]["ms_per_token"]
+        result["speedup"] = standard / speculative if standard and speculative else None
+        return result
+
+class FirstTokenTimer(StoppingCriteria):
+    """ Never stops generation; calls on_first_token once, right after the first new token. """
+    def __init__(self, on_first_token):
+        self.on_first_token = on_first_token
+        self.fired = False
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs):
+        if not self.fired:
+            self.fired = True
+            self.on_first_token()
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+class MaxNewTokensPerRowCriteria(StoppingCriteria):
+    """ Stops each batch row once it has produced its own max_new_tokens. """
+    def __init__(self, prompt_length: int, max_new_tokens: list[int]):
+        self.prompt_length = prompt_length
+        self.max_new_tokens = torch.tensor(max_new_tokens)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs):
+        generated = input_ids.shape[1] - self.prompt_length
+        return (self.max_new_tokens <= generated).to(input_ids.device)
+
+class RowStreamers(StoppingCriteria):
+    """
+    Never stops generation; after each decoding step puts the new tokens of every streamed row of a batch
+    into that row's own streamer (a TextIteratorStreamer only takes one sequence), up to the row's max_new_tokens.
+    """
+    def __init__(self, prompt_length: int, rows: list):
+        self.seen = prompt_length
+        self.streams = [
+            (row, request.streamer, prompt_length + request.max_new_tokens)
+            for row, request in enumerate(rows) if request.streamer is not None
+        ]
 
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs):
-        # Decode only the newly generated token
-        new_token_id = input_ids[0, -1].item()
-        new_text = self.tokenizer.decode([new_token_id], skip_special_tokens=True)
-        self.generated_text += new_text.lower()
-
-        # If any keyword shows up, stop
-        for kw in self.keywords:
-            if kw in self.generated_text:
-                print(f"[STOPPING] Triggered on keyword: {kw}")
-                return True
-
-        return False
+        for row, streamer, end in self.streams:
+            if self.seen < end:
+                streamer.put(input_ids[row, self.seen:min(input_ids.shape[1], end)].cpu())
+        self.seen = input_ids.shape[1]
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
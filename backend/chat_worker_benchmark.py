@@ -0,0 +1,312 @@
+# chat_worker_benchmark.py - throughput of the chat worker's generation paths, with the real ChatWorker run in-process
+#
+#   python -m backend.chat_worker_benchmark batching                      # tokens/s at 1, 8 and 32 concurrent users
+#   python -m backend.chat_worker_benchmark batching --users 1 8 32 --max-new-tokens 64
+#   python -m backend.chat_worker_benchmark batching --config phi-2 --pretrained   # real phi-2 on a GPU
+#   python -m backend.chat_worker_benchmark merged --config phi-2                  # ms/token, PeftModel vs merged copy
+#   python -m backend.chat_worker_benchmark speculative --pretrained               # ms/token, prompt lookup off vs on
+#   python -m backend.chat_worker_benchmark prefix --config phi-2                  # time to first token, prefix KV reuse off vs on
+#
+# start() warm-starts from a snapshot directory written here: random weights of the --config (phi-2 by default on
+# CUDA, a tiny Phi on CPU; --layers cuts the depth) or microsoft/phi-2 itself with --pretrained. The LoRAs are random
+# adapters shaped like the trained ones (r=16 on every attention/MLP projection, embed_tokens and lm_head saved),
+# loaded from local directories, so nothing is downloaded unless --pretrained is given.
+#
+# batching: every user sends --rounds chats one after another, spread over --adapters LoRAs. The same worker serves
+# them one generate() per request (MAX_BATCH_SIZE=1, the path before cross-request batching) and batched.
+# merged: one user sends --rounds chats to one LoRA through the PeftModel, then the LoRA is merged (the worker's own
+# _promote_merged) and the same chats run on the merged copy. Timed from the worker's merged_models latency.
+# speculative: one user sends the same --rounds chats with speculative=False (one row per batch) and True, timed from
+# the worker's decode_stats. A speculative chat only decodes speculatively when it has its batch to itself, which a
+# single user always does; under concurrent traffic it is batched as a plain row. Drafts are only accepted when the model repeats the history, so random weights say
+# nothing about acceptance: the 1.5-2x target can only be checked with --pretrained and real adapters.
+# prefix: one conversation grows by two turns per chat for --rounds chats, each generating a single token, with every
+# prompt prefilled in full and then starting from the previous turn's KV cache. The other modes never reuse a prefix.
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from peft import LoraConfig, get_peft_model
+from transformers import AutoModelForCausalLM, AutoTokenizer, PhiConfig, PreTrainedTokenizerFast
+
+from backend import chat_with_lora
+
+PHI2_CONFIG = dict(
+    vocab_size=51200, hidden_size=2560, intermediate_size=10240, num_hidden_layers=32, num_attention_heads=32,
+    partial_rotary_factor=0.4, max_position_embeddings=2048, layer_norm_eps=1e-5, tie_word_embeddings=False
+)
+TINY_CONFIG = dict(
+    vocab_size=51200, hidden_size=256, intermediate_size=1024, num_hidden_layers=4, num_attention_heads=8,
+    partial_rotary_factor=0.4, max_position_embeddings=2048, layer_norm_eps=1e-5, tie_word_embeddings=False
+)
+# Same shape as lora_training_config_phi2.yaml, with transformers' Phi module names
+ADAPTER_CONFIG = dict(
+    r=16, lora_alpha=32, lora_dropout=0.05, target_modules=["q_proj", "k_proj", "v_proj", "dense", "fc1", "fc2"],
+    modules_to_save=["embed_tokens", "lm_head"], init_lora_weights=False
+)
+
+WORDS = [
+    "hey", "are", "you", "coming", "tonight", "lol", "ok", "see", "you", "at", "8", "did", "the", "game", "yesterday",
+    "no", "i", "missed", "it", "work", "was", "crazy", "send", "me", "the", "notes", "sure", "give", "a", "sec",
+    "haha", "yeah", "that", "sounds", "good", "what", "time", "tomorrow", "maybe", "later", "dinner", "?", "!", ".",
+]
+
+def sample_history(rng: random.Random, turns: int) -> list[dict]:
+    return [
+        {"sender": "You" if i % 2 == 0 else "Assistant", "message": " ".join(rng.choice(WORDS) for _ in range(rng.randrange(3, 16)))}
+        for i in range(turns)
+    ]
+
+def load_tokenizer(pretrained: bool):
+    """ phi-2's tokenizer; without Hub access a byte-level BPE trained on WORDS (phi-2's is byte-level BPE too). """
+    try:
+        return AutoTokenizer.from_pretrained(chat_with_lora.BASE_MODEL_ID)
+    except OSError:
+        if pretrained:
+            raise
+        print("⚠️ phi-2 tokenizer unavailable, training a small byte-level BPE instead", file=sys.stderr)
+        return train_tokenizer()
+
+def train_tokenizer():
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    rng = random.Random(0)
+    texts = [" ".join(turn["message"] for turn in sample_history(rng, 20)) for _ in range(200)]
+    tokenizer.train_from_iterator(texts, trainers.BpeTrainer(
+        vocab_size=2000, special_tokens=["<|endoftext|>"], initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    ))
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token="<|endoftext|>", eos_token="<|endoftext|>")
+
+def write_snapshot(directory: str, args, tokenizer=None, vocab_size: int = None) -> str:
+    """
+    Writes a warm-start snapshot (weights, tokenizer, marker) the way ChatWorker._save_snapshot does.
+    vocab_size overrides the config's, e.g. to fit a trained tokenizer so every sampled id decodes to text.
+    """
+    snapshot_dir = os.path.join(directory, "snapshot")
+    tokenizer = tokenizer or load_tokenizer(args.pretrained)
+    if args.pretrained:
+        model = AutoModelForCausalLM.from_pretrained(chat_with_lora.BASE_MODEL_ID, torch_dtype=torch.float16)
+    else:
+        config = dict(PHI2_CONFIG if args.config == "phi-2" else TINY_CONFIG)
+        if args.layers:
+            config["num_hidden_layers"] = args.layers
+        if vocab_size:
+            config["vocab_size"] = vocab_size
+        torch.manual_seed(0)
+        model = AutoModelForCausalLM.from_config(PhiConfig(**config), torch_dtype=torch.float16)
+    tokenizer.save_pretrained(snapshot_dir)
+    model.save_pretrained(snapshot_dir, safe_serialization=True)
+    with open(os.path.join(snapshot_dir, chat_with_lora.SNAPSHOT_MARKER), "w") as f:
+        json.dump({"format": chat_with_lora.SNAPSHOT_FORMAT, "base_model": chat_with_lora.BASE_MODEL_ID}, f)
+    return snapshot_dir
+
+def write_adapters(directory: str, snapshot_dir: str, count: int) -> dict[str, str]:
+    """ Random LoRAs saved as adapter directories. Returns lora_repo -> path. """
+    base = AutoModelForCausalLM.from_pretrained(snapshot_dir, torch_dtype=torch.float32)
+    model = get_peft_model(base, LoraConfig(**ADAPTER_CONFIG), adapter_name="adapter_0")
+    for i in range(1, count):
+        model.add_adapter(f"adapter_{i}", LoraConfig(**ADAPTER_CONFIG))
+    paths = {}
+    for i in range(count):
+        path = os.path.join(directory, f"adapter_{i}")
+        model.save_pretrained(path, selected_adapters=[f"adapter_{i}"])
+        # save_pretrained puts non-default adapters in a subdirectory named after them
+        nested = os.path.join(path, f"adapter_{i}")
+        paths[f"benchmark/lora-{i}-model"] = nested if os.path.isdir(nested) else path
+    del model, base
+    return paths
+
+def start_worker(args, directory: str, env: dict):
+    """ The real ChatWorker, outside Modal: start() loads the snapshot, then every adapter is made resident. """
+    snapshot_dir = write_snapshot(directory, args)
+    adapter_paths = write_adapters(directory, snapshot_dir, args.adapters)
+
+    os.environ.update({"LORA_CACHE_MAX_ADAPTERS": str(max(16, args.adapters)), **env})
+    worker = chat_with_lora.ChatWorker(
+        snapshot_dir=snapshot_dir, adapter_cache_dir=os.path.join(directory, "adapters"), device=args.device
+    )
+    worker.start()
+    with worker._gpu_lock:
+        for lora_repo, path in adapter_paths.items():
+            worker._activate_lora(None, lora_repo, path)
+    return worker, list(adapter_paths)
+
+def run_users(worker, adapters: list[str], users: int, rounds: int, args, **chat_kwargs) -> tuple[float, list[str]]:
+    """ users threads, each sending rounds chats back to back. Returns (wall seconds, replies). """
+    def user(index: int) -> list[str]:
+        rng = random.Random(index)
+        replies = []
+        for _ in range(rounds):
+            replies.append(worker.chat_with_lora(
+                hf_token=None,
+                lora_repo=adapters[index % len(adapters)],
+                chat_history=json.dumps(sample_history(rng, args.turns)),
+                max_new_tokens=args.max_new_tokens,
+                **chat_kwargs
+            ))
+        return replies
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as pool:
+        replies = [reply for replies in pool.map(user, range(users)) for reply in replies]
+    return time.perf_counter() - started, replies
+
+def benchmark_batching(worker, adapters: list[str], args) -> dict:
+    """ Generated tokens per second, one generate() per request vs cross-request batches, per number of users. """
+    results = {}
+    run_users(worker, adapters, 1, 1, args)  # warm-up
+    for users in args.users:
+        for mode, max_batch_size in (("one_at_a_time", 1), ("batched", args.max_batch_size)):
+            worker.max_batch_size = max_batch_size
+            # Batches of one row are counted as standard decoding
+            before = batched_tokens(worker)
+            wall, replies = run_users(worker, adapters, users, args.rounds, args)
+            tokens = batched_tokens(worker) - before
+            results.setdefault(users, {})[mode] = {"requests": len(replies), "tokens": tokens, "tokens_per_s": tokens / wall}
+        one, batched = results[users]["one_at_a_time"]["tokens_per_s"], results[users]["batched"]["tokens_per_s"]
+        results[users]["speedup"] = batched / one
+    return results
+
+def batched_tokens(worker) -> int:
+    return sum(worker.decode_stats.totals[kind]["tokens"] for kind in ("standard", "batched"))
+
+def report_batching(results: dict):
+    for users, result in results.items():
+        one, batched = result["one_at_a_time"]["tokens_per_s"], result["batched"]["tokens_per_s"]
+        print(f"👥 {users:3d} users: one at a time {one:8.1f} tok/s, batched {batched:8.1f} tok/s ({result['speedup']:.2f}x)")
+
+def benchmark_merged(worker, adapters: list[str], args) -> dict:
+    """ ms per generated token of one LoRA's chats through the PeftModel, then through its merged copy. """
+    lora_repo = adapters[0]
+    worker.max_batch_size = 1
+    results = {}
+    for kind in ("unmerged", "merged"):
+        if kind == "merged":
+            worker._promote_merged(None, lora_repo)
+            if worker.merged_models.get(lora_repo) is None:
+                raise RuntimeError(f"merging {lora_repo} failed, rerun with --verbose")
+        totals = worker.merged_models.latency[kind]
+        run_users(worker, [lora_repo], 1, 1, args)  # warm-up
+        seconds, tokens = totals
+        run_users(worker, [lora_repo], 1, args.rounds, args)
+        seconds, tokens = totals[0] - seconds, totals[1] - tokens
+        results[kind] = {"tokens": tokens, "ms_per_token": 1000 * seconds / tokens}
+    results["speedup"] = results["unmerged"]["ms_per_token"] / results["merged"]["ms_per_token"]
+    return results
+
+def report_merged(results: dict):
+    for kind in ("unmerged", "merged"):
+        print(f"🧩 {kind:8s}: {results[kind]['ms_per_token']:7.2f} ms/token over {results[kind]['tokens']} tokens")
+    print(f"⚡ merged copy: {results['speedup']:.2f}x")
+
+def benchmark_speculative(worker, adapters: list[str], args) -> dict:
+    """ ms per generated token and tokens per forward pass of the same chats, token by token vs prompt lookup. """
+    # One row per batch: plain token-by-token decoding, or prompt lookup for speculative chats
+    worker.max_batch_size = 1
+    results = {}
+    for kind, speculative in (("standard", False), ("speculative", True)):
+        totals = worker.decode_stats.totals[kind]
+        run_users(worker, adapters, 1, 1, args, speculative=speculative)  # warm-up
+        before = dict(totals)
+        run_users(worker, adapters, 1, args.rounds, args, speculative=speculative)
+        tokens, forwards, seconds = (totals[key] - before[key] for key in ("tokens", "forwards", "seconds"))
+        results[kind] = {"tokens": tokens, "tokens_per_step": tokens / forwards, "ms_per_token": 1000 * seconds / tokens}
+    results["speedup"] = results["standard"]["ms_per_token"] / results["speculative"]["ms_per_token"]
+    return results
+
+def report_speculative(results: dict):
+    for kind in ("standard", "speculative"):
+        result = results[kind]
+        print(f"🎯 {kind:11s}: {result['ms_per_token']:7.2f} ms/token, {result['tokens_per_step']:.2f} tokens/step")
+    # Each step samples one token; the rest are accepted drafts (the prefill is counted as a step too)
+    print(f"✅ accepted drafts/step: {results['speculative']['tokens_per_step'] - 1:.2f}")
+    print(f"⚡ speculative: {results['speedup']:.2f}x (target 1.5-2x)")
+
+def benchmark_prefix(worker, adapters: list[str], args) -> dict:
+    """ Seconds to the first token of each turn of one conversation, full prefill vs the previous turn's KV as prefix. """
+    worker.max_batch_size = 1
+    history = sample_history(random.Random(0), args.turns + 2 * args.rounds + 1)
+    results = {}
+    for kind, min_reuse_tokens in (("full_prefill", sys.maxsize), ("prefix_reuse", 32)):
+        worker.prefix_cache.clear()
+        worker.prefix_cache.min_reuse_tokens = min_reuse_tokens
+        before = worker.prefix_cache.stats()
+        seconds = []
+        for turn in range(args.rounds + 1):
+            chat_history = json.dumps(history[:args.turns + 2 * turn + 1])
+            t = time.perf_counter()
+            worker.chat_with_lora(hf_token=None, lora_repo=adapters[0], chat_history=chat_history, max_new_tokens=1)
+            seconds.append(time.perf_counter() - t)
+        stats = worker.prefix_cache.stats()
+        reused, prompt = (stats[key] - before[key] for key in ("reused_tokens", "prompt_tokens"))
+        # The first turn has nothing to reuse in either run
+        results[kind] = {"ms_to_first_token": 1000 * sum(seconds[1:]) / args.rounds, "reused_prompt_share": reused / prompt}
+    results["speedup"] = results["full_prefill"]["ms_to_first_token"] / results["prefix_reuse"]["ms_to_first_token"]
+    return results
+
+def report_prefix(results: dict):
+    for kind in ("full_prefill", "prefix_reuse"):
+        result = results[kind]
+        print(f"⏱️ {kind:12s}: {result['ms_to_first_token']:8.2f} ms to first token, {result['reused_prompt_share']:.0%} of prompt tokens reused")
+    print(f"⚡ prefix reuse: {results['speedup']:.2f}x")
+
+MODES = {
+    "batching": (benchmark_batching, report_batching),
+    "merged": (benchmark_merged, report_merged),
+    "speculative": (benchmark_speculative, report_speculative),
+    "prefix": (benchmark_prefix, report_prefix),
+}
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="ChatWorker generation benchmarks")
+    parser.add_argument("mode", choices=list(MODES))
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--config", choices=["phi-2", "tiny"], default=None, help="default: phi-2 on CUDA, tiny on CPU")
+    parser.add_argument("--layers", type=int, default=None, help="override the config's number of layers")
+    parser.add_argument("--pretrained", action="store_true", help="use microsoft/phi-2 weights (needs the Hub)")
+    parser.add_argument("--adapters", type=int, default=4)
+    parser.add_argument("--turns", type=int, default=12, help="chat history turns per request")
+    parser.add_argument("--max-new-tokens", type=int, default=48)
+    parser.add_argument("--users", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--rounds", type=int, default=None, help="chats per user (default: 2 batching, 8 otherwise)")
+    parser.add_argument("--max-batch-size", type=int, default=16)
+    parser.add_argument("--verbose", action="store_true", help="keep the worker's own logging")
+    args = parser.parse_args(argv)
+    if args.config is None:
+        args.config = "phi-2" if args.device == "cuda" else "tiny"
+    if args.rounds is None:
+        args.rounds = 2 if args.mode == "batching" else 8
+    env = {"MAX_BATCH_SIZE": str(args.max_batch_size)}
+    if args.mode != "prefix":
+        # Every chat starts from a full prefill, so runs that repeat a history compare decoding alone
+        env["KV_CACHE_MIN_REUSE_TOKENS"] = str(sys.maxsize)
+    if args.mode == "merged":
+        # Merge only when told to, and never demote during the run
+        env.update({"MERGED_MODELS_MAX_GPU_GB": "1024", "MERGE_PROMOTE_RPM": "1e9", "MERGE_DEMOTE_RPM": "0"})
+    benchmark, report = MODES[args.mode]
+
+    # The worker logs every request; only the report is printed unless --verbose
+    worker_output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+    with tempfile.TemporaryDirectory() as directory, worker_output:
+        worker, adapters = start_worker(args, directory, env)
+        results = benchmark(worker, adapters, args)
+
+    model = "microsoft/phi-2" if args.pretrained else f"{args.config} config, random weights"
+    print(f"🧪 {args.mode} on {args.device}, {model}, {worker.base_model.config.num_hidden_layers} layers, {len(adapters)} LoRAs")
+    report(results)
+    print(json.dumps(results, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,108 +1,192 @@
 # dataset_analyzer.py
 
 import json
+import math
+import os
 import re
-import numpy as np
-from typing import List
-from supabase import Client
+from collections import Counter
+from typing import TYPE_CHECKING, List
+from backend.ttl_cache import TTLCache
 
-def analyze_dataset(jsonl_path: str, participants: List[str]):
-    """
-    Analyze dataset JSONL (Axolotl format with messages[]).
-    Returns dict with generation settings + a custom end_prompt string.
-    Also returns the participants list for Supabase storage.
-    """
+if TYPE_CHECKING:
+    from supabase import Client
 
-    msg_lengths = []
-    all_msgs = []
-    emoji_count = 0
-    slang_count = 0
+# lora_id -> (max_new_tokens, end_prompt, participants).
+# Entries only go stale on retrain, but invalidate_dataset_analysis only reaches the worker that handled it;
+# the short TTL bounds how long every other worker or replica keeps serving the old analysis.
+dataset_analysis_cache = TTLCache(max_entries=2048, ttl_seconds=int(os.getenv("DATASET_ANALYSIS_CACHE_TTL", "300")))
 
-    # very rough slang detection (can extend with a dictionary)
-    slang_words = {"lol", "omg", "idk", "lmao", "brb", "btw", "smth", "nah", "tho"}
+# very rough slang detection (can extend with a dictionary)
+SLANG_WORDS = {"lol", "omg", "idk", "lmao", "brb", "btw", "smth", "nah", "tho"}
+# Matches a whole \w+ token equal to a slang word, so one findall over a batch of
+# messages counts the same tokens as tokenizing every message separately
+SLANG_PATTERN = re.compile(r"(?<!\w)(?:" + "|".join(sorted(SLANG_WORDS)) + r")(?!\w)")
 
-    with open(jsonl_path, "r", encoding="utf-8") as f:
-        for line in f:
-            obj = json.loads(line)
-            for msg in obj.get("messages", []):
-                content = msg["content"].strip()
-                if not content:
-                    continue
-
-                all_msgs.append(content)
-                msg_lengths.append(len(content.split()))
+# Messages buffered before their emoji/slang counts are computed in one pass
+BATCH_SIZE = 4096
 
-                # detect emojis (unicode ranges)
-                emoji_count += sum(
-                    1 for ch in content if (ord(ch) > 127 and not ch.isalnum())
-                )
+class DatasetStats:
+    """
+    Running statistics over Axolotl messages[], fed one conversation at a time,
+    so the analysis can be collected while the dataset is being written.
+    """
 
-                # detect slang
-                tokens = re.findall(r"\w+", content.lower())
-                slang_count += sum(1 for t in tokens if t in slang_words)
+    def __init__(self):
+        # Histogram of message lengths (in words): exact mean/percentiles in memory
+        # bounded by the number of distinct lengths, not the number of messages
+        self.length_counts = Counter()
+        self.msg_count = 0
+        self.emoji_count = 0
+        self.slang_count = 0
+        self._batch = []
+
+    def add_messages(self, messages: list[dict]):
+        for msg in messages:
+            content = msg["content"].strip()
+            if content:
+                self._batch.append(content)
+        if len(self._batch) >= BATCH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, []
+
+        self.msg_count += len(batch)
+        self.length_counts.update(len(content.split()) for content in batch)
+
+        # A newline separator can't join \w+ tokens across messages and isn't counted as an emoji
+        joined = "\n".join(batch)
+
+        # detect emojis (unicode ranges); cleaned datasets are ASCII-only, so usually skipped
+        if not joined.isascii():
+            self.emoji_count += sum(
+                1 for ch in joined if (ord(ch) > 127 and not ch.isalnum())
+            )
+
+        # detect slang
+        self.slang_count += len(SLANG_PATTERN.findall(joined.lower()))
+
+    def mean_length(self) -> float:
+        return sum(length * count for length, count in self.length_counts.items()) / self.msg_count
+
+    def length_percentile(self, q: float) -> float:
+        """ Same value as np.percentile(lengths, q) (linear method), computed from the histogram. """
+        virtual_index = (self.msg_count - 1) * (q / 100)
+        lower = math.floor(virtual_index)
+        gamma = virtual_index - lower
+
+        a = b = None
+        seen = 0
+        for length in sorted(self.length_counts):
+            seen += self.length_counts[length]
+            if a is None and seen > lower:
+                a = length
+            if seen > lower + 1 or seen == self.msg_count:
+                b = length
+                break
+
+        # numpy's _lerp, including its switch to the upper end for gamma >= 0.5
+        diff = b - a
+        if gamma >= 0.5:
+            return b - diff * (1 - gamma)
+        return a + diff * gamma
+
+    def analysis(self, participants: List[str]) -> dict:
+        """
+        Returns dict with generation settings + a custom end_prompt string.
+        Also returns the participants list for Supabase storage.
+        """
+        self._flush()
+        if not self.msg_count:
+            return {
+                "max_new_tokens": 128,
+                "end_prompt": "(Answer naturally.)",
+                "participants": participants or []
+            }
+
+        avg_len = self.mean_length()
+
+        # Heuristic: prefer 95th percentile * 1.2, fallback to avg if dataset is too small
+        if self.msg_count > 10:
+            p95_len = self.length_percentile(95)
+            max_new_tokens = int(min(512, max(32, p95_len * 1.2)))
+        else:
+            max_new_tokens = int(min(512, max(32, avg_len * 2)))
+
+        # Build dynamic end prompt
+        style_bits = []
+
+        if avg_len < 8:
+            style_bits.append("Keep replies short and casual")
+        elif avg_len > 20:
+            style_bits.append("Give longer, detailed replies")
+        else:
+            style_bits.append("Match the same tone and length")
+
+        if self.emoji_count / max(1, self.msg_count) > 0.2:
+            style_bits.append("Use emojis naturally")
+        if self.slang_count / max(1, self.msg_count) > 0.05:
+            style_bits.append("Include slang if it fits the context")
+
+        end_prompt = "(" + ", and ".join(style_bits) + ".)"
 
-    if not all_msgs:
         return {
-            "max_new_tokens": 128,
-            "end_prompt": "(Answer naturally.)",
+            "max_new_tokens": max_new_tokens,
+            "end_prompt": end_prompt,
+            "stats": {
+                "avg_msg_len": avg_len,
+                "emoji_density": self.emoji_count / max(1, self.msg_count),
+                "slang_density": self.slang_count / max(1, self.msg_count),
+            },
             "participants": participants or []
         }
 
-    avg_len = np.mean(msg_lengths)
-
-    # Heuristic: prefer 95th percentile * 1.2, fallback to avg if dataset is too small
-    if len(msg_lengths) > 10:
-        p95_len = np.percentile(msg_lengths, 95)
-        max_new_tokens = int(min(512, max(32, p95_len * 1.2)))
-    else:
-        max_new_tokens = int(min(512, max(32, avg_len * 2)))
-
-    # Build dynamic end prompt
-    style_bits = []
-
-    if avg_len < 8:
-        style_bits.append("Keep replies short and casual")
-    elif avg_len > 20:
-        style_bits.append("Give longer, detailed replies")
-    else:
-        style_bits.append("Match the same tone and length")
-
-    if emoji_count / max(1, len(all_msgs)) > 0.2:
-        style_bits.append("Use emojis naturally")
-    if slang_count / max(1, len(all_msgs)) > 0.05:
-        style_bits.append("Include slang if it fits the context")
-
-    end_prompt = "(" + ", and ".join(style_bits) + ".)"
-
-    return {
-        "max_new_tokens": max_new_tokens,
-        "end_prompt": end_prompt,
-        "stats": {
-            "avg_msg_len": avg_len,
-            "emoji_density": emoji_count / max(1, len(all_msgs)),
-            "slang_density": slang_count / max(1, len(all_msgs)),
-        },
-        "participants": participants or []
-    }
-
-def save_dataset_analysis_to_supabase(supabase: Client, lora_id: str, analysis: dict):
+def analyze_dataset(jsonl_path: str, participants: List[str]):
+    """
+    Analyze dataset JSONL (Axolotl format with messages[]).
+    See DatasetStats.analysis for the returned dict.
+    """
+    stats = DatasetStats()
+    with open(jsonl_path, "r", encoding="utf-8") as f:
+        for line in f:
+            obj = json.loads(line)
+            stats.add_messages(obj.get("messages", []))
+    return stats.analysis(participants)
+
+def save_dataset_analysis_to_supabase(supabase: "Client", lora_id: str, analysis: dict):
     try:
         supabase.table("loras").update({"dataset_analysis": analysis}).eq("id", lora_id).execute()
+        dataset_analysis_cache.set(lora_id, _analysis_settings(analysis))
         print(f"✅ Saved dataset analysis for lora {lora_id}")
     except Exception as e:
         print(f"⚠️ Failed to save dataset analysis: {e}")
 
-def get_dataset_analysis_from_supabase(supabase: Client, lora_id: str) -> tuple[int, str, list[str]]:
+def invalidate_dataset_analysis(lora_id: str):
+    """ Drop the cached analysis, e.g. when the LoRA is being retrained. """
+    dataset_analysis_cache.invalidate(lora_id)
+
+def get_dataset_analysis_from_supabase(supabase: "Client", lora_id: str) -> tuple[int, str, list[str]]:
+    cached = dataset_analysis_cache.get(lora_id)
+    if cached is not None:
+        return cached
+
     try:
         resp = supabase.table("loras").select("dataset_analysis").eq("id", lora_id).single().execute()
         analysis = resp.data.get("dataset_analysis") if resp.data else None
         if not analysis:
             raise ValueError("No dataset analysis found")
-        max_new_tokens = analysis.get("max_new_tokens", 150)
-        end_prompt = analysis.get("end_prompt", "\nUser:")
-        participants = analysis.get("participants", ["User", "Assistant"])
-        return max_new_tokens, end_prompt, participants
+        settings = _analysis_settings(analysis)
+        dataset_analysis_cache.set(lora_id, settings)
+        return settings
     except Exception as e:
         print(f"⚠️ Failed to retrieve dataset analysis: {e}")
         # Return defaults
         return 150, "\nUser:", ["User", "Assistant"]
+
+def _analysis_settings(analysis: dict) -> tuple[int, str, list[str]]:
+    max_new_tokens = analysis.get("max_new_tokens", 150)
+    end_prompt = analysis.get("end_prompt", "\nUser:")
+    participants = analysis.get("participants", ["User", "Assistant"])
+    return max_new_tokens, end_prompt, participants
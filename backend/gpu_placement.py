@@ -0,0 +1,115 @@
+# gpu_placement.py - cached RunPod GPU catalog and failure-aware ordering of GPU types for pod placement
+
+import math
+import os
+import threading
+import time
+from collections import deque
+
+from backend.runpod_client import RunPodClient, RunPodError
+from backend.ttl_cache import TTLCache
+
+# The catalog is the same for every account, so one cached copy serves all creators
+GPU_CATALOG_TTL = int(os.getenv("GPU_CATALOG_TTL", "3600"))
+gpu_catalog_cache = TTLCache(max_entries=1, ttl_seconds=GPU_CATALOG_TTL)
+GPU_CATALOG_KEY = "gpuTypes"
+
+# A capacity failure counts 1 and halves every half-life, so a type that was full a while ago is retried
+GPU_FAILURE_HALF_LIFE_SECONDS = float(os.getenv("GPU_FAILURE_HALF_LIFE_SECONDS", "900"))
+PLACEMENT_LATENCY_WINDOW = 512
+
+async def get_gpu_catalog(runpod: RunPodClient) -> list[dict] | None:
+    """
+    [{id, displayName, memoryInGb}, ...], fetched at most once per GPU_CATALOG_TTL.
+    None if RunPod answers with errors or still fails after the client's retries; failures are not cached.
+    """
+    catalog = gpu_catalog_cache.get(GPU_CATALOG_KEY)
+    if catalog is not None:
+        return catalog
+
+    try:
+        resp = await runpod.graphql_async("query { gpuTypes { id displayName memoryInGb } }")
+    except RunPodError as e:
+        print(f"❌ Failed to fetch GPU types: {e}")
+        return None
+    if "errors" in resp:
+        print("❌ Failed to fetch GPU types:", resp["errors"])
+        return None
+
+    catalog = resp["data"]["gpuTypes"]
+    gpu_catalog_cache.set(GPU_CATALOG_KEY, catalog)
+    return catalog
+
+class GpuPlacementStats:
+    """
+    Per-GPU-type failure scores with exponential decay, plus placement latency / attempt metrics.
+    rank() orders eligible types by rounded failure score, then by memory (smallest first, as before),
+    so types that recently had no capacity are tried last until their score decays.
+    """
+    def __init__(self, half_life_seconds: float = GPU_FAILURE_HALF_LIFE_SECONDS):
+        self.decay_rate = math.log(2) / half_life_seconds
+        self._lock = threading.Lock()
+        self._scores = {}  # gpu id -> (score, updated_at)
+        self.attempts = {}  # gpu id -> {"successes": n, "failures": n}
+        self.placements = 0
+        self.failed_placements = 0
+        self.total_attempts = 0
+        self.latencies = deque(maxlen=PLACEMENT_LATENCY_WINDOW)
+
+    def score(self, gpu_id: str, now: float | None = None) -> float:
+        with self._lock:
+            return self._decayed(gpu_id, now or time.monotonic())
+
+    def _decayed(self, gpu_id: str, now: float) -> float:
+        score, updated_at = self._scores.get(gpu_id, (0.0, now))
+        return score * math.exp(-self.decay_rate * (now - updated_at))
+
+    def rank(self, gpus: list[dict], min_memory_gb: int) -> list[dict]:
+        now = time.monotonic()
+        with self._lock:
+            eligible = [g for g in gpus if g["memoryInGb"] >= min_memory_gb]
+            return sorted(eligible, key=lambda g: (round(self._decayed(g["id"], now)), g["memoryInGb"]))
+
+    def record_attempt(self, gpu_id: str, succeeded: bool):
+        now = time.monotonic()
+        with self._lock:
+            counts = self.attempts.setdefault(gpu_id, {"successes": 0, "failures": 0})
+            self.total_attempts += 1
+            if succeeded:
+                counts["successes"] += 1
+                # Capacity is back: forget the type's past failures
+                self._scores.pop(gpu_id, None)
+            else:
+                counts["failures"] += 1
+                self._scores[gpu_id] = (self._decayed(gpu_id, now) + 1.0, now)
+
+    def record_placement(self, succeeded: bool, seconds: float):
+        with self._lock:
+            if succeeded:
+                self.placements += 1
+            else:
+                self.failed_placements += 1
+            self.latencies.append(seconds)
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            latencies = sorted(self.latencies)
+            finished = self.placements + self.failed_placements
+            return {
+                "placements": self.placements,
+                "failed_placements": self.failed_placements,
+                "avg_attempts": self.total_attempts / finished if finished else 0.0,
+                "latency_ms": {
+                    "avg": 1000 * sum(latencies) / len(latencies) if latencies else 0.0,
+                    "p50": 1000 * latencies[len(latencies) // 2] if latencies else 0.0,
+                    "p95": 1000 * latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else 0.0,
+                },
+                "gpu_types": {
+                    gpu_id: {**counts, "failure_score": round(self._decayed(gpu_id, now), 3)}
+                    for gpu_id, counts in self.attempts.items()
+                },
+                "catalog_cache": gpu_catalog_cache.stats(),
+            }
+
+placement_stats = GpuPlacementStats()
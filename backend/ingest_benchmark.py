@@ -0,0 +1,122 @@
+# ingest_benchmark.py - peak memory (RSS) and time of turning an uploaded chat export into training files
+#
+#   python -m backend.ingest_benchmark                 # synthetic 200 MB export, legacy path vs current path
+#   python -m backend.ingest_benchmark --mb 50
+#
+# /generate-voice receives the export as one rawText string. The legacy path (backend/legacy.py) converts it
+# to a second JSONL string, splits the lines with scikit-learn, writes both files and reads the train file back
+# for the analysis; the current one (dataset_pipeline.write_training_files) streams each line into its file.
+# Each path runs in a fresh interpreter, so ru_maxrss is that path's own high-water mark. Reported: the peak,
+# and the peak minus the RSS once the export is loaded (what the path itself adds on top of the request body).
+# Only the backend process is measured: with PREPROCESS_WORKERS >= 2, exports over PREPROCESS_PARALLEL_MIN_CHARS
+# are converted in worker processes, which hold at most two 2 MB chunks each.
+
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from backend.normalize_benchmark import ASCII_WORDS, NON_ASCII_WORDS
+
+PARTICIPANTS = ["User", "Assistant"]
+
+def write_export(path: str, total_bytes: int, non_ascii_share: float = 0.2, seed: int = 0):
+    """ Frontend JSONL: one {"text": "User: ...\\nAssistant: ..."} conversation per line. """
+    rng = random.Random(seed)
+    words = [word for word in ASCII_WORDS if not word.endswith(":")]
+    size = 0
+    with open(path, "w", encoding="utf-8") as f:
+        while size < total_bytes:
+            turns = []
+            for i in range(rng.randrange(2, 10)):
+                message = [rng.choice(words) for _ in range(rng.randrange(2, 20))]
+                if rng.random() < non_ascii_share:
+                    message[rng.randrange(len(message))] = rng.choice(NON_ASCII_WORDS)
+                turns.append(f"{PARTICIPANTS[i % 2]}: {' '.join(message)}")
+            line = json.dumps({"text": "\n".join(turns)}, ensure_ascii=False) + "\n"
+            f.write(line)
+            size += len(line.encode("utf-8"))
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+
+def rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024**2
+
+def run_path(path: str, export_path: str) -> dict:
+    """ Child process: one path over the export, as /generate-voice runs it. """
+    from backend.dataset_pipeline import remove_files, write_training_files
+    from backend.legacy import legacy_write_training_files
+
+    with open(export_path, encoding="utf-8") as f:
+        raw_text = f.read()
+    # Not the high-water mark: decoding the file briefly holds its bytes too
+    loaded = rss_mb()
+
+    started = time.perf_counter()
+    if path == "legacy":
+        train_path, val_path, analysis = legacy_write_training_files(raw_text, PARTICIPANTS)
+    else:
+        train_path, val_path, _, _, stats = write_training_files(raw_text, 0.02)
+        analysis = stats.analysis(PARTICIPANTS)
+    seconds = time.perf_counter() - started
+
+    with open(train_path, encoding="utf-8") as f:
+        train_lines = sum(1 for _ in f)
+    with open(val_path, encoding="utf-8") as f:
+        val_lines = sum(1 for _ in f)
+    remove_files(train_path, val_path)
+    return {
+        "peak_mb": peak_rss_mb(),
+        "loaded_mb": loaded,
+        "seconds": seconds,
+        "train_lines": train_lines,
+        "val_lines": val_lines,
+        "max_new_tokens": analysis["max_new_tokens"],
+    }
+
+def measure(path: str, export_path: str) -> dict:
+    result = subprocess.run(
+        [sys.executable, "-m", "backend.ingest_benchmark", "--run", path, "--export", export_path],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"{path} path failed:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Peak RSS of building training files from a chat export")
+    parser.add_argument("--mb", type=float, default=200, help="size of the synthetic export")
+    parser.add_argument("--run", choices=["legacy", "current"], help=argparse.SUPPRESS)
+    parser.add_argument("--export", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run:
+        print(json.dumps(run_path(args.run, args.export)))
+        return 0
+
+    with tempfile.TemporaryDirectory() as directory:
+        export_path = os.path.join(directory, "export.jsonl")
+        write_export(export_path, int(args.mb * 1024 * 1024))
+        export_mb = os.path.getsize(export_path) / 1024**2
+        results = {path: measure(path, export_path) for path in ("legacy", "current")}
+
+    print(f"📏 {export_mb:.0f} MB export")
+    for path, result in results.items():
+        print(
+            f"{'🐢' if path == 'legacy' else '🚀'} {path:7s}: peak {result['peak_mb']:7.0f} MB "
+            f"(+{result['peak_mb'] - result['loaded_mb']:.0f} MB over the loaded export), "
+            f"{result['seconds']:.1f}s, {result['train_lines']} train / {result['val_lines']} val lines"
+        )
+    legacy, current = results["legacy"], results["current"]
+    print(f"📉 peak over the loaded export: {(current['peak_mb'] - current['loaded_mb']) / (legacy['peak_mb'] - legacy['loaded_mb']):.0%} of legacy")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,212 @@
+# legacy.py - implementations replaced by faster ones, kept verbatim as the reference backend/tests compare the
+# current code against. The backend/*_benchmark.py scripts import them from here as their "before" path;
+# nothing the service runs (main.py and what it imports) imports this module.
+# Nothing here imports torch, so memory benchmarks of the data paths are not inflated by it; the generation-side
+# reference is in legacy_generation.py.
+
+import json
+import re
+import tempfile
+import unicodedata
+from typing import List
+
+import numpy as np
+
+# Text normalization, replaced by backend/dataset_pipeline.py's clean_unicode / remove_all_unicode_except_ascii
+
+def legacy_clean_unicode(text: str) -> str:
+    replacements = {
+        "’": "'", "‘": "'", "“": '"', "”": '"', "–": "-", "—": "-", "…": "...", "•": "-", " ": " ", "\u00A0": " "
+    }
+    for bad, good in replacements.items():
+        text = text.replace(bad, good)
+    return unicodedata.normalize('NFKC', text)
+
+def legacy_remove_all_unicode_except_ascii(text: str) -> str:
+    allowed_chars = (
+        "abcdefghijklmnopqrstuvwxyz"
+        "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+        "0123456789"
+        " ~!@#$%^&*()-=_+[]{};':\"\\|,.<>/?"
+    )
+    return "".join(c for c in text if c in allowed_chars)
+
+# ChatML prompt string + one tokenizer call over it, replaced by ChatWorker.build_chatml_input_ids.
+# The method's self.tokenizer is a parameter here; legacy_prompt_ids is what _prepare_inputs did with the string.
+
+def legacy_format_chatml_conversation(
+    tokenizer,
+    history: list,
+    end_prompt: str = None,
+    participants: dict = None,
+    max_tokens: int = 1800
+) -> str:
+    if participants is None:
+        participants = {"user": "You", "assistant": "Assistant"}
+    
+    lines = []
+
+    # Optional: add a system prompt at the very start
+    if end_prompt:
+        lines.append(f"<|im_start|>system\n{end_prompt}<|im_end|>")
+
+    total_tokens = 0
+
+    # Walk backwards through history (most recent first)
+    for turn in reversed(history):
+        # Map sender -> ChatML role
+        if turn["sender"] == participants.get("user", "You"):
+            role = "user"
+        elif turn["sender"] == participants.get("assistant", "Assistant"):
+            role = "assistant"
+        else:
+            role = "user"  # default fallback
+
+        entry = f"<|im_start|>{role}\n{turn['message']}<|im_end|>"
+
+        # Estimate tokens
+        tokens = len(tokenizer.encode(entry))
+        if total_tokens + tokens > max_tokens:
+            break
+        total_tokens += tokens
+
+        # Prepend so order is correct
+        lines.insert(0, entry)
+
+    # Only add assistant prompt if last turn was user
+    if history and history[-1]["sender"] == participants.get("user", "You"):
+        lines.append("<|im_start|>assistant\n")
+    
+    return "\n".join(lines)
+
+def legacy_prompt_ids(tokenizer, history: list, end_prompt: str = None, participants: dict = None, max_tokens: int = 1800) -> list[int]:
+    formatted_prompt = legacy_format_chatml_conversation(tokenizer, history, end_prompt, participants, max_tokens)
+    return tokenizer(formatted_prompt.strip(), return_tensors="pt")["input_ids"][0].tolist()
+
+# Training file preparation, replaced by backend/dataset_pipeline.py's write_training_files: the whole export
+# converted to one JSONL string, split with scikit-learn, written, then read back for the analysis.
+# legacy_write_training_files is the sequence /generate-voice ran.
+
+def legacy_split_train_val(jsonl_str: str, val_frac: float = 0.02) -> tuple[str, str]:
+    # scikit-learn is no longer a backend dependency; only running the legacy path needs it
+    from sklearn.model_selection import train_test_split
+
+    lines = [line for line in jsonl_str.strip().splitlines() if line.strip()]
+    train_lines, val_lines = train_test_split(lines, test_size=val_frac, random_state=42)
+    return "\n".join(train_lines), "\n".join(val_lines)
+
+def legacy_text_to_axolotl_json(raw_text: str) -> str:
+    conversation_jsonl = []
+    for line in raw_text.strip().splitlines():
+        if not line.strip():
+            continue
+        try:
+            obj = json.loads(line)
+            text = legacy_remove_all_unicode_except_ascii(legacy_clean_unicode(obj.get("text", "").strip()))
+            pattern = r"(User|Assistant):\s*(.*?)(?=(User|Assistant):|$)"
+            matches = re.findall(pattern, text, flags=re.DOTALL)
+            messages = []
+            for match in matches:
+                role = "user" if match[0].lower() == "user" else "assistant"
+                content = match[1].strip()
+                if content:
+                    messages.append({"role": role, "content": content})
+            if messages:
+                conversation_jsonl.append(json.dumps({"messages": messages}, ensure_ascii=False))
+        except Exception:
+            continue
+    return "\n".join(conversation_jsonl)
+
+def legacy_analyze_dataset(jsonl_path: str, participants: List[str]):
+    msg_lengths = []
+    all_msgs = []
+    emoji_count = 0
+    slang_count = 0
+
+    # very rough slang detection (can extend with a dictionary)
+    slang_words = {"lol", "omg", "idk", "lmao", "brb", "btw", "smth", "nah", "tho"}
+
+    with open(jsonl_path, "r", encoding="utf-8") as f:
+        for line in f:
+            obj = json.loads(line)
+            for msg in obj.get("messages", []):
+                content = msg["content"].strip()
+                if not content:
+                    continue
+
+                all_msgs.append(content)
+                msg_lengths.append(len(content.split()))
+
+                # detect emojis (unicode ranges)
+                emoji_count += sum(
+                    1 for ch in content if (ord(ch) > 127 and not ch.isalnum())
+                )
+
+                # detect slang
+                tokens = re.findall(r"\w+", content.lower())
+                slang_count += sum(1 for t in tokens if t in slang_words)
+
+    if not all_msgs:
+        return {
+            "max_new_tokens": 128,
+            "end_prompt": "(Answer naturally.)",
+            "participants": participants or []
+        }
+
+    avg_len = np.mean(msg_lengths)
+
+    # Heuristic: prefer 95th percentile * 1.2, fallback to avg if dataset is too small
+    if len(msg_lengths) > 10:
+        p95_len = np.percentile(msg_lengths, 95)
+        max_new_tokens = int(min(512, max(32, p95_len * 1.2)))
+    else:
+        max_new_tokens = int(min(512, max(32, avg_len * 2)))
+
+    # Build dynamic end prompt
+    style_bits = []
+
+    if avg_len < 8:
+        style_bits.append("Keep replies short and casual")
+    elif avg_len > 20:
+        style_bits.append("Give longer, detailed replies")
+    else:
+        style_bits.append("Match the same tone and length")
+
+    if emoji_count / max(1, len(all_msgs)) > 0.2:
+        style_bits.append("Use emojis naturally")
+    if slang_count / max(1, len(all_msgs)) > 0.05:
+        style_bits.append("Include slang if it fits the context")
+
+    end_prompt = "(" + ", and ".join(style_bits) + ".)"
+
+    return {
+        "max_new_tokens": max_new_tokens,
+        "end_prompt": end_prompt,
+        "stats": {
+            "avg_msg_len": avg_len,
+            "emoji_density": emoji_count / max(1, len(all_msgs)),
+            "slang_density": slang_count / max(1, len(all_msgs)),
+        },
+        "participants": participants or []
+    }
+
+def legacy_write_training_files(raw_text: str, participants: List[str], val_frac: float = 0.02) -> tuple[str, str, dict]:
+    """ Returns (train_path, val_path, analysis); the caller deletes the files. """
+    # Convert frontend JSONL into Axolotl format
+    jsonl_str = legacy_text_to_axolotl_json(raw_text)
+
+    # Split train / validation
+    train_jsonl, val_jsonl = legacy_split_train_val(jsonl_str, val_frac=val_frac)
+
+    # ---------- Write temp files ----------
+    with tempfile.NamedTemporaryFile(mode="w+", delete=False, suffix=".jsonl", encoding="utf-8") as f_train, \
+         tempfile.NamedTemporaryFile(mode="w+", delete=False, suffix=".jsonl", encoding="utf-8") as f_val:
+        f_train_path = f_train.name
+        f_val_path = f_val.name
+        f_train.write(train_jsonl)
+        f_val.write(val_jsonl)
+        f_train.flush()
+        f_val.flush()
+
+    # ---------- Analyze dataset ----------
+    return f_train_path, f_val_path, legacy_analyze_dataset(f_train_path, participants)
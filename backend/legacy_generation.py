@@ -0,0 +1,41 @@
+# legacy_generation.py - generation-time code replaced by faster versions, kept verbatim as the reference for
+# backend/tests/test_chat_with_lora.py and backend/stopping_benchmark.py (see legacy.py for the data paths).
+# LegacyBatchStoppingCriteria at the end is not baseline code, only the adapter that runs it on a batch.
+
+import torch
+from transformers import StoppingCriteria
+
+# Stop-phrase check, replaced by backend/chat_with_lora.py's KeywordMatcher / KeywordStoppingCriteria
+
+class KeywordStoppingCriteria(StoppingCriteria):
+    def __init__(self, tokenizer, keywords):
+        self.tokenizer = tokenizer
+        self.keywords = [kw.lower() for kw in keywords]
+        self.generated_text = ""
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs):
+        # Decode only the newly generated token
+        new_token_id = input_ids[0, -1].item()
+        new_text = self.tokenizer.decode([new_token_id], skip_special_tokens=True)
+        self.generated_text += new_text.lower()
+
+        # If any keyword shows up, stop
+        for kw in self.keywords:
+            if kw in self.generated_text:
+                print(f"[STOPPING] Triggered on keyword: {kw}")
+                return True
+
+        return False
+
+class LegacyBatchStoppingCriteria(StoppingCriteria):
+    """ The baseline stopper only reads row 0 (it ran one sequence at a time); this runs one per batch row. """
+    def __init__(self, tokenizer, keywords):
+        self.tokenizer = tokenizer
+        self.keywords = keywords
+        self.rows = []
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs):
+        if not self.rows:
+            self.rows = [KeywordStoppingCriteria(self.tokenizer, self.keywords) for _ in range(input_ids.shape[0])]
+        done = [stopper(input_ids[row:row + 1], scores) for row, stopper in enumerate(self.rows)]
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
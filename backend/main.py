@@ -2,35 +2,35 @@
 
 # -------------------- Standard library imports --------------------
 import asyncio
+import base64
 import json
 import os
-import re
-import tempfile
+import threading
 import traceback
-import unicodedata
+from collections import OrderedDict
 from contextlib import asynccontextmanager
+from functools import lru_cache
 
 # -------------------- Third-party imports --------------------
-from fastapi import BackgroundTasks, FastAPI, Request
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from dotenv import load_dotenv
-from sklearn.model_selection import train_test_split 
-from supabase import create_client
-import modal
 
-# -------------------- Cryptography imports --------------------
-import base64
-from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import padding
+# Heavy modules (modal, supabase, cryptography, backend.train_lora) are imported on
+# first use instead of here, so a fresh worker is ready to serve as soon as possible.
 
 # -------------------- Local imports --------------------
 from backend.dataset_analyzer import (
-    analyze_dataset,
+    dataset_analysis_cache,
     get_dataset_analysis_from_supabase,
+    invalidate_dataset_analysis,
     save_dataset_analysis_to_supabase,
 )
-from backend.train_lora import finalize_training, train_lora
+from backend.dataset_pipeline import remove_files, write_training_files
+from backend.supabase_client import get_supabase
+from backend.training_scheduler import JobState, TrainingScheduler
+from backend.ttl_cache import TTLCache
 
 # -------------------- FastAPI app --------------------
 app = FastAPI()
@@ -54,17 +54,82 @@ load_dotenv(dotenv_path=env_path)
 RSA_PRIVATE_KEY = os.getenv("RSA_PRIVATE_KEY")
 RSA_PUBLIC_KEY = os.getenv("RSA_PUBLIC_KEY")
 
-# -------------------- Supabase client --------------------
-supabase = create_client(
-    os.getenv("NEXT_PUBLIC_SUPABASE_URL"),
-    os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-)
+@lru_cache(maxsize=None)
+def get_rsa_keys():
+    """
+    Parses the PEM keys once per process (at startup, from lifespan) instead of on every request.
+    Returns (private_key, public_key, oaep_padding).
+    """
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import padding
+
+    private_key = serialization.load_pem_private_key(RSA_PRIVATE_KEY.encode(), password=None) if RSA_PRIVATE_KEY else None
+    public_key = serialization.load_pem_public_key(RSA_PUBLIC_KEY.encode()) if RSA_PUBLIC_KEY else None
+    oaep_padding = padding.OAEP(
+        mgf=padding.MGF1(algorithm=hashes.SHA256()),
+        algorithm=hashes.SHA256(),
+        label=None
+    )
+    return private_key, public_key, oaep_padding
+
+# -------------------- Credential caches --------------------
+# lora_id -> creator_id never changes, so it can live long.
+# creator_id -> decrypted env vars is short-lived and dropped when /save-env-vars writes new keys.
+creator_id_cache = TTLCache(max_entries=4096, ttl_seconds=int(os.getenv("CREATOR_ID_CACHE_TTL", "3600")))
+env_vars_cache = TTLCache(max_entries=1024, ttl_seconds=int(os.getenv("ENV_VARS_CACHE_TTL", "300")))
+
+# -------------------- Concurrency --------------------
+# Max chats a single worker forwards to Modal at once; the rest wait for a free slot.
+CHAT_CONCURRENCY_LIMIT = int(os.getenv("CHAT_CONCURRENCY_LIMIT", "32"))
+chat_slots = asyncio.Semaphore(CHAT_CONCURRENCY_LIMIT)
+
+# LoRAs chatted with most recently (last = newest); the default list for /prefetch-adapters
+PREFETCH_MAX_LORAS = int(os.getenv("PREFETCH_MAX_LORAS", "16"))
+recent_lora_ids = OrderedDict()
+
+# Chat worker deployment: weight precision (fp16 | int8 | nf4), KV cache (fp16 | int8) and an optional smaller GPU
+CHAT_PRECISION = os.getenv("CHAT_PRECISION", "fp16")
+CHAT_KV_CACHE = os.getenv("CHAT_KV_CACHE", "fp16")
+CHAT_GPU = os.getenv("CHAT_GPU")
 
 # -------------------- Root endpoint --------------------
 @app.get("/")
 async def root():
     return {"message": "Hello from Loraly! This is the backend."}
 
+# -------------------- Cache stats endpoint --------------------
+@app.get("/cache-stats")
+async def cache_stats():
+    return {
+        "creator_id_cache": creator_id_cache.stats(),
+        "env_vars_cache": env_vars_cache.stats(),
+        "dataset_analysis_cache": dataset_analysis_cache.stats(),
+    }
+
+@app.get("/runpod-stats")
+async def runpod_stats():
+    from backend.gpu_placement import placement_stats
+    from backend.runpod_client import runpod_metrics
+
+    return {**runpod_metrics(), "placement": placement_stats.snapshot()}
+
+# -------------------- Training scheduler --------------------
+training_scheduler = TrainingScheduler(env_vars_loader=lambda lora_id: get_env_vars_for_lora(lora_id))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Malformed RSA keys fail the boot instead of the first request that needs them
+    get_rsa_keys()
+    # Pick up training jobs a previous process left unfinished
+    await training_scheduler.resume()
+    yield
+
+app.router.lifespan_context = lifespan
+
+@app.get("/training-stats")
+async def training_stats():
+    return training_scheduler.stats()
+
 # -------------------- Finalize training endpoint --------------------
 @app.post("/finalize-training")
 async def finalize_training_endpoint(request: Request):
@@ -82,21 +147,34 @@ async def finalize_training_endpoint(request: Request):
 
     print_from_main(f"Received finalize notification for LoRA {lora_id}")
     
-    env_vars = get_env_vars_for_lora(lora_id)
+    env_vars = await asyncio.to_thread(get_env_vars_for_lora, lora_id)
     if not env_vars:
         return JSONResponse({"error": "Creator not found for this LoRA"}, status_code=404)
-    runpod_api_key = env_vars["runpod_api_key"]
 
     try:
-        resp = supabase.table("loras").select("pod_id").eq("id", lora_id).single().execute()
+        resp = await asyncio.to_thread(
+            lambda: get_supabase().table("loras").select("pod_id").eq("id", lora_id).single().execute()
+        )
         pod_id = resp.data.get("pod_id") if resp.data else None
 
         if not pod_id:
             print_from_main(f"No pod_id found for LoRA {lora_id}")
             return JSONResponse({"error": "Pod ID not found"}, status_code=404)
 
-        finalize_training(runpod_api_key, lora_id, pod_id, cuda_not_available=(status == "cuda_not_available"))
-        return {"status": "success", "message": f"Training finalized for LoRA {lora_id}"}
+        # The HF check and clean-up run in the scheduler; the pod gets its answer right away
+        job = await training_scheduler.notify_finished(
+            lora_id, pod_id, cuda_not_available=(status == "cuda_not_available")
+        )
+        if job is None:
+            return {"status": "success", "message": f"Training already finalizing for LoRA {lora_id}"}
+        if job.state != JobState.FINALIZING:
+            # Another worker is still provisioning the job and picks the recorded callback up
+            return {"status": "success", "message": f"Finalize request recorded for LoRA {lora_id}"}
+        return {"status": "success", "message": f"Finalizing training for LoRA {lora_id}"}
+
+    except ValueError as e:
+        print_from_main(f"Rejected finalize notification: {e}")
+        return JSONResponse({"error": str(e)}, status_code=409)
 
     except Exception as e:
         print_from_main(f"Error finalizing training: {e}")
@@ -104,20 +182,27 @@ async def finalize_training_endpoint(request: Request):
         return JSONResponse({"error": str(e)}, status_code=500)
 
 # -------------------- Loading modal objects --------------------
-Phi2ChatCls = modal.Cls.from_name("phi2-lora-chat", "Phi2Chat")
 chat_worker = None
+chat_worker_lock = threading.Lock()
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
+def get_chat_worker():
+    """
+    Looks up the persistent Modal chat worker on first use (importing modal only then).
+    Runs in worker threads, so concurrent first requests wait for one lookup instead of each making a handle.
+    """
     global chat_worker
-    print_from_main("Spinning up PERSISTENT Modal chat worker...")
-    
-    # Chat worker
-    chat_worker = Phi2ChatCls()
-    print_from_main(f"Persistent chat worker spawned: {chat_worker}")
-    yield
-
-app.router.lifespan_context = lifespan
+    if chat_worker is None:
+        with chat_worker_lock:
+            if chat_worker is None:
+                import modal
+
+                print_from_main("Spinning up PERSISTENT Modal chat worker...")
+                Phi2ChatCls = modal.Cls.from_name("phi2-lora-chat", "Phi2Chat")
+                if CHAT_GPU:
+                    Phi2ChatCls = Phi2ChatCls.with_options(gpu=CHAT_GPU)
+                chat_worker = Phi2ChatCls(precision=CHAT_PRECISION, kv_cache=CHAT_KV_CACHE)
+                print_from_main(f"Persistent chat worker spawned: {chat_worker}")
+    return chat_worker
 
 # -------------------- Chat API --------------------
 @app.post("/chat")
@@ -132,7 +217,7 @@ async def chat(request: Request) -> JSONResponse:
         if not isinstance(chat_history, list):
             return JSONResponse({"error": "chatHistory must be a list"}, status_code=400)
 
-        env_vars = get_env_vars_for_lora(lora_id)
+        env_vars, (max_new_tokens, end_prompt, participants) = await load_chat_context(lora_id)
         if not env_vars:
             return JSONResponse({"error": "Creator not found for this LoRA"}, status_code=404)
         hf_token = env_vars["hf_token"]
@@ -140,16 +225,17 @@ async def chat(request: Request) -> JSONResponse:
 
         print_from_main(f"Sending prompt to Modal for LoRA: {lora_id}")
 
-        max_new_tokens, end_prompt, participants = get_dataset_analysis_from_supabase(supabase, lora_id)
-
-        response = chat_worker.chat_with_lora.remote(
-            hf_token=hf_token,
-            lora_repo=f"{hf_username}/{lora_id}-model",
-            chat_history=json.dumps(chat_history),
-            max_new_tokens=max_new_tokens,
-            end_prompt=end_prompt,
-            participants=participants
-        )
+        worker = await asyncio.to_thread(get_chat_worker)
+        async with chat_slots:
+            response = await worker.chat_with_lora.remote.aio(
+                hf_token=hf_token,
+                lora_repo=f"{hf_username}/{lora_id}-model",
+                chat_history=json.dumps(chat_history),
+                max_new_tokens=max_new_tokens,
+                end_prompt=end_prompt,
+                participants=participants,
+                speculative=bool(data.get("speculative", False))
+            )
 
         return {"response": response}
 
@@ -158,10 +244,119 @@ async def chat(request: Request) -> JSONResponse:
         traceback.print_exc()
         return JSONResponse({"error": "Internal server error"}, status_code=500)
 
+@app.get("/chat-precision-stats")
+async def chat_precision_stats():
+    """ Memory and throughput of the chat worker's precision mode. """
+    try:
+        worker = await asyncio.to_thread(get_chat_worker)
+        return await worker.precision_stats.remote.aio()
+    except Exception as e:
+        print_from_main(f"ERROR in chat-precision-stats endpoint: {str(e)}")
+        traceback.print_exc()
+        return JSONResponse({"error": "Internal server error"}, status_code=500)
+
+# -------------------- Adapter prefetch API --------------------
+@app.post("/prefetch-adapters")
+async def prefetch_adapters(request: Request):
+    """
+    Downloads and activates LoRA adapters on the chat worker before traffic arrives (e.g. after a scale-up).
+    Body (optional): {"loraIds": [...]}, at most PREFETCH_MAX_LORAS ids, most important first.
+    Defaults to the LoRAs this process served most recently.
+    """
+    try:
+        body = await request.body()
+        try:
+            data = json.loads(body) if body else {}
+        except ValueError:
+            return JSONResponse({"error": "Invalid JSON body"}, status_code=400)
+        if not isinstance(data, dict):
+            return JSONResponse({"error": "Body must be a JSON object"}, status_code=400)
+        lora_ids = data.get("loraIds")
+        if lora_ids is not None:
+            if not isinstance(lora_ids, list) or not all(isinstance(lora_id, str) and lora_id for lora_id in lora_ids):
+                return JSONResponse({"error": "loraIds must be a list of LoRA id strings"}, status_code=400)
+            if len(lora_ids) > PREFETCH_MAX_LORAS:
+                return JSONResponse({"error": f"loraIds may hold at most {PREFETCH_MAX_LORAS} ids"}, status_code=400)
+        lora_ids = lora_ids or list(reversed(recent_lora_ids))
+        if not lora_ids:
+            return {"results": {}}
+
+        env_vars_list = await asyncio.gather(*(asyncio.to_thread(get_env_vars_for_lora, lora_id) for lora_id in lora_ids))
+        adapters = [
+            {"hf_token": env_vars["hf_token"], "lora_repo": f"{env_vars['hf_username']}/{lora_id}-model"}
+            for lora_id, env_vars in zip(lora_ids, env_vars_list) if env_vars
+        ]
+
+        print_from_main(f"Prefetching {len(adapters)} adapters on the chat worker")
+        worker = await asyncio.to_thread(get_chat_worker)
+        results = await worker.prefetch_adapters.remote.aio(adapters)
+        return {"results": results}
+
+    except Exception as e:
+        print_from_main(f"ERROR in prefetch-adapters endpoint: {str(e)}")
+        traceback.print_exc()
+        return JSONResponse({"error": "Internal server error"}, status_code=500)
+
+# -------------------- Streaming chat API --------------------
+@app.post("/chat/stream")
+async def chat_stream(request: Request):
+    """
+    Same request body as /chat, but the reply is sent as server-sent events:
+    one `data: {"token": ...}` event per released piece, then `event: done` with the full reply.
+    """
+    try:
+        data = await request.json()
+        lora_id = data.get("loraid")
+        chat_history = data.get("chatHistory")
+
+        if not lora_id or not chat_history:
+            return JSONResponse({"error": "Missing loraid or chatHistory"}, status_code=400)
+        if not isinstance(chat_history, list):
+            return JSONResponse({"error": "chatHistory must be a list"}, status_code=400)
+
+        env_vars, (max_new_tokens, end_prompt, participants) = await load_chat_context(lora_id)
+        if not env_vars:
+            return JSONResponse({"error": "Creator not found for this LoRA"}, status_code=404)
+        hf_token = env_vars["hf_token"]
+        hf_username = env_vars["hf_username"]
+
+        print_from_main(f"Streaming prompt to Modal for LoRA: {lora_id}")
+
+    except Exception as e:
+        print_from_main(f"ERROR in chat stream endpoint: {str(e)}")
+        traceback.print_exc()
+        return JSONResponse({"error": "Internal server error"}, status_code=500)
+
+    async def event_stream():
+        reply = ""
+        try:
+            worker = await asyncio.to_thread(get_chat_worker)
+            async with chat_slots:
+                async for piece in worker.chat_with_lora_stream.remote_gen.aio(
+                    hf_token=hf_token,
+                    lora_repo=f"{hf_username}/{lora_id}-model",
+                    chat_history=json.dumps(chat_history),
+                    max_new_tokens=max_new_tokens,
+                    end_prompt=end_prompt,
+                    participants=participants
+                ):
+                    reply += piece
+                    yield format_sse({"token": piece})
+            yield format_sse({"response": reply}, event="done")
+        except Exception as e:
+            print_from_main(f"ERROR while streaming chat reply: {str(e)}")
+            traceback.print_exc()
+            yield format_sse({"error": "Internal server error"}, event="error")
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 # -------------------- Generate voice endpoint --------------------
 @app.post("/generate-voice")
-async def generate_voice(request: Request, background_tasks: BackgroundTasks):
+async def generate_voice(request: Request):
     try:
         data = await request.json()
         lora_id = data.get("loraId")
@@ -171,45 +366,47 @@ async def generate_voice(request: Request, background_tasks: BackgroundTasks):
         if not lora_id or not raw_text:
             return JSONResponse({"error": "Missing loraId or rawText"}, status_code=400)
 
-        env_vars = get_env_vars_for_lora(lora_id)
+        env_vars = await asyncio.to_thread(get_env_vars_for_lora, lora_id)
         if not env_vars:
             return JSONResponse({"error": "Creator not found for this LoRA"}, status_code=404)
 
-        # Convert frontend JSONL into Axolotl format
-        jsonl_str = text_to_axolotl_json(raw_text)
+        # A (re)train replaces the dataset analysis, so never serve the old one from cache
+        invalidate_dataset_analysis(lora_id)
 
-        # Split train / validation
-        train_jsonl, val_jsonl = split_train_val(jsonl_str, val_frac=0.02)
+        # Convert frontend JSONL into Axolotl train / validation files in one streaming pass
+        f_train_path, f_val_path, train_lines, val_lines, stats = await asyncio.to_thread(write_training_files, raw_text, 0.02)
 
-        # ---------- Write temp files ----------
-        with tempfile.NamedTemporaryFile(mode="w+", delete=False, suffix=".jsonl", encoding="utf-8") as f_train, \
-             tempfile.NamedTemporaryFile(mode="w+", delete=False, suffix=".jsonl", encoding="utf-8") as f_val:
-            f_train_path = f_train.name
-            f_val_path = f_val.name
-            f_train.write(train_jsonl)
-            f_val.write(val_jsonl)
-            f_train.flush()
-            f_val.flush()
+        # Training needs at least one line in each split; never start a paid pod on an empty dataset
+        if train_lines == 0 or val_lines == 0:
+            remove_files(f_train_path, f_val_path)
+            print_from_main(f"Rejecting dataset for {lora_id}: {train_lines} train / {val_lines} validation lines")
+            return JSONResponse(
+                {"error": "Not enough usable conversations in rawText (need at least two)"},
+                status_code=400
+            )
 
         # ---------- Analyze dataset ----------
         try:
-            analysis = analyze_dataset(f_train_path, participants)
-            save_dataset_analysis_to_supabase(supabase, lora_id, analysis)
+            analysis = stats.analysis(participants)
+            await asyncio.to_thread(lambda: save_dataset_analysis_to_supabase(get_supabase(), lora_id, analysis))
         except Exception as e:
             print_from_main(f"Failed to analyze dataset: {e}")
             analysis = None
 
         # ---------- Launch training in background ----------
-        background_tasks.add_task(
-            train_lora,
-            env_vars,
-            lora_id,
-            f_train_path,
-            f_val_path,
-            "lora_training_configs/lora_training_config_phi2.yaml"
-        )
-        background_tasks.add_task(delete_file_after_delay, f_train_path, 10)
-        background_tasks.add_task(delete_file_after_delay, f_val_path, 10)
+        # The scheduler owns the dataset files from here on and deletes them once uploaded
+        try:
+            await training_scheduler.submit(
+                lora_id,
+                env_vars,
+                f_train_path,
+                f_val_path,
+                "lora_training_configs/lora_training_config_phi2.yaml"
+            )
+        except ValueError as e:
+            remove_files(f_train_path, f_val_path)
+            print_from_main(f"Rejected training submission: {e}")
+            return JSONResponse({"error": str(e)}, status_code=409)
 
         return {
             "status": "processing",
@@ -241,30 +438,26 @@ async def save_env_vars(request: Request):
             "runpod_api_key": runpod_api_key
         })
 
-        # Load public key for encryption
-        public_key = serialization.load_pem_public_key(RSA_PUBLIC_KEY.encode())
-
-        encrypted = public_key.encrypt(
-            env_blob.encode(),
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None
-            )
-        )
+        _, public_key, oaep_padding = get_rsa_keys()
+        encrypted = public_key.encrypt(env_blob.encode(), oaep_padding)
 
         # Base64 encode for DB storage
         encrypted_b64 = base64.b64encode(encrypted).decode()
 
-        resp = supabase.table("profiles").update({
-            "env_vars_encrypted": encrypted_b64
-        }).eq("id", user_id).execute()
+        resp = await asyncio.to_thread(
+            lambda: get_supabase().table("profiles").update({
+                "env_vars_encrypted": encrypted_b64
+            }).eq("id", user_id).execute()
+        )
 
         print_from_main(f"Supabase response: {resp}")
 
         if not resp.data:
             return JSONResponse({"error": "Failed to update profiles table"}, status_code=500)
 
+        # Drop the stale decrypted copy so the next request picks up the new keys
+        env_vars_cache.invalidate(user_id)
+
         return {"status": "success", "message": "API keys saved successfully"}
 
     except Exception as e:
@@ -273,64 +466,30 @@ async def save_env_vars(request: Request):
         return JSONResponse({"error": "Internal server error"}, status_code=500)
 
 # -------------------- Helpers --------------------
-async def delete_file_after_delay(file_path: str, delay_seconds: int):
-    await asyncio.sleep(delay_seconds)
-    try:
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            print_from_main(f"Temp file deleted: {file_path}")
-    except Exception as e:
-        print_from_main(f"Error deleting temp file: {e}")
-
-def split_train_val(jsonl_str: str, val_frac: float = 0.02) -> tuple[str, str]:
-    lines = [line for line in jsonl_str.strip().splitlines() if line.strip()]
-    train_lines, val_lines = train_test_split(lines, test_size=val_frac, random_state=42)
-    return "\n".join(train_lines), "\n".join(val_lines)
-
-def clean_unicode(text: str) -> str:
-    replacements = {
-        "’": "'", "‘": "'", "“": '"', "”": '"', "–": "-", "—": "-", "…": "...", "•": "-", " ": " ", "\u00A0": " "
-    }
-    for bad, good in replacements.items():
-        text = text.replace(bad, good)
-    return unicodedata.normalize('NFKC', text)
-
-def remove_all_unicode_except_ascii(text: str) -> str:
-    allowed_chars = (
-        "abcdefghijklmnopqrstuvwxyz"
-        "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
-        "0123456789"
-        " ~!@#$%^&*()-=_+[]{};':\"\\|,.<>/?"
+async def load_chat_context(lora_id: str) -> tuple[dict | None, tuple[int, str, list[str]]]:
+    """
+    Fetches creator env vars and the dataset analysis for a LoRA concurrently.
+    The Supabase client is sync, so both lookups run in worker threads instead of on the event loop.
+    """
+    recent_lora_ids[lora_id] = None
+    recent_lora_ids.move_to_end(lora_id)
+    while len(recent_lora_ids) > PREFETCH_MAX_LORAS:
+        recent_lora_ids.popitem(last=False)
+
+    return await asyncio.gather(
+        asyncio.to_thread(get_env_vars_for_lora, lora_id),
+        asyncio.to_thread(lambda: get_dataset_analysis_from_supabase(get_supabase(), lora_id)),
     )
-    return "".join(c for c in text if c in allowed_chars)
 
-def text_to_axolotl_json(raw_text: str) -> str:
-    conversation_jsonl = []
-    for line in raw_text.strip().splitlines():
-        if not line.strip():
-            continue
-        try:
-            obj = json.loads(line)
-            text = remove_all_unicode_except_ascii(clean_unicode(obj.get("text", "").strip()))
-            pattern = r"(User|Assistant):\s*(.*?)(?=(User|Assistant):|$)"
-            matches = re.findall(pattern, text, flags=re.DOTALL)
-            messages = []
-            for match in matches:
-                role = "user" if match[0].lower() == "user" else "assistant"
-                content = match[1].strip()
-                if content:
-                    messages.append({"role": role, "content": content})
-            if messages:
-                conversation_jsonl.append(json.dumps({"messages": messages}, ensure_ascii=False))
-        except Exception:
-            continue
-    return "\n".join(conversation_jsonl)
+def format_sse(payload: dict, event: str | None = None) -> str:
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(payload)}\n\n"
 
 def print_from_main(message: str):
     print(f"[MAIN.PY] {message}")
 
 def fetch_env_vars_for_user(user_id: str) -> dict:
-    resp = supabase.table("profiles").select("env_vars_encrypted").eq("id", user_id).single().execute()
+    resp = get_supabase().table("profiles").select("env_vars_encrypted").eq("id", user_id).single().execute()
 
     if not resp.data or not resp.data.get("env_vars_encrypted"):
         raise ValueError("No env vars found for this user")
@@ -338,26 +497,22 @@ def fetch_env_vars_for_user(user_id: str) -> dict:
     encrypted_b64 = resp.data["env_vars_encrypted"]
     encrypted_bytes = base64.b64decode(encrypted_b64)
 
-    private_key = serialization.load_pem_private_key(
-        RSA_PRIVATE_KEY.encode(),
-        password=None,
-    )
-
-    decrypted = private_key.decrypt(
-        encrypted_bytes,
-        padding.OAEP(
-            mgf=padding.MGF1(algorithm=hashes.SHA256()),
-            algorithm=hashes.SHA256(),
-            label=None
-        )
-    )
+    private_key, _, oaep_padding = get_rsa_keys()
+    decrypted = private_key.decrypt(encrypted_bytes, oaep_padding)
 
     return json.loads(decrypted.decode())
 
 def get_env_vars_for_lora(lora_id: str) -> dict | None:
-    lora_row = supabase.table("loras").select("creator_id").eq("id", lora_id).single().execute()
-    if not lora_row.data or not lora_row.data.get("creator_id"):
-        return None
-
-    creator_id = lora_row.data["creator_id"]
-    return fetch_env_vars_for_user(creator_id)
+    creator_id = creator_id_cache.get(lora_id)
+    if creator_id is None:
+        lora_row = get_supabase().table("loras").select("creator_id").eq("id", lora_id).single().execute()
+        if not lora_row.data or not lora_row.data.get("creator_id"):
+            return None
+        creator_id = lora_row.data["creator_id"]
+        creator_id_cache.set(lora_id, creator_id)
+
+    env_vars = env_vars_cache.get(creator_id)
+    if env_vars is None:
+        env_vars = fetch_env_vars_for_user(creator_id)
+        env_vars_cache.set(creator_id, env_vars)
+    return env_vars
@@ -0,0 +1,53 @@
+# normalize_benchmark.py - throughput (MB/s) of the chat text normalization, against the implementation it replaced
+#
+#   python -m backend.normalize_benchmark [--mb 20] [--non-ascii-share 0.2]
+#
+# The legacy functions live in backend/legacy.py; backend/tests/test_dataset_pipeline.py
+# checks that the current ones produce identical output.
+
+import argparse
+import random
+import time
+
+from backend.dataset_pipeline import clean_unicode, remove_all_unicode_except_ascii
+from backend.legacy import legacy_clean_unicode, legacy_remove_all_unicode_except_ascii
+
+ASCII_WORDS = ["hey", "are", "you", "coming", "tonight?", "lol", "ok", "see", "you", "at", "8", "User:", "Assistant:"]
+NON_ASCII_WORDS = ["café", "“quoted”", "it’s", "wait…", "—", "ﬁne", "ＦＵＬＬ", "naïve", "😂", "ok\u00A0then", "•"]
+
+def sample_lines(total_bytes: int, non_ascii_share: float, seed: int = 0) -> list[str]:
+    """ Chat-like lines of ~80 chars; non_ascii_share of them contain curly quotes, ligatures, emoji etc. """
+    rng = random.Random(seed)
+    lines, size = [], 0
+    while size < total_bytes:
+        words = [rng.choice(ASCII_WORDS) for _ in range(14)]
+        if rng.random() < non_ascii_share:
+            words[rng.randrange(len(words))] = rng.choice(NON_ASCII_WORDS)
+        line = " ".join(words)
+        lines.append(line)
+        size += len(line.encode("utf-8"))
+    return lines
+
+def throughput(normalize, lines: list[str], total_mb: float) -> float:
+    started = time.perf_counter()
+    for line in lines:
+        normalize(line)
+    return total_mb / (time.perf_counter() - started)
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description="Chat text normalization throughput")
+    parser.add_argument("--mb", type=float, default=20, help="size of the synthetic export")
+    parser.add_argument("--non-ascii-share", type=float, default=0.2, help="share of lines with non-ASCII text")
+    args = parser.parse_args(argv)
+
+    lines = sample_lines(int(args.mb * 1024 * 1024), args.non_ascii_share)
+    total_mb = sum(len(line.encode("utf-8")) for line in lines) / 1024**2
+
+    legacy = throughput(lambda t: legacy_remove_all_unicode_except_ascii(legacy_clean_unicode(t)), lines, total_mb)
+    current = throughput(lambda t: remove_all_unicode_except_ascii(clean_unicode(t)), lines, total_mb)
+    print(f"📏 {total_mb:.1f} MB, {len(lines)} lines, {args.non_ascii_share:.0%} with non-ASCII text")
+    print(f"🐢 legacy:  {legacy:8.1f} MB/s")
+    print(f"🚀 current: {current:8.1f} MB/s ({current / legacy:.1f}x)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+# precision_check.py - quality of the chat worker's precision modes against a full-precision reference
+#
+#   python -m backend.precision_check                                   # tiny model on CPU (CI)
+#   python -m backend.precision_check --model microsoft/phi-2 --max-kl 0.05
+#
+# Weight modes are scored teacher-forced on fixed chat text: KL divergence to the fp32 reference,
+# top-1 agreement and perplexity. Without CUDA, int8/nf4 are simulated by quantize-dequantizing every
+# linear weight (per-row absmax int8, blockwise NF4), so the check runs anywhere; with CUDA and
+# bitsandbytes the real kernels are used. int8-kv compares greedy continuations with an 8-bit HQQ KV cache.
+
+import argparse
+import json
+import math
+import sys
+
+import torch
+import torch.nn.functional as F
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+DEFAULT_MODEL = "hf-internal-testing/tiny-random-PhiForCausalLM"
+MODES = ("fp16", "int8", "nf4", "int8-kv")
+
+# Same turn format the chat worker prompts with
+SAMPLE_TEXTS = [
+    "<|im_start|>user\nhey are you coming tonight?<|im_end|>\n<|im_start|>assistant\nyeah should be there around 8, want me to bring anything<|im_end|>\n",
+    "<|im_start|>user\ndid you see the game yesterday<|im_end|>\n<|im_start|>assistant\nno i missed it, was stuck at work until late. who won?<|im_end|>\n",
+    "<|im_start|>user\ncan you send me the notes from class<|im_end|>\n<|im_start|>assistant\nsure, give me a sec i'll take pictures and send them over<|im_end|>\n",
+]
+GREEDY_NEW_TOKENS = 32
+# Same int8 KV cache as the worker (quanto only supports 2/4 bits, HQQ does 8)
+INT8_KV_CACHE_CONFIG = {"backend": "HQQ", "nbits": 8}
+
+# NF4 levels (QLoRA): quantiles of a standard normal, scaled to [-1, 1]
+NF4_LEVELS = torch.tensor([
+    -1.0, -0.6961928009986877, -0.5250730514526367, -0.39491748809814453,
+    -0.28444138169288635, -0.18477343022823334, -0.09105003625154495, 0.0,
+    0.07958029955625534, 0.16093020141124725, 0.24611230194568634, 0.33791524171829224,
+    0.44070982933044434, 0.5626170039176941, 0.7229568362236023, 1.0,
+])
+NF4_BLOCK_SIZE = 64
+# Blocks matched against the 16 levels at once, bounding the temporary to ~256 MB for large layers
+NF4_CHUNK_BLOCKS = 65536
+
+def fake_quantize_int8(weight: torch.Tensor) -> torch.Tensor:
+    """ Per-output-row absmax int8, like LLM.int8() without its fp16 outlier columns (so slightly pessimistic). """
+    scale = weight.abs().amax(dim=1, keepdim=True).clamp(min=1e-8) / 127
+    return (weight / scale).round().clamp(-127, 127) * scale
+
+def fake_quantize_nf4(weight: torch.Tensor) -> torch.Tensor:
+    """ Blockwise absmax NF4 (bitsandbytes' 4-bit format), without double-quantizing the scales. """
+    flat = weight.flatten()
+    padding = (-flat.numel()) % NF4_BLOCK_SIZE
+    blocks = F.pad(flat, (0, padding)).view(-1, NF4_BLOCK_SIZE)
+    scale = blocks.abs().amax(dim=1, keepdim=True).clamp(min=1e-8)
+    levels = NF4_LEVELS.to(device=weight.device, dtype=weight.dtype)
+    dequantized = torch.empty_like(blocks)
+    for start in range(0, blocks.shape[0], NF4_CHUNK_BLOCKS):
+        chunk = slice(start, start + NF4_CHUNK_BLOCKS)
+        indices = ((blocks[chunk] / scale[chunk]).unsqueeze(-1) - levels).abs().argmin(dim=-1)
+        dequantized[chunk] = levels[indices] * scale[chunk]
+    return dequantized.flatten()[:flat.numel()].view_as(weight)
+
+def quantize_linear_weights(model, quantize) -> int:
+    """ Replaces every linear weight but lm_head (kept in 16 bit, as bitsandbytes does). Returns weights quantized. """
+    count = 0
+    for name, module in model.named_modules():
+        if isinstance(module, torch.nn.Linear) and not name.endswith("lm_head"):
+            module.weight.data = quantize(module.weight.data)
+            count += module.weight.numel()
+    return count
+
+def weights_mb(model, precision: str, quantized_count: int = 0) -> float:
+    """ Memory of the weights in a mode: 16-bit params plus packed int8 / NF4 weights and their scales. """
+    total = sum(p.numel() for p in model.parameters())
+    if precision == "int8":
+        packed = quantized_count * 1.0
+    elif precision == "nf4":
+        packed = quantized_count * 0.5 + quantized_count / NF4_BLOCK_SIZE * 4
+    else:
+        packed = 0.0
+    return ((total - quantized_count) * 2 + packed) / 1024**2
+
+def load_model(model_id: str, precision: str, device: str):
+    """ Returns (model, method, weights_mb) for a weight precision mode. """
+    use_bnb = precision in ("int8", "nf4") and device == "cuda"
+    if use_bnb:
+        from transformers import BitsAndBytesConfig
+
+        config = BitsAndBytesConfig(load_in_8bit=True) if precision == "int8" else BitsAndBytesConfig(
+            load_in_4bit=True, bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.float16, bnb_4bit_use_double_quant=True
+        )
+        model = AutoModelForCausalLM.from_pretrained(
+            model_id, torch_dtype=torch.float16, quantization_config=config, device_map=device
+        )
+        return model.eval(), "bitsandbytes", model.get_memory_footprint() / 1024**2
+
+    dtype = torch.float32 if precision == "fp32" else torch.float16 if device == "cuda" else torch.float32
+    model = AutoModelForCausalLM.from_pretrained(model_id, torch_dtype=dtype).to(device).eval()
+    if precision == "fp16":
+        # Round-trips through fp16 on CPU too, where half matmuls are slow or missing
+        for param in model.parameters():
+            param.data = param.data.half().to(dtype)
+        return model, "native" if device == "cuda" else "simulated", weights_mb(model, "fp16")
+    if precision in ("int8", "nf4"):
+        quantize = fake_quantize_int8 if precision == "int8" else fake_quantize_nf4
+        count = quantize_linear_weights(model, quantize)
+        return model, "simulated", weights_mb(model, precision, count)
+    return model, "native", sum(p.numel() * p.element_size() for p in model.parameters()) / 1024**2
+
+@torch.no_grad()
+def teacher_forced_logits(model, batches: list[torch.Tensor]) -> list[torch.Tensor]:
+    return [model(input_ids=ids.to(model.device)).logits[0, :-1].float().cpu() for ids in batches]
+
+def compare_logits(reference: list[torch.Tensor], candidate: list[torch.Tensor], batches: list[torch.Tensor]) -> dict:
+    """ Mean KL(reference || candidate), top-1 agreement and perplexity over every predicted position. """
+    kl_sum, agree, nll_sum, positions = 0.0, 0, 0.0, 0
+    for ref, cand, ids in zip(reference, candidate, batches):
+        ref_logp, cand_logp = F.log_softmax(ref, dim=-1), F.log_softmax(cand, dim=-1)
+        kl_sum += F.kl_div(cand_logp, ref_logp, log_target=True, reduction="sum").item()
+        agree += (ref.argmax(-1) == cand.argmax(-1)).sum().item()
+        nll_sum += F.nll_loss(cand_logp, ids[0, 1:], reduction="sum").item()
+        positions += ref.shape[0]
+    return {
+        "kl": kl_sum / positions,
+        "top1_agreement": agree / positions,
+        "perplexity": math.exp(nll_sum / positions),
+    }
+
+@torch.no_grad()
+def greedy_continuations(model, tokenizer, batches: list[torch.Tensor], **generate_kwargs) -> list[list[int]]:
+    continuations = []
+    for ids in batches:
+        # The first half of each sample is the prompt; the model continues from there
+        prompt = ids[:, :max(2, ids.shape[1] // 2)].to(model.device)
+        outputs = model.generate(
+            input_ids=prompt, attention_mask=torch.ones_like(prompt), max_new_tokens=GREEDY_NEW_TOKENS,
+            min_new_tokens=GREEDY_NEW_TOKENS, do_sample=False, pad_token_id=tokenizer.eos_token_id, **generate_kwargs
+        )
+        continuations.append(outputs[0, prompt.shape[1]:].tolist())
+    return continuations
+
+def matching_fraction(reference: list[list[int]], candidate: list[list[int]]) -> float:
+    """ Share of greedy tokens produced before the first divergence from the reference. """
+    matched, total = 0, 0
+    for ref, cand in zip(reference, candidate):
+        prefix = next((i for i, (a, b) in enumerate(zip(ref, cand)) if a != b), min(len(ref), len(cand)))
+        matched += prefix
+        total += len(ref)
+    return matched / total if total else 1.0
+
+def run(model_id: str, modes: list[str], device: str) -> dict:
+    tokenizer = AutoTokenizer.from_pretrained(model_id)
+    batches = [tokenizer(text, return_tensors="pt")["input_ids"] for text in SAMPLE_TEXTS]
+
+    reference_model, _, reference_mb = load_model(model_id, "fp32", device)
+    reference = teacher_forced_logits(reference_model, batches)
+    report = {
+        "model": model_id,
+        "device": device,
+        "reference": {"precision": "fp32", "weights_mb": reference_mb, **compare_logits(reference, reference, batches)},
+        "modes": {},
+    }
+
+    for mode in modes:
+        try:
+            if mode == "int8-kv":
+                # The worker's int8 KV cache; weights stay fp32 so only the cache differs
+                baseline = greedy_continuations(reference_model, tokenizer, batches)
+                quantized = greedy_continuations(
+                    reference_model, tokenizer, batches,
+                    cache_implementation="quantized", cache_config=dict(INT8_KV_CACHE_CONFIG)
+                )
+                report["modes"][mode] = {"method": "hqq", "greedy_agreement": matching_fraction(baseline, quantized)}
+                continue
+
+            model, method, mb = load_model(model_id, mode, device)
+            report["modes"][mode] = {
+                "method": method,
+                "weights_mb": mb,
+                **compare_logits(reference, teacher_forced_logits(model, batches), batches),
+            }
+            del model
+        except Exception as e:
+            report["modes"][mode] = {"error": str(e)}
+    return report
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Quality check of the chat worker precision modes")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=MODES)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--max-kl", type=float, default=None, help="fail if a weight mode's mean KL exceeds this")
+    parser.add_argument("--min-greedy-agreement", type=float, default=None, help="fail if int8-kv agrees less than this")
+    args = parser.parse_args(argv)
+
+    torch.manual_seed(0)
+    report = run(args.model, args.modes, args.device)
+    print(json.dumps(report, indent=2))
+
+    failed = [mode for mode, result in report["modes"].items() if "error" in result]
+    for mode, result in report["modes"].items():
+        if args.max_kl is not None and result.get("kl", 0.0) > args.max_kl:
+            failed.append(mode)
+        if args.min_greedy_agreement is not None and result.get("greedy_agreement", 1.0) < args.min_greedy_agreement:
+            failed.append(mode)
+    if failed:
+        print(f"❌ Precision check failed for: {', '.join(sorted(set(failed)))}", file=sys.stderr)
+        return 1
+    print("✅ Precision check passed", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,74 @@
+# prompt_benchmark.py - prompt building time per chat message, memoized per-turn ids vs the string prompt it replaced
+#
+#   python -m backend.prompt_benchmark                                   # 50, 500 and 5000 turns of history
+#   python -m backend.prompt_benchmark --tokenizer /path/to/tokenizer    # a local copy of phi-2's tokenizer
+#
+# For each history length the prompt for the newest message is built three ways, with the worker's budget
+# (80% of phi-2's 2048 positions):
+#   legacy: format the ChatML string turn by turn (one encode() per turn), then tokenize the whole string
+#   cold:   build_chatml_input_ids on a fresh worker, nothing memoized (first message after a container start)
+#   warm:   build_chatml_input_ids after the previous message of the same conversation (the steady state)
+# backend/tests/test_chat_with_lora.py checks that the ids are identical.
+
+import argparse
+import random
+import sys
+import time
+
+from transformers import AutoTokenizer
+
+from backend.chat_with_lora import BASE_MODEL_ID, ChatWorker, add_missing_special_tokens
+from backend.chat_worker_benchmark import sample_history
+from backend.legacy import legacy_prompt_ids
+
+HISTORY_BUDGET = int(2048 * 0.8)
+
+def prompt_worker(tokenizer) -> ChatWorker:
+    """ A ChatWorker that was never started (no model), with just the tokenizer build_chatml_input_ids uses. """
+    worker = ChatWorker()
+    worker.tokenizer = tokenizer
+    worker._newline_ids = tokenizer("\n", add_special_tokens=False)["input_ids"]
+    return worker
+
+def best_of(repeats: int, run) -> float:
+    """ Best seconds of repeats calls of run(), which returns the seconds of the part it timed. """
+    return min(run() for _ in range(repeats))
+
+def timed(function, *args) -> float:
+    started = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - started
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="ChatML prompt building benchmark")
+    parser.add_argument("--turns", type=int, nargs="+", default=[50, 500, 5000])
+    parser.add_argument("--tokenizer", default=BASE_MODEL_ID, help="Hub id or local directory")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    add_missing_special_tokens(tokenizer)
+    participants = {"user": "You", "assistant": "Assistant"}
+
+    print(f"🧪 tokenizer {args.tokenizer}, budget {HISTORY_BUDGET} tokens, best of {args.repeats}")
+    for turns in args.turns:
+        history = sample_history(random.Random(turns), turns + (turns % 2 == 0))  # ends with a user turn
+        legacy = best_of(args.repeats, lambda: timed(legacy_prompt_ids, tokenizer, history, None, participants, HISTORY_BUDGET))
+        cold = best_of(args.repeats, lambda: timed(
+            prompt_worker(tokenizer).build_chatml_input_ids, history, None, participants, HISTORY_BUDGET
+        ))
+
+        def warm() -> float:
+            worker = prompt_worker(tokenizer)
+            worker.build_chatml_input_ids(history[:-2], None, participants, HISTORY_BUDGET)
+            return timed(worker.build_chatml_input_ids, history, None, participants, HISTORY_BUDGET)
+
+        warm_s = best_of(args.repeats, warm)
+        print(
+            f"📏 {turns:5d} turns: legacy {legacy * 1e3:7.2f} ms, cold {cold * 1e3:7.2f} ms ({legacy / cold:.1f}x), "
+            f"warm {warm_s * 1e3:7.2f} ms ({legacy / warm_s:.1f}x)"
+        )
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
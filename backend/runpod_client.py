@@ -0,0 +1,287 @@
+# runpod_client.py - pooled, retrying client for the RunPod GraphQL and REST APIs
+
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+# Overridable so the client can be pointed at a local stub server
+RUNPOD_GRAPHQL_URL = os.getenv("RUNPOD_GRAPHQL_URL", "https://api.runpod.io/graphql")
+RUNPOD_REST_URL = os.getenv("RUNPOD_REST_URL", "https://rest.runpod.io/v1")
+
+RUNPOD_CONNECT_TIMEOUT = float(os.getenv("RUNPOD_CONNECT_TIMEOUT", "5"))
+RUNPOD_READ_TIMEOUT = float(os.getenv("RUNPOD_READ_TIMEOUT", "30"))
+RUNPOD_MAX_RETRIES = int(os.getenv("RUNPOD_MAX_RETRIES", "3"))
+RUNPOD_BACKOFF_SECONDS = float(os.getenv("RUNPOD_BACKOFF_SECONDS", "0.5"))
+RUNPOD_POOL_SIZE = int(os.getenv("RUNPOD_POOL_SIZE", "10"))
+# API keys are per creator; only the clients of the most recently used keys are kept
+RUNPOD_MAX_CLIENTS = int(os.getenv("RUNPOD_MAX_CLIENTS", "16"))
+
+# Rate limiting and server-side failures are worth another try; other statuses are final
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# A mutation (e.g. podFindAndDeployOnDemand) may already have run when a 5xx or a read timeout comes back,
+# so it is only resent when RunPod certainly did not process it
+NON_IDEMPOTENT_RETRYABLE_STATUSES = {429}
+
+class RunPodError(Exception):
+    """ Raised when a RunPod call still fails after every retry. """
+
+class RunPodUnknownOutcome(RunPodError):
+    """ A non-idempotent call got a 5xx or lost its connection after it was sent: RunPod may have run it. """
+
+class RunPodClient:
+    """
+    One keep-alive connection pool per API key, shared by every RunPod call of this process.
+    The sync methods use a requests.Session and the *_async methods an httpx.AsyncClient;
+    both apply the same timeouts, retry 429/5xx/connection errors with exponential backoff
+    (honouring Retry-After) and record the same request metrics. Non-idempotent calls
+    (GraphQL mutations) are only retried on 429 and on failures to connect; any other 5xx or
+    connection error after sending raises RunPodUnknownOutcome.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        graphql_url: str = RUNPOD_GRAPHQL_URL,
+        rest_url: str = RUNPOD_REST_URL,
+        connect_timeout: float = RUNPOD_CONNECT_TIMEOUT,
+        read_timeout: float = RUNPOD_READ_TIMEOUT,
+        max_retries: int = RUNPOD_MAX_RETRIES,
+        backoff_seconds: float = RUNPOD_BACKOFF_SECONDS,
+        pool_size: int = RUNPOD_POOL_SIZE,
+    ):
+        self.graphql_url = graphql_url
+        self.rest_url = rest_url.rstrip("/")
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.pool_size = pool_size
+        self.headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        }
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update(self.headers)
+
+        self._async_client = None
+        self._metrics_lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.total_seconds = 0.0
+        self.status_counts = {}
+
+    # -------------------- GraphQL --------------------
+    def graphql(self, query: str, variables: dict | None = None, idempotent: bool | None = None) -> dict:
+        """
+        Runs one GraphQL operation and returns the decoded body ({"data": ...} or {"errors": ...}).
+        idempotent defaults to False for mutations and True for queries.
+        """
+        if idempotent is None:
+            idempotent = not is_mutation(query)
+        response = self._request("POST", self.graphql_url, idempotent, json=graphql_body(query, variables))
+        return decode_body(response.status_code, response.text, response.json)
+
+    async def graphql_async(self, query: str, variables: dict | None = None, idempotent: bool | None = None) -> dict:
+        if idempotent is None:
+            idempotent = not is_mutation(query)
+        response = await self._request_async("POST", self.graphql_url, idempotent, json=graphql_body(query, variables))
+        return decode_body(response.status_code, response.text, response.json)
+
+    # -------------------- REST --------------------
+    def delete_pod(self, pod_id: str) -> tuple[int, str]:
+        """ Terminates a pod. Returns (status_code, body text). """
+        response = self._request("DELETE", f"{self.rest_url}/pods/{pod_id}", idempotent=True)
+        return response.status_code, response.text
+
+    async def delete_pod_async(self, pod_id: str) -> tuple[int, str]:
+        response = await self._request_async("DELETE", f"{self.rest_url}/pods/{pod_id}", idempotent=True)
+        return response.status_code, response.text
+
+    # -------------------- Transport --------------------
+    def _request(self, method: str, url: str, idempotent: bool, **kwargs) -> requests.Response:
+        retryable_statuses = RETRYABLE_STATUSES if idempotent else NON_IDEMPOTENT_RETRYABLE_STATUSES
+        for attempt in range(self.max_retries + 1):
+            started = time.perf_counter()
+            try:
+                response = self.session.request(
+                    method, url, timeout=(self.connect_timeout, self.read_timeout), **kwargs
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._record(None, time.perf_counter() - started)
+                if not (idempotent or request_not_sent(e)):
+                    self._record_failure()
+                    raise RunPodUnknownOutcome(f"{method} {url} failed after it was sent, not resent: {e}") from e
+                if attempt == self.max_retries:
+                    self._record_failure()
+                    raise RunPodError(f"{method} {url} failed after {attempt + 1} attempts: {e}") from e
+                time.sleep(self._backoff(attempt))
+                continue
+
+            self._record(response.status_code, time.perf_counter() - started)
+            self._raise_if_unknown_outcome(method, url, response.status_code, retryable_statuses, response.text)
+            if response.status_code not in retryable_statuses:
+                return response
+            if attempt == self.max_retries:
+                self._record_failure()
+                raise RunPodError(
+                    f"{method} {url} returned {response.status_code} after {attempt + 1} attempts: {response.text[:200]}"
+                )
+            time.sleep(self._backoff(attempt, response.headers.get("Retry-After")))
+
+    async def _request_async(self, method: str, url: str, idempotent: bool, **kwargs):
+        import httpx
+
+        retryable_statuses = RETRYABLE_STATUSES if idempotent else NON_IDEMPOTENT_RETRYABLE_STATUSES
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(
+                headers=self.headers,
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+            )
+
+        for attempt in range(self.max_retries + 1):
+            started = time.perf_counter()
+            try:
+                response = await self._async_client.request(method, url, **kwargs)
+            except (httpx.TransportError, httpx.TimeoutException) as e:
+                self._record(None, time.perf_counter() - started)
+                # Only a failed connect guarantees RunPod never saw the request
+                not_sent = isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))
+                if not (idempotent or not_sent):
+                    self._record_failure()
+                    raise RunPodUnknownOutcome(f"{method} {url} failed after it was sent, not resent: {e}") from e
+                if attempt == self.max_retries:
+                    self._record_failure()
+                    raise RunPodError(f"{method} {url} failed after {attempt + 1} attempts: {e}") from e
+                await asyncio.sleep(self._backoff(attempt))
+                continue
+
+            self._record(response.status_code, time.perf_counter() - started)
+            self._raise_if_unknown_outcome(method, url, response.status_code, retryable_statuses, response.text)
+            if response.status_code not in retryable_statuses:
+                return response
+            if attempt == self.max_retries:
+                self._record_failure()
+                raise RunPodError(
+                    f"{method} {url} returned {response.status_code} after {attempt + 1} attempts: {response.text[:200]}"
+                )
+            await asyncio.sleep(self._backoff(attempt, response.headers.get("Retry-After")))
+
+    def _raise_if_unknown_outcome(self, method: str, url: str, status_code: int, retryable_statuses: set, text: str):
+        """ A 5xx that is not retried for this call (a mutation) leaves it unknown whether RunPod ran it. """
+        if status_code in RETRYABLE_STATUSES and status_code not in retryable_statuses:
+            self._record_failure()
+            raise RunPodUnknownOutcome(f"{method} {url} returned {status_code}, not resent: {text[:200]}")
+
+    def _backoff(self, attempt: int, retry_after: str | None = None) -> float:
+        with self._metrics_lock:
+            self.retries += 1
+        if retry_after:
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                pass
+        # Exponential with full jitter so concurrent callers don't retry in lockstep
+        return random.uniform(0, self.backoff_seconds * (2 ** attempt))
+
+    # -------------------- Metrics --------------------
+    def _record(self, status_code: int | None, seconds: float):
+        key = str(status_code) if status_code is not None else "connection_error"
+        with self._metrics_lock:
+            self.requests += 1
+            self.total_seconds += seconds
+            self.status_counts[key] = self.status_counts.get(key, 0) + 1
+
+    def _record_failure(self):
+        with self._metrics_lock:
+            self.failures += 1
+
+    def metrics(self) -> dict:
+        with self._metrics_lock:
+            return {
+                "requests": self.requests,
+                "retries": self.retries,
+                "failures": self.failures,
+                "status_counts": dict(self.status_counts),
+                "avg_latency_ms": 1000 * self.total_seconds / self.requests if self.requests else 0.0,
+            }
+
+    def close(self):
+        self.session.close()
+
+    async def aclose(self):
+        self.close()
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+
+def graphql_body(query: str, variables: dict | None) -> dict:
+    body = {"query": query}
+    if variables is not None:
+        body["variables"] = variables
+    return body
+
+def is_mutation(query: str) -> bool:
+    return query.lstrip().startswith("mutation")
+
+def request_not_sent(e: requests.RequestException) -> bool:
+    """ True if the connection failed before the request went out, so resending cannot run it twice. """
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], "reason", None) if e.args else None
+    return isinstance(reason, NewConnectionError)
+
+def decode_body(status_code: int, text: str, json_decoder) -> dict:
+    """ RunPod reports GraphQL errors in the body; non-JSON bodies are turned into the same shape. """
+    try:
+        return json_decoder()
+    except ValueError:
+        return {"errors": [{"message": f"HTTP {status_code}: {text[:200]}"}]}
+
+_clients = OrderedDict()  # api key -> RunPodClient, least recently used first
+_clients_lock = threading.Lock()
+_retired_metrics = {"requests": 0, "retries": 0, "failures": 0, "status_counts": {}}
+
+def get_runpod_client(api_key: str) -> RunPodClient:
+    """
+    Returns the shared client for this API key, so its connections are reused across calls.
+    At most RUNPOD_MAX_CLIENTS are kept. An evicted client is not closed, since a job may still be polling
+    through it; its connections close once nothing refers to it, and runpod_metrics() keeps what it had recorded.
+    """
+    with _clients_lock:
+        client = _clients.get(api_key)
+        if client is None:
+            client = _clients[api_key] = RunPodClient(api_key)
+        _clients.move_to_end(api_key)
+        while len(_clients) > RUNPOD_MAX_CLIENTS:
+            _, evicted = _clients.popitem(last=False)
+            add_metrics(_retired_metrics, evicted.metrics())
+        return client
+
+def runpod_metrics() -> dict:
+    """ Request metrics summed over every client of this process, evicted ones included. """
+    with _clients_lock:
+        clients = list(_clients.values())
+        total = {"clients": len(clients), "requests": 0, "retries": 0, "failures": 0, "status_counts": {}}
+        add_metrics(total, _retired_metrics)
+    for client in clients:
+        add_metrics(total, client.metrics())
+    return total
+
+def add_metrics(total: dict, metrics: dict):
+    for key in ("requests", "retries", "failures"):
+        total[key] += metrics[key]
+    for status, count in metrics["status_counts"].items():
+        total["status_counts"][status] = total["status_counts"].get(status, 0) + count
@@ -0,0 +1,76 @@
+# split_benchmark.py - train/val split time and import cost, content-hash router vs scikit-learn's train_test_split
+#
+#   python -m backend.split_benchmark                           # 10k, 100k and 1M Axolotl lines
+#   python -m backend.split_benchmark --lines 100000 --runs 3
+#
+# split: the legacy split_train_val (backend/legacy.py) takes the whole JSONL string, splits it into a list
+# and shuffles it with train_test_split; TrainValRouter routes the same lines one at a time into two sinks.
+# import: fresh-interpreter `import` of what each splitter needs (sklearn.model_selection vs backend.dataset_pipeline),
+# measured with startup_benchmark's -X importtime run, which is what the split added to backend startup.
+
+import argparse
+import json
+import random
+import sys
+import time
+
+from backend.dataset_pipeline import TrainValRouter
+from backend.normalize_benchmark import ASCII_WORDS
+from backend.startup_benchmark import REPO_ROOT, measure
+from backend.legacy import legacy_split_train_val
+
+VAL_FRAC = 0.02
+
+def axolotl_lines(count: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    words = [word for word in ASCII_WORDS if not word.endswith(":")]
+    return [
+        json.dumps({"messages": [
+            {"role": "user" if i % 2 == 0 else "assistant", "content": " ".join(rng.choice(words) for _ in range(rng.randrange(2, 20)))}
+            for i in range(rng.randrange(2, 8))
+        ]})
+        for _ in range(count)
+    ]
+
+def route(lines: list[str]) -> tuple[list[str], list[str]]:
+    train, val = [], []
+    router = TrainValRouter(lambda line, messages: train.append(line), val.append, val_frac=VAL_FRAC)
+    for line in lines:
+        router.route(line, None)
+    router.close()
+    return train, val
+
+def best_seconds(runs: int, function, *args) -> tuple[float, object]:
+    best, result = float("inf"), None
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Train/val split benchmark")
+    parser.add_argument("--lines", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    sklearn_import = measure(REPO_ROOT, "sklearn.model_selection", args.runs)
+    pipeline_import = measure(REPO_ROOT, "backend.dataset_pipeline", args.runs)
+    print(
+        f"📦 import: sklearn.model_selection {sklearn_import['import_ms']:.0f} ms, "
+        f"backend.dataset_pipeline {pipeline_import['import_ms']:.0f} ms"
+    )
+
+    for count in args.lines:
+        lines = axolotl_lines(count)
+        jsonl_str = "\n".join(lines)
+        legacy, (_, legacy_val) = best_seconds(args.runs, legacy_split_train_val, jsonl_str, VAL_FRAC)
+        current, (_, val) = best_seconds(args.runs, route, lines)
+        print(
+            f"✂️ {count:9,d} lines: train_test_split {legacy * 1e3:8.1f} ms ({legacy_val.count(chr(10)) + 1} val), "
+            f"router {current * 1e3:8.1f} ms ({len(val)} val), {legacy / current:.1f}x"
+        )
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
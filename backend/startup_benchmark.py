@@ -0,0 +1,116 @@
+# startup_benchmark.py - import-to-ready time of the backend, from `python -X importtime`
+#
+#   python -m backend.startup_benchmark                      # this tree
+#   python -m backend.startup_benchmark --compare <ref>      # this tree vs. a git revision (commit, tag, branch)
+#   python -m backend.startup_benchmark --max-ms 400         # exit 1 above a budget (regression check)
+#
+# Each run is a fresh interpreter doing `import backend.main`, i.e. everything a uvicorn worker loads
+# before it can serve `/`. Reported: median wall time over --runs, the cumulative import time of
+# backend.main from -X importtime, and its direct imports that contribute most to it.
+# Revisions that create the Supabase client at import need NEXT_PUBLIC_SUPABASE_URL and
+# SUPABASE_SERVICE_ROLE_KEY set (any well-formed placeholder works; nothing is contacted).
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+def measure_once(root: str, module: str) -> tuple[float, int, dict[str, int]]:
+    """ Returns (wall seconds, cumulative us of module, direct import -> cumulative us). """
+    env = {**os.environ, "PYTHONPATH": root, "PYTHONDONTWRITEBYTECODE": "1"}
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=root, env=env, capture_output=True, text=True
+    )
+    wall = time.perf_counter() - started
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+
+    # Children are printed before their parent, one indentation level (2 spaces) deeper
+    lines = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            lines.append((len(match.group(3)), match.group(4), int(match.group(2))))
+    position = next(i for i, (_, name, _) in enumerate(lines) if name == module)
+    indent = lines[position][0]
+    children = {}
+    for child_indent, name, cumulative in reversed(lines[:position]):
+        if child_indent <= indent:
+            break
+        if child_indent == indent + 2:
+            children[name] = cumulative
+    return wall, lines[position][2], children
+
+def measure(root: str, module: str, runs: int) -> dict:
+    # One untimed run so the OS file cache is warm for every measured one
+    measure_once(root, module)
+    walls, mains, top_level = [], [], {}
+    for _ in range(runs):
+        wall, main_us, modules = measure_once(root, module)
+        walls.append(wall)
+        mains.append(main_us)
+        for name, us in modules.items():
+            top_level.setdefault(name, []).append(us)
+    return {
+        "wall_ms": 1000 * statistics.median(walls),
+        "module": module,
+        "import_ms": statistics.median(mains) / 1000,
+        "heaviest": sorted(
+            ((name, statistics.median(us) / 1000) for name, us in top_level.items()),
+            key=lambda item: item[1], reverse=True
+        )[:10],
+    }
+
+def export_revision(revision: str, directory: str):
+    """ Writes backend/ (and the files it reads at import) of a git revision into directory. """
+    archive = subprocess.run(
+        ["git", "archive", "--format=tar", revision, "backend", "lora_training_configs"],
+        cwd=REPO_ROOT, capture_output=True, check=True
+    ).stdout
+    archive_path = os.path.join(directory, "revision.tar")
+    with open(archive_path, "wb") as f:
+        f.write(archive)
+    with tarfile.open(archive_path) as tar:
+        tar.extractall(directory, filter="data")
+
+def report(label: str, result: dict):
+    print(f"📦 {label}: wall {result['wall_ms']:.0f} ms, import {result['module']} {result['import_ms']:.0f} ms")
+    for module, ms in result["heaviest"]:
+        print(f"     {ms:8.1f} ms  {module}")
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Backend import-to-ready benchmark")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--module", default="backend.main")
+    parser.add_argument("--compare", metavar="REF", help="also measure this git revision")
+    parser.add_argument("--max-ms", type=float, default=None, help="fail if this tree's median wall time exceeds it")
+    args = parser.parse_args(argv)
+
+    current = measure(REPO_ROOT, args.module, args.runs)
+    if args.compare:
+        with tempfile.TemporaryDirectory() as directory:
+            export_revision(args.compare, directory)
+            previous = measure(directory, args.module, args.runs)
+        report(args.compare, previous)
+        report("current", current)
+        print(f"📉 wall time {current['wall_ms'] / previous['wall_ms']:.0%} of {args.compare}")
+    else:
+        report("current", current)
+
+    if args.max_ms is not None and current["wall_ms"] > args.max_ms:
+        print(f"❌ Startup took {current['wall_ms']:.0f} ms, budget is {args.max_ms:.0f} ms", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,76 @@
+# stopping_benchmark.py - per-step cost of the stop-phrase check, incremental automaton vs the substring scan it replaced
+#
+#   python -m backend.stopping_benchmark                                   # batch 1, 8, 16 x replies of 64, 128, 256 tokens
+#   python -m backend.stopping_benchmark --batch-sizes 16 --new-tokens 512
+#
+# Both stoppers get the real stop list (ChatWorker.get_stop_convo_endings) and are called once per decoding step
+# the way generate() calls them, on token ids of chat-like text that never completes a stop phrase (every row runs
+# to the end, the worst case for both). The automaton is built once and reused across requests as on the worker,
+# so its per-token text cache is warm; the legacy stopper decodes every row's new token each step.
+# Uses phi-2's tokenizer, or chat_worker_benchmark's small byte-level BPE without Hub access.
+
+import argparse
+import random
+import sys
+import time
+
+import torch
+
+from backend.chat_with_lora import ChatWorker, KeywordMatcher, KeywordStoppingCriteria
+from backend.chat_worker_benchmark import WORDS, load_tokenizer
+from backend.legacy_generation import LegacyBatchStoppingCriteria
+
+PROMPT_TOKENS = 200
+
+def reply_token_ids(tokenizer, keywords: list[str], rng: random.Random, count: int) -> list[int]:
+    """ count token ids of chat-like text in which no stop phrase occurs. """
+    filler = [word for word in WORDS if not any(word in keyword.split() for keyword in keywords)]
+    token_ids = []
+    while len(token_ids) < count:
+        sentence = " " + " ".join(rng.choice(filler) for _ in range(rng.randrange(3, 12)))
+        token_ids += tokenizer(sentence, add_special_tokens=False)["input_ids"]
+    return token_ids[:count]
+
+def time_per_step(make_stopper, input_ids: torch.Tensor, repeats: int) -> float:
+    """ Best-of-repeats mean seconds per generate() step over the reply part of input_ids. """
+    best = float("inf")
+    for _ in range(repeats):
+        stopper = make_stopper()
+        started = time.perf_counter()
+        for length in range(PROMPT_TOKENS + 1, input_ids.shape[1] + 1):
+            if stopper(input_ids[:, :length], None).all():
+                raise RuntimeError("a stop phrase matched; the benchmark text must not contain one")
+        best = min(best, (time.perf_counter() - started) / (input_ids.shape[1] - PROMPT_TOKENS))
+    return best
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Stop-phrase check per-step overhead")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 16])
+    parser.add_argument("--new-tokens", type=int, nargs="+", default=[64, 128, 256])
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    tokenizer = load_tokenizer(pretrained=False)
+    keywords = ChatWorker.get_stop_convo_endings()
+    matcher = KeywordMatcher(tokenizer, keywords)
+    rng = random.Random(0)
+
+    print(f"🧪 {len(keywords)} stop phrases, {type(tokenizer).__name__} ({len(tokenizer)} tokens)")
+    for new_tokens in args.new_tokens:
+        for batch_size in args.batch_sizes:
+            input_ids = torch.tensor([
+                [tokenizer.eos_token_id] * PROMPT_TOKENS + reply_token_ids(tokenizer, keywords, rng, new_tokens)
+                for _ in range(batch_size)
+            ])
+            # The worker's matcher has long seen these tokens; only the first request pays for decoding them
+            time_per_step(lambda: KeywordStoppingCriteria(matcher), input_ids, 1)
+            current = time_per_step(lambda: KeywordStoppingCriteria(matcher), input_ids, args.repeats)
+            legacy = time_per_step(lambda: LegacyBatchStoppingCriteria(tokenizer, keywords), input_ids, args.repeats)
+            print(
+                f"📏 {new_tokens:4d} new tokens, batch {batch_size:3d}: legacy {legacy * 1e6:8.1f} us/step, "
+                f"automaton {current * 1e6:7.1f} us/step ({legacy / current:.1f}x)"
+            )
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
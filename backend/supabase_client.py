@@ -0,0 +1,24 @@
+# supabase_client.py - one lazily created Supabase client shared by every backend module
+
+import os
+import threading
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_supabase():
+    """
+    Returns the process-wide Supabase client.
+    The supabase package is only imported, and the client only created, on first use,
+    so importing a backend module does not pay for it.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from supabase import create_client
+                _client = create_client(
+                    os.getenv("NEXT_PUBLIC_SUPABASE_URL"),
+                    os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+                )
+    return _client
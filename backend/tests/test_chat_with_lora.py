@@ -0,0 +1,385 @@
+# test_chat_with_lora.py - the streamed reply must equal the one-shot filtered reply, however it is split into tokens;
+# the incremental stopper stops the same rows at the same step as the substring scan it replaced; prompt ids built
+# from memoized per-turn ids equal tokenizing the joined prompt string with phi-2's tokenizer; a stream, a blocking chat
+# and a speculative chat sent together are rows of the same generate() batch; prefix KV caches are only reused by the
+# model that produced them, and the next turn of a conversation alone in its batch reuses the previous one's; the
+# adapter cache evicts least recently used adapters to the warm tier within its count and byte budgets, sparing the batch's;
+# LoRAs are merged from promote_rpm on, unmerged below demote_rpm, and their merged copies never exceed max_bytes
+
+import argparse
+import json
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import torch
+from transformers import AutoTokenizer, DynamicCache
+
+from backend import chat_with_lora
+from backend.chat_with_lora import (
+    BASE_MODEL_ID, AdapterCache, ChatWorker, IncrementalReplyFilter, KeywordMatcher, KeywordStoppingCriteria,
+    MergedModelCache, PrefixKVCache, add_missing_special_tokens, filter_output, truncate_to_last_sentence
+)
+from backend.chat_worker_benchmark import sample_history, train_tokenizer, write_adapters, write_snapshot
+from backend.prompt_benchmark import prompt_worker
+from backend.legacy import legacy_prompt_ids
+from backend.legacy_generation import LegacyBatchStoppingCriteria
+
+EXAMPLES = 20000
+SEED = 1234
+
+# Pieces of every tag filter_output strips, their closers on their own, and the text around them
+FRAGMENTS = [
+    "<", ">", "|", "@", ":", "<|", "|>", "<@", "<:", "<|im_end|>", "<|im_start|>", "user", "assistant",
+    "<This message was edited", "<this MESSAGE was edited", " by", "This", " message", " was", " edited",
+    " hello", " there", "ok", "!", ".", "?", " ", "  ", "\n", "\t", "a", "b",
+]
+
+def stream(tokens: list[str]) -> str:
+    reply_filter = IncrementalReplyFilter()
+    pieces = [reply_filter.push(token) for token in tokens]
+    pieces.append(reply_filter.finish())
+    return "".join(pieces)
+
+def expected(reply: str) -> str:
+    return truncate_to_last_sentence(filter_output(reply.strip()))
+
+def random_tokens(rng: random.Random) -> list[str]:
+    reply = "".join(rng.choice(FRAGMENTS) for _ in range(rng.randrange(0, 24)))
+    # Split at random offsets, so tags and closers also break mid-token
+    cuts = sorted(rng.sample(range(1, len(reply)), min(len(reply) - 1, rng.randrange(0, 12)))) if len(reply) > 1 else []
+    return [reply[start:end] for start, end in zip([0] + cuts, cuts + [len(reply)])]
+
+def test_stray_closer_inside_open_tag():
+    # The '>' does not close '<|'; the later '|>' does, and takes the sentence before it along
+    tokens = [":", "<|im_end|>", "<", "|", ".", "|", "<", ".", ">", " hello", "!", "|>"]
+    assert stream(tokens) == expected("".join(tokens)) == ":"
+
+def test_stream_matches_one_shot_filter():
+    rng = random.Random(SEED)
+    for _ in range(EXAMPLES):
+        tokens = random_tokens(rng)
+        assert stream(tokens) == expected("".join(tokens)), repr(tokens)
+
+def test_pieces_are_released_before_the_end():
+    reply_filter = IncrementalReplyFilter()
+    assert reply_filter.push("Hey there. ") == "Hey there."
+    assert reply_filter.push("<|im_") == ""
+    assert reply_filter.push("end|> Bye!") == " Bye!"
+    assert reply_filter.finish() == ""
+
+# Token texts for the stopper test: pieces of stop phrases (so they also complete across tokens) and filler
+TOKEN_TEXTS = [
+    "good", " night", " Good", " NIGHT", "bye", "Bye", " see", " you", " later", "later", " ya", "see", " y",
+    "ou", " take", " care", " the", " end", "that", "'s", " it", " all", "cheers", " ci", "ao", "hey", " what",
+    " time", " tomorrow", " ok", ".", "!", " ", "\n", "<|im_end|>",
+]
+
+class TokenTextTokenizer:
+    """ decode() of a single id, which is all both stoppers use. """
+    def decode(self, token_ids: list[int], skip_special_tokens: bool = False) -> str:
+        return "".join(TOKEN_TEXTS[token_id] for token_id in token_ids)
+
+def test_stopper_matches_legacy_substring_scan():
+    rng = random.Random(SEED)
+    tokenizer = TokenTextTokenizer()
+    keywords = ChatWorker.get_stop_convo_endings()
+    matcher = KeywordMatcher(tokenizer, keywords)
+    for _ in range(500):
+        rows, prompt_length, steps = rng.randrange(1, 6), rng.randrange(1, 8), rng.randrange(1, 40)
+        input_ids = torch.tensor([[rng.randrange(len(TOKEN_TEXTS)) for _ in range(prompt_length + steps)] for _ in range(rows)])
+        legacy = LegacyBatchStoppingCriteria(tokenizer, keywords)
+        current = KeywordStoppingCriteria(matcher)
+        for length in range(prompt_length + 1, prompt_length + steps + 1):
+            step_ids = input_ids[:, :length]
+            assert current(step_ids, None).tolist() == legacy(step_ids, None).tolist(), input_ids.tolist()
+
+# Hub id or local directory of the tokenizer the prompt test runs against
+PROMPT_TOKENIZER = os.environ.get("PHI2_TOKENIZER", BASE_MODEL_ID)
+# Message pieces around which joining could tokenize differently: whitespace runs (phi-2 has tokens for them),
+# newlines and tabs at the edges, ChatML markers typed by a user, non-ASCII text
+MESSAGE_PIECES = [
+    "hey", " there", "ok", "lol", "!", "?", ".", " ", "  ", "    ", "\n", "\n\n", "\t", "\t\t", " \n", "<|im_end|>",
+    "<|im_start|>", "<|", "|>", "user", "assistant", "café", "😂", "“quoted”", "<|endoftext|>", "",
+]
+
+def test_turn_ids_equal_tokenizing_the_joined_prompt():
+    try:
+        tokenizer = AutoTokenizer.from_pretrained(PROMPT_TOKENIZER)
+    except OSError as e:
+        pytest.skip(f"tokenizer {PROMPT_TOKENIZER} unavailable: {e}")
+    add_missing_special_tokens(tokenizer)
+    worker = prompt_worker(tokenizer)
+
+    rng = random.Random(SEED)
+    participants = {"user": "You", "assistant": "Maddy"}
+    for _ in range(300):
+        history = [
+            {
+                "sender": rng.choice(["You", "Maddy", "Someone else"]),
+                "message": "".join(rng.choice(MESSAGE_PIECES) for _ in range(rng.randrange(0, 12))),
+            }
+            for _ in range(rng.randrange(1, 60))
+        ]
+        end_prompt = rng.choice([None, "Stay concise.", " Reply in one line.\n"])
+        max_tokens = rng.choice([40, 200, 1638])
+        # The same conversation is asked again with one more turn, so memoized turn ids are reused too
+        for turns in (len(history) - 1, len(history)):
+            args = (history[:turns], end_prompt, participants, max_tokens)
+            assert worker.build_chatml_input_ids(*args) == legacy_prompt_ids(tokenizer, *args), args
+
+def kv_cache(length: int) -> DynamicCache:
+    cache = DynamicCache()
+    cache.update(torch.zeros(1, 2, length, 4), torch.zeros(1, 2, length, 4), 0)
+    return cache
+
+def test_prefix_cache_keeps_merged_and_unmerged_apart():
+    prefix_cache = PrefixKVCache(max_entries=8, max_bytes=1 << 30, min_reuse_tokens=4)
+    prefix_cache.put(("user/lora-model", False), torch.arange(5), kv_cache(5))
+
+    # Promoted to a merged copy between turns: the PeftModel's KV must not be fed to it
+    assert prefix_cache.take(("user/lora-model", True), torch.arange(6)) == (None, 0)
+    cache, reused = prefix_cache.take(("user/lora-model", False), torch.arange(6))
+    assert reused == 5 and cache.get_seq_length() == 5
+
+def test_prefix_cache_takes_the_longest_prefix_of_a_long_enough_match():
+    model = ("user/lora-model", False)
+    prefix_cache = PrefixKVCache(max_entries=8, max_bytes=1 << 30, min_reuse_tokens=8)
+    prefix_cache.put(model, torch.arange(40), kv_cache(40))
+    prefix_cache.put(model, torch.cat([torch.arange(4), torch.arange(100, 130)]), kv_cache(34))
+
+    # The history window slid: the prompt no longer starts like either entry, so it is prefilled in full
+    assert prefix_cache.take(model, torch.arange(1, 50)) == (None, 0)
+    # Only a common opener with the second entry: it stays for the conversation it belongs to
+    assert prefix_cache.take(model, torch.cat([torch.arange(4), torch.arange(200, 220)])) == (None, 0)
+    assert len(prefix_cache.entries) == 2
+
+    cache, reused = prefix_cache.take(model, torch.cat([torch.arange(30), torch.arange(500, 510)]))
+    assert reused == 30 and cache.get_seq_length() == 30
+    assert len(prefix_cache.entries) == 1
+    # A prompt the entry covers whole still leaves one token for generate() to run on
+    cache, reused = prefix_cache.take(model, torch.cat([torch.arange(4), torch.arange(100, 120)]))
+    assert reused == 23 and cache.get_seq_length() == 23
+
+def adapter_cache(events: list, max_adapters: int = 3, max_gpu_bytes: int = 100, max_cpu_bytes: int = 100) -> AdapterCache:
+    """ Adapters are their own names; offloading one prefixes it with "cpu:" and restoring strips that again. """
+    return AdapterCache(
+        max_adapters=max_adapters,
+        max_gpu_bytes=max_gpu_bytes,
+        max_cpu_bytes=max_cpu_bytes,
+        offload_fn=lambda key, value: events.append(("offload", key)) or f"cpu:{value}",
+        restore_fn=lambda key, value: events.append(("restore", key)) or value.removeprefix("cpu:"),
+        drop_fn=lambda key, value: events.append(("drop", key))
+    )
+
+def test_adapter_cache_evicts_the_least_recently_used():
+    events = []
+    cache = adapter_cache(events)
+    for key in "abc":
+        cache.put(key, key, 10)
+    assert cache.get("a") == "a"
+
+    cache.put("d", "d", 10)
+    cache.put("e", "e", 10)
+    assert list(cache.resident) == ["a", "d", "e"]
+    assert list(cache.warm) == ["b", "c"]
+    assert events == [("offload", "b"), ("offload", "c")]
+    assert cache.stats()["evictions"] == 2
+
+def test_adapter_cache_stays_within_the_gpu_byte_budget():
+    events = []
+    cache = adapter_cache(events, max_adapters=10, max_cpu_bytes=80)
+    for key in "abc":
+        cache.put(key, key, 40)
+    assert list(cache.resident) == ["b", "c"] and cache.gpu_bytes() == 80
+
+    # One adapter as large as the budget pushes out all the others (and the warm tier keeps what fits)
+    cache.put("d", "d", 100)
+    assert list(cache.resident) == ["d"] and list(cache.warm) == ["b", "c"]
+    # One larger than the warm tier is dropped when evicted, not offloaded
+    cache.put("e", "e", 60)
+    assert list(cache.resident) == ["e"] and list(cache.warm) == ["b", "c"]
+    assert events[-1] == ("drop", "d")
+    assert cache.stats()["drops"] == 2
+
+def test_adapter_cache_restores_from_the_warm_tier():
+    events = []
+    cache = adapter_cache(events, max_cpu_bytes=20)
+    for key in "abcd":
+        cache.put(key, key, 10)
+    assert list(cache.warm) == ["a"]
+
+    # Brought back from the CPU copy, pushing the next least recently used one down
+    assert cache.get("a") == "a"
+    assert list(cache.resident) == ["c", "d", "a"] and list(cache.warm) == ["b"]
+    assert ("restore", "a") in events
+
+    # The warm tier has its own byte budget: the oldest copy is gone for good
+    cache.put("e", "e", 10)
+    cache.put("f", "f", 10)
+    assert list(cache.warm) == ["c", "d"]
+    assert "b" not in cache and cache.get("b") is None
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["warm_hits"], stats["misses"]) == (0, 1, 1)
+    assert stats["cpu_bytes"] == 20
+
+def test_adapter_cache_spares_the_adapters_of_the_current_batch():
+    events = []
+    cache = adapter_cache(events)
+    for key in "abc":
+        cache.put(key, key, 10)
+
+    # "a" is the least recently used, but the batch being prepared runs on it
+    cache.pinned = {"a", "d"}
+    cache.put("d", "d", 10)
+    assert list(cache.resident) == ["a", "c", "d"] and list(cache.warm) == ["b"]
+
+    # When only the batch's own adapters are left, the budget still wins
+    cache.pinned = {"a", "c", "d", "e"}
+    cache.put("e", "e", 10)
+    assert list(cache.resident) == ["c", "d", "e"] and list(cache.warm) == ["b", "a"]
+
+class FakeClock:
+    """ Stands in for the time module: monotonic() only moves when the test advances it. """
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+def merged_cache(monkeypatch, max_bytes: int = 100) -> tuple[MergedModelCache, FakeClock]:
+    clock = FakeClock()
+    monkeypatch.setattr(chat_with_lora, "time", clock)
+    # One minute window, so the rates are request counts
+    return MergedModelCache(max_bytes=max_bytes, promote_rpm=6, demote_rpm=2, window_seconds=60), clock
+
+def record(cache: MergedModelCache, key, requests: int):
+    for _ in range(requests):
+        cache.record(key)
+
+def test_merged_cache_promotes_and_demotes_at_its_thresholds(monkeypatch):
+    cache, clock = merged_cache(monkeypatch)
+    record(cache, "a", 5)
+    assert cache.plan("a", 40) == ([], False)
+    record(cache, "a", 1)
+    assert cache.plan("a", 40) == ([], True)
+    cache.add("a", "merged-a", 40)
+    assert cache.plan("a", 40) == ([], False)
+
+    # Between the thresholds it stays merged, so it does not flap
+    clock.now += 60
+    record(cache, "a", 2)
+    assert cache.plan("a", 40) == ([], False)
+    clock.now += 60
+    record(cache, "a", 1)
+    assert cache.plan("a", 40) == (["a"], False)
+
+    # Only one merge runs at a time
+    cache.remove("a")
+    cache.pending = "b"
+    record(cache, "a", 6)
+    assert cache.plan("a", 40) == ([], False)
+
+def test_merged_copies_stay_within_max_bytes(monkeypatch):
+    cache, clock = merged_cache(monkeypatch)
+    record(cache, "a", 8)
+    cache.add("a", "merged-a", 60)
+
+    # No room next to "a": a hotter LoRA replaces it, a colder one does not
+    record(cache, "b", 7)
+    assert cache.plan("b", 60) == ([], False)
+    record(cache, "b", 3)
+    assert cache.plan("b", 60) == (["a"], True)
+    # Room for both
+    assert cache.plan("b", 40) == ([], True)
+    # Never merged when a copy alone exceeds the budget
+    record(cache, "c", 50)
+    assert cache.plan("c", 101) == ([], False)
+
+    # A merged LoRA that cooled down makes room whatever the new one's rate
+    clock.now += 60
+    record(cache, "a", 1)
+    record(cache, "d", 6)
+    assert cache.plan("d", 100) == (["a"], True)
+
+@pytest.fixture(scope="module")
+def tiny_worker(tmp_path_factory):
+    """ A started ChatWorker on CPU: a 2-layer random Phi snapshot and two random LoRAs, both resident. """
+    directory = str(tmp_path_factory.mktemp("worker"))
+    args = argparse.Namespace(pretrained=False, config="tiny", layers=2)
+    tokenizer = train_tokenizer()
+    add_missing_special_tokens(tokenizer)  # real snapshots are saved with them already added
+    snapshot_dir = write_snapshot(directory, args, tokenizer, vocab_size=len(tokenizer))
+    adapter_paths = write_adapters(directory, snapshot_dir, 2)
+    worker = ChatWorker(snapshot_dir=snapshot_dir, adapter_cache_dir=os.path.join(directory, "adapters"), device="cpu")
+    worker.start()
+    with worker._gpu_lock:
+        for lora_repo, path in adapter_paths.items():
+            worker._activate_lora(None, lora_repo, path)
+    yield worker, list(adapter_paths)
+    worker.shutdown()
+
+def test_stream_and_chat_share_a_batch(tiny_worker, monkeypatch):
+    worker, adapters = tiny_worker
+    batches = []
+    generate_rows = worker._generate_rows
+
+    def recording_generate_rows(rows):
+        batches.append(list(rows))
+        return generate_rows(rows)
+
+    monkeypatch.setattr(worker, "_generate_rows", recording_generate_rows)
+    monkeypatch.setattr(worker, "batch_window", 1.0)  # wide enough for both requests to join the first one's batch
+
+    history = json.dumps(sample_history(random.Random(SEED), 6))
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        streamed = pool.submit(lambda: "".join(worker.chat_with_lora_stream(None, adapters[0], history, 24)))
+        reply = pool.submit(worker.chat_with_lora, None, adapters[1], history, 24)
+        streamed, reply = streamed.result(timeout=120), reply.result(timeout=120)
+
+    assert [len(rows) for rows in batches] == [2]
+    stream_row, chat_row = sorted(batches[0], key=lambda row: row.streamer is None)
+    assert stream_row.streamer is not None and chat_row.streamer is None
+    assert streamed == worker._postprocess_reply(stream_row.reply.strip())
+    assert reply == worker._postprocess_reply(chat_row.reply.strip())
+
+def test_speculative_chat_only_runs_alone(tiny_worker, monkeypatch):
+    worker, adapters = tiny_worker
+    monkeypatch.setattr(worker, "batch_window", 1.0)
+    history = json.dumps(sample_history(random.Random(SEED), 6))
+
+    def generate_calls() -> dict:
+        return {kind: totals["requests"] for kind, totals in worker.decode_stats.totals.items()}
+
+    before = generate_calls()
+    # Sent together with a plain chat it is one more row of the batch
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        chats = [
+            pool.submit(worker.chat_with_lora, None, lora_repo, history, 24, speculative=lora_repo == adapters[0])
+            for lora_repo in adapters
+        ]
+        for chat in chats:
+            chat.result(timeout=120)
+    assert {kind: calls - before[kind] for kind, calls in generate_calls().items()} == {"standard": 0, "speculative": 0, "batched": 1}
+
+    worker.chat_with_lora(None, adapters[0], history, 24, speculative=True)
+    assert {kind: calls - before[kind] for kind, calls in generate_calls().items()} == {"standard": 0, "speculative": 1, "batched": 1}
+
+def test_next_turn_reuses_the_previous_prompt(tiny_worker, monkeypatch):
+    worker, adapters = tiny_worker
+    monkeypatch.setattr(worker, "batch_window", 0.0)
+    worker.prefix_cache.clear()
+    before = worker.prefix_cache.stats()
+    history = sample_history(random.Random(SEED), 12)
+
+    worker.chat_with_lora(None, adapters[0], json.dumps(history[:9]), 8)
+    # The next turn, streamed: its shared history is not prefilled again
+    "".join(worker.chat_with_lora_stream(None, adapters[0], json.dumps(history[:11]), 8))
+
+    first, second = (worker.build_chatml_input_ids(history[:turns], max_tokens=1638) for turns in (9, 11))
+    shared = next((i for i, (a, b) in enumerate(zip(first, second)) if a != b), len(first))
+    stats = worker.prefix_cache.stats()
+    assert stats["hits"] - before["hits"] == 1 and stats["misses"] - before["misses"] == 1
+    assert stats["reused_tokens"] - before["reused_tokens"] >= shared > 0
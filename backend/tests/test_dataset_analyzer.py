@@ -0,0 +1,156 @@
+# test_dataset_analyzer.py - DatasetStats' single pass over the dataset must give the analysis the numpy analyzer it
+# replaced gave, for any messages and however they are batched; a retrain never serves the previous analysis from cache
+
+import json
+import random
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from backend import dataset_analyzer
+from backend.dataset_analyzer import (
+    DatasetStats, analyze_dataset, get_dataset_analysis_from_supabase, invalidate_dataset_analysis,
+    save_dataset_analysis_to_supabase
+)
+from backend.legacy import legacy_analyze_dataset
+from backend.tests.test_ttl_cache import fake_clock
+from backend.ttl_cache import TTLCache
+
+EXAMPLES = 500
+SEED = 1234
+
+# Slang in any case and next to word characters (which hide it from \w+ tokens), emojis and other non-ASCII
+# symbols, letters that are not emojis, and every kind of whitespace str.split() and str.strip() know
+WORD_PIECES = [
+    "hey", "ok", "sure", "lol", "LOL", "Lol", "lolz", "xlol", "lol_", "_tho", "tho", "idk", "omg", "brb", "btw",
+    "smth", "nah", "lmao", "lol!", "(idk)", "tho,", "éidk", "idké", "nah2", "😂", "🙂", "—", "…", "€", "é", "ß", "中",
+    "!", "?", ".", "'", "\u200b",
+]
+WHITESPACE = [" ", " ", "  ", "\n", "\t", "\xa0", "\u2002", "\u2009", "\u3000", "\x1c"]
+
+def random_content(rng: random.Random) -> str:
+    words = rng.choice([0, 1, 2, 3, 5, 8, 12, 20, 30, 45])
+    pieces = []
+    for _ in range(words):
+        pieces.append(rng.choice(WHITESPACE))
+        pieces.append("".join(rng.choice(WORD_PIECES) for _ in range(rng.randrange(1, 3))))
+    return "".join(pieces) + rng.choice(["", " ", "\n"])
+
+def random_dataset(rng: random.Random) -> str:
+    lines = []
+    for _ in range(rng.randrange(0, 12)):
+        messages = [
+            {"role": rng.choice(["user", "assistant"]), "content": random_content(rng)}
+            for _ in range(rng.randrange(0, 6))
+        ]
+        lines.append(json.dumps({"messages": messages}, ensure_ascii=rng.random() < 0.5))
+    return "\n".join(lines)
+
+def test_analysis_matches_legacy(tmp_path, monkeypatch):
+    # Small batches, so counts are also carried across flushes
+    monkeypatch.setattr(dataset_analyzer, "BATCH_SIZE", 4)
+    rng = random.Random(SEED)
+    path = tmp_path / "train.jsonl"
+    for _ in range(EXAMPLES):
+        path.write_text(random_dataset(rng), encoding="utf-8")
+        participants = rng.choice([None, [], ["You", "Maddy"]])
+        expected = legacy_analyze_dataset(str(path), participants)
+        result = analyze_dataset(str(path), participants)
+
+        assert result.keys() == expected.keys(), path.read_text(encoding="utf-8")
+        assert {k: v for k, v in result.items() if k != "stats"} == {k: v for k, v in expected.items() if k != "stats"}
+        if "stats" in expected:
+            # The mean is a plain sum here and numpy's pairwise sum there; the densities are exact
+            assert result["stats"]["avg_msg_len"] == pytest.approx(expected["stats"]["avg_msg_len"], rel=1e-12)
+            assert result["stats"]["emoji_density"] == expected["stats"]["emoji_density"]
+            assert result["stats"]["slang_density"] == expected["stats"]["slang_density"]
+
+def test_length_percentile_matches_numpy():
+    rng = random.Random(SEED + 1)
+    for _ in range(2000):
+        lengths = [rng.choice([0, 1, 2, 3, 5, 8, 13, 40, 200]) for _ in range(rng.randrange(1, 60))]
+        stats = DatasetStats()
+        stats.add_messages([{"content": " ".join(["w"] * length) or "."} for length in lengths])
+        stats._flush()
+        # "." is a one-word message standing in for length 0, which analysis() never sees
+        lengths = [length or 1 for length in lengths]
+        q = rng.choice([0, 5, 50, 95, 99, 100, rng.uniform(0, 100)])
+        assert stats.length_percentile(q) == pytest.approx(np.percentile(lengths, q), rel=1e-12, abs=1e-12), (lengths, q)
+
+class FakeSupabase:
+    """ The loras table, through the query chains dataset_analyzer uses; counts the selects that reach it. """
+    def __init__(self, rows: dict):
+        self.rows = rows
+        self.selects = 0
+
+    def table(self, name: str):
+        assert name == "loras"
+        return FakeQuery(self)
+
+class FakeQuery:
+    def __init__(self, db: FakeSupabase):
+        self.db = db
+        self.values = None
+        self.lora_id = None
+
+    def update(self, values: dict):
+        self.values = values
+        return self
+
+    def select(self, columns: str):
+        return self
+
+    def eq(self, column: str, value):
+        self.lora_id = value
+        return self
+
+    def single(self):
+        return self
+
+    def execute(self):
+        if self.values is not None:
+            self.db.rows[self.lora_id].update(self.values)
+            return SimpleNamespace(data=None)
+        self.db.selects += 1
+        return SimpleNamespace(data=dict(self.db.rows[self.lora_id]))
+
+@pytest.fixture
+def analysis_cache(monkeypatch):
+    cache = TTLCache(max_entries=8, ttl_seconds=300)
+    monkeypatch.setattr(dataset_analyzer, "dataset_analysis_cache", cache)
+    return cache
+
+def analysis(max_new_tokens: int) -> dict:
+    return {"max_new_tokens": max_new_tokens, "end_prompt": "\nYou:", "participants": ["You", "Maddy"]}
+
+def test_retrain_replaces_the_cached_analysis(analysis_cache):
+    db = FakeSupabase({"lora-1": {"dataset_analysis": analysis(100)}})
+    assert get_dataset_analysis_from_supabase(db, "lora-1") == (100, "\nYou:", ["You", "Maddy"])
+    assert get_dataset_analysis_from_supabase(db, "lora-1")[0] == 100
+    assert db.selects == 1
+
+    # A retrain drops the cached analysis before its new dataset is analyzed, then saves the new one
+    invalidate_dataset_analysis("lora-1")
+    assert analysis_cache.get("lora-1") is None
+    save_dataset_analysis_to_supabase(db, "lora-1", analysis(200))
+    assert db.rows["lora-1"]["dataset_analysis"]["max_new_tokens"] == 200
+    assert get_dataset_analysis_from_supabase(db, "lora-1")[0] == 200
+    assert db.selects == 1
+
+    # Without a save, the next read goes back to Supabase
+    invalidate_dataset_analysis("lora-1")
+    assert get_dataset_analysis_from_supabase(db, "lora-1")[0] == 200
+    assert db.selects == 2
+
+def test_analysis_saved_by_another_worker_is_read_after_the_ttl(analysis_cache, monkeypatch):
+    clock = fake_clock(monkeypatch)
+    db = FakeSupabase({"lora-1": {"dataset_analysis": analysis(100)}})
+    assert get_dataset_analysis_from_supabase(db, "lora-1")[0] == 100
+
+    # Retrained through another worker, whose invalidation never reached this one's cache
+    db.rows["lora-1"]["dataset_analysis"] = analysis(200)
+    clock.now += 299
+    assert get_dataset_analysis_from_supabase(db, "lora-1")[0] == 100
+    clock.now += 1
+    assert get_dataset_analysis_from_supabase(db, "lora-1")[0] == 200
@@ -0,0 +1,168 @@
+# test_dataset_pipeline.py - the fast text normalization must match the implementation it replaced byte for byte,
+# the export must be cut into the same lines str.splitlines() gave, serially or in chunks, and every dataset
+# must be split into train and validation by content alone, with about val_frac of it in validation
+
+import json
+import os
+import random
+
+from backend.dataset_pipeline import (
+    TrainValRouter, clean_unicode, convert_chunk, iter_conversations, iter_lines, remove_all_unicode_except_ascii,
+    split_at_lines, stripped_bounds, write_training_files
+)
+from backend.legacy import (
+    legacy_clean_unicode, legacy_remove_all_unicode_except_ascii, legacy_text_to_axolotl_json
+)
+
+EXAMPLES = 20000
+SEED = 1234
+
+# Where the two implementations could plausibly differ: the replacement keys, characters NFKC expands
+# into ASCII (ligatures, fullwidth, superscripts) or into replacement keys, combining marks, control chars
+INTERESTING = (
+    "’‘“”–—…• \u00A0"
+    "ﬁﬂﬀＡＺａｚ０９！？＂＇｀¹²³½™…‥\u2002\u2003\u2009\u3000"
+    "éèüñçÅ\u0301\u0308\u0327"
+    "\t\n\r\x00\x0b\x0c\x7f`"
+    "😂🙂\U0001F600\u200b\ufeff"
+)
+
+def random_text(rng: random.Random) -> str:
+    chars = []
+    for _ in range(rng.randrange(0, 40)):
+        pick = rng.random()
+        if pick < 0.4:
+            chars.append(chr(rng.randrange(32, 127)))
+        elif pick < 0.7:
+            chars.append(rng.choice(INTERESTING))
+        elif pick < 0.95:
+            chars.append(chr(rng.randrange(0x80, 0xD800)))
+        else:
+            chars.append(chr(rng.randrange(0x10000, 0x20000)))
+    return "".join(chars)
+
+def test_clean_unicode_matches_legacy():
+    rng = random.Random(SEED)
+    for _ in range(EXAMPLES):
+        text = random_text(rng)
+        assert clean_unicode(text) == legacy_clean_unicode(text), repr(text)
+
+def test_remove_all_unicode_except_ascii_matches_legacy():
+    rng = random.Random(SEED + 1)
+    for _ in range(EXAMPLES):
+        text = random_text(rng)
+        assert remove_all_unicode_except_ascii(text) == legacy_remove_all_unicode_except_ascii(text), repr(text)
+
+def test_full_normalization_matches_legacy():
+    rng = random.Random(SEED + 2)
+    for _ in range(EXAMPLES):
+        text = random_text(rng)
+        expected = legacy_remove_all_unicode_except_ascii(legacy_clean_unicode(text))
+        assert remove_all_unicode_except_ascii(clean_unicode(text)) == expected, repr(text)
+
+# Every line boundary str.splitlines() knows, JSON and non-JSON whitespace, and text around them
+LINE_PIECES = [
+    "a", "{}", " ", "é", "😂", "\n", "\r", "\r\n", "\n\n", "\x0b", "\x0c", "\x1c", "\x1d", "\x1e", "\x1f", "\x85",
+    "\u2028", "\u2029", "\xa0", "\t",
+]
+
+def random_lines(rng: random.Random) -> str:
+    return "".join(rng.choice(LINE_PIECES) for _ in range(rng.randrange(0, 20)))
+
+def test_iter_lines_matches_splitlines():
+    rng = random.Random(SEED + 3)
+    for _ in range(EXAMPLES):
+        text = random_lines(rng)
+        assert list(iter_lines(text)) == text.splitlines(), repr(text)
+        assert list(iter_lines(text, *stripped_bounds(text))) == text.strip().splitlines(), repr(text)
+
+def test_chunks_split_into_the_same_lines():
+    rng = random.Random(SEED + 4)
+    for _ in range(EXAMPLES):
+        text = random_lines(rng)
+        start, end = stripped_bounds(text)
+        chunks = list(split_at_lines(text, rng.randrange(1, 8), start, end))
+        assert "".join(chunks) == text.strip(), repr(text)
+        assert [line for chunk in chunks for line in iter_lines(chunk)] == text.strip().splitlines(), repr(text)
+
+def random_export(rng: random.Random) -> str:
+    """ Frontend JSONL lines, some broken, joined by any line boundary and padded with any whitespace. """
+    lines = []
+    for _ in range(rng.randrange(0, 8)):
+        text = " ".join(rng.choice(["User:", "Assistant:", "hi", "ok", "“yes”", "\u2028", "\x85"]) for _ in range(rng.randrange(0, 6)))
+        line = json.dumps({"text": text}, ensure_ascii=rng.random() < 0.5)
+        lines.append(rng.choice(["", " ", "\x1f", "\xa0"]) + (line if rng.random() < 0.9 else line[:-1]))
+    separators = ["\n", "\r\n", "\r", "\x0b", "\x1e", "\x85", "\u2028", "\n \n"]
+    text = "".join(line + rng.choice(separators) for line in lines)
+    return rng.choice(["", " \n", "\x1f"]) + text + rng.choice(["", "\n", " \x1f"])
+
+def test_conversion_matches_legacy():
+    rng = random.Random(SEED + 5)
+    for _ in range(2000):
+        raw_text = random_export(rng)
+        expected = legacy_text_to_axolotl_json(raw_text)
+        assert "\n".join(line for line, _ in iter_conversations(raw_text)) == expected, repr(raw_text)
+        # The parallel path's chunks, converted in-process
+        chunks = split_at_lines(raw_text, rng.randrange(1, 64), *stripped_bounds(raw_text))
+        assert "\n".join(line for chunk in chunks for line, _ in convert_chunk(chunk)) == expected, repr(raw_text)
+
+def route_all(lines: list[str], val_frac: float = 0.02, seed: int = 42) -> tuple[list[str], list[str]]:
+    train, val = [], []
+    router = TrainValRouter(lambda line, messages: train.append(line), val.append, val_frac=val_frac, seed=seed)
+    for line in lines:
+        router.route(line, [])
+    router.close()
+    return train, val
+
+def test_routing_depends_only_on_content():
+    rng = random.Random(SEED + 6)
+    lines = [f"conversation {i}" for i in range(5000)]
+    train, val = route_all(lines)
+    shuffled_train, shuffled_val = route_all(rng.sample(lines, len(lines)))
+    assert (set(shuffled_train), set(shuffled_val)) == (set(train), set(val))
+    # Every prefix of the input routes its lines as the whole input did
+    first_train, first_val = route_all(lines[:1000])
+    assert set(first_val) == set(val) & set(lines[:1000])
+    assert set(first_train) == set(train) & set(lines[:1000])
+    # The seed picks another split
+    assert set(route_all(lines, seed=7)[1]) != set(val)
+
+def test_validation_share_stays_near_target():
+    lines = [f"conversation {i}" for i in range(20000)]
+    for val_frac in (0.02, 0.1, 0.5):
+        train, val = route_all(lines, val_frac=val_frac)
+        assert len(train) + len(val) == len(lines)
+        # A few binomial standard deviations
+        assert abs(len(val) / len(lines) - val_frac) < 4 * (val_frac * (1 - val_frac) / len(lines)) ** 0.5 + 1e-9, val_frac
+
+def test_small_inputs_still_get_a_validation_line():
+    for count in range(2, 60):
+        lines = [f"conversation {i}" for i in range(count)]
+        train, val = route_all(lines)
+        assert val and train, count
+        assert sorted(train + val) == sorted(lines)
+    # A single line has to train
+    assert route_all(["conversation"]) == (["conversation"], [])
+    assert route_all([]) == ([], [])
+
+def test_training_files_split_the_export():
+    raw_text = "\n".join(
+        json.dumps({"text": f"User: question {i}\nAssistant: answer {i}"}) for i in range(30)
+    )
+    expected = [line for line, _ in iter_conversations(raw_text)]
+    expected_train, expected_val = route_all(expected)
+    for _ in range(2):
+        train_path, val_path, train_lines, val_lines, stats = write_training_files(raw_text)
+        try:
+            with open(train_path, encoding="utf-8") as f:
+                train = f.read().split("\n")
+            with open(val_path, encoding="utf-8") as f:
+                val = f.read().split("\n")
+        finally:
+            os.remove(train_path)
+            os.remove(val_path)
+        assert (train, val) == (expected_train, expected_val)
+        assert (train_lines, val_lines) == (len(train), len(val))
+        # The statistics come from the train split only
+        stats._flush()
+        assert stats.msg_count == 2 * len(train)
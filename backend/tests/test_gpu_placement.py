@@ -0,0 +1,154 @@
+# test_gpu_placement.py - the GPU catalog is fetched from RunPod once per TTL and a failed fetch is neither cached
+# nor left out of the placement stats, GPU types that just ran out of capacity are tried last until their failure
+# score decays, and a deploy whose outcome is unknown never leaves a second pod behind nor adopts the pod of an
+# earlier attempt
+
+import asyncio
+
+from backend import train_lora
+from backend.gpu_placement import GpuPlacementStats, get_gpu_catalog, gpu_catalog_cache
+from backend.tests.test_runpod_client import DEPLOYED, GPU_TYPES, UNAVAILABLE, StubRunPod
+
+GPUS = [
+    {"id": "A40", "displayName": "A40", "memoryInGb": 48},
+    {"id": "L4", "displayName": "L4", "memoryInGb": 24},
+    {"id": "A100", "displayName": "A100", "memoryInGb": 80},
+]
+
+def fetch_catalog_twice(stub: StubRunPod) -> list:
+    async def fetch():
+        client = stub.client()
+        try:
+            return [await get_gpu_catalog(client) for _ in range(2)]
+        finally:
+            await client.aclose()
+
+    gpu_catalog_cache.clear()
+    try:
+        return asyncio.run(fetch())
+    finally:
+        gpu_catalog_cache.clear()
+
+def test_catalog_is_fetched_once():
+    with StubRunPod([(200, GPU_TYPES)]) as stub:
+        catalogs = fetch_catalog_twice(stub)
+    assert catalogs == [GPU_TYPES["data"]["gpuTypes"]] * 2
+    assert len(stub.requests) == 1
+
+def test_catalog_errors_are_not_cached():
+    with StubRunPod([(200, {"errors": [{"message": "unauthorized"}]}), (200, GPU_TYPES)]) as stub:
+        catalogs = fetch_catalog_twice(stub)
+    assert catalogs == [None, GPU_TYPES["data"]["gpuTypes"]]
+    assert len(stub.requests) == 2
+
+def test_catalog_call_failing_every_retry_is_not_cached():
+    with StubRunPod([(503, UNAVAILABLE)] * 4 + [(200, GPU_TYPES)]) as stub:
+        catalogs = fetch_catalog_twice(stub)
+    assert catalogs == [None, GPU_TYPES["data"]["gpuTypes"]]
+    assert len(stub.requests) == 5
+
+def test_rank_tries_recently_failed_types_last():
+    stats = GpuPlacementStats(half_life_seconds=900)
+    assert [g["id"] for g in stats.rank(GPUS, min_memory_gb=40)] == ["A40", "A100"]
+
+    stats.record_attempt("A40", succeeded=False)
+    assert [g["id"] for g in stats.rank(GPUS, min_memory_gb=40)] == ["A100", "A40"]
+
+    # A success clears the type's failures
+    stats.record_attempt("A40", succeeded=True)
+    assert [g["id"] for g in stats.rank(GPUS, min_memory_gb=40)] == ["A40", "A100"]
+
+def test_failure_score_decays():
+    stats = GpuPlacementStats(half_life_seconds=60)
+    stats.record_attempt("A40", succeeded=False)
+    score, updated_at = stats._scores["A40"]
+    assert abs(stats.score("A40", now=updated_at + 60) - score / 2) < 1e-9
+    assert stats.score("A40", now=updated_at + 600) < 0.5  # rounds to 0: A40 is back in memory order
+
+TWO_GPU_TYPES = {"data": {"gpuTypes": GPUS[:1] + GPUS[2:]}}  # A40, then A100
+NONCE = "a1b2c3d4"
+ENV_VARS = {"runpod_api_key": "rp_test", "hf_token": "hf_test", "hf_username": "creator"}
+
+def pods(*found: tuple[str, str, str]) -> dict:
+    return {"data": {"myself": {"pods": [{"id": i, "name": name, "desiredStatus": status} for i, name, status in found]}}}
+
+def create_pod(stub: StubRunPod, monkeypatch, stats: GpuPlacementStats) -> str | None:
+    async def place():
+        client = stub.client(max_retries=1)
+        monkeypatch.setattr(train_lora, "get_runpod_client", lambda api_key: client)
+        try:
+            return await train_lora.create_pod(ENV_VARS, "lora-1", "output/lora-1", "config", "microsoft/phi-2")
+        finally:
+            await client.aclose()
+
+    monkeypatch.setattr(train_lora, "placement_stats", stats)
+    monkeypatch.setattr(train_lora, "trainer_pod_name", lambda lora_id: f"{lora_id}-trainer-{NONCE}")
+    gpu_catalog_cache.clear()
+    try:
+        return asyncio.run(place())
+    finally:
+        gpu_catalog_cache.clear()
+
+def deploys(stub: StubRunPod) -> list[str]:
+    """ gpuTypeId of every deploy mutation the stub received. """
+    return [body["variables"]["input"]["gpuTypeId"] for _, _, body in stub.requests if "variables" in body]
+
+def pod_lookups(stub: StubRunPod) -> int:
+    return sum("pods" in body["query"] for _, _, body in stub.requests)
+
+def test_deploy_5xx_adopts_the_pod_runpod_created(monkeypatch):
+    # A pod of an earlier attempt for the same LoRA is still running: only this call's pod is adopted
+    found = pods(("pod-0", "lora-1-trainer-00000000", "RUNNING"), ("pod-1", f"lora-1-trainer-{NONCE}", "RUNNING"))
+    with StubRunPod([(200, TWO_GPU_TYPES), (503, UNAVAILABLE), (200, found)]) as stub:
+        assert create_pod(stub, monkeypatch, GpuPlacementStats()) == "pod-1"
+    assert deploys(stub) == ["A40"]
+    assert pod_lookups(stub) == 1
+
+def test_deploy_rejection_moves_on_without_a_lookup(monkeypatch):
+    # A GraphQL error reply or retries spent on 429s are definite: RunPod deployed nothing
+    responses = [(200, TWO_GPU_TYPES), (200, {"errors": [{"message": "no capacity"}]}), (429, UNAVAILABLE)]
+    stats = GpuPlacementStats()
+    with StubRunPod(responses) as stub:
+        assert create_pod(stub, monkeypatch, stats) is None
+    assert deploys(stub) == ["A40", "A100", "A100"]
+    assert pod_lookups(stub) == 0
+    assert stats.snapshot()["failed_placements"] == 1
+
+def test_deploy_5xx_without_a_pod_moves_to_the_next_type(monkeypatch):
+    # Neither a stopped pod of this call nor a running one of an earlier attempt counts
+    responses = [
+        (200, TWO_GPU_TYPES), (502, UNAVAILABLE),
+        (200, pods(("pod-0", f"lora-1-trainer-{NONCE}", "EXITED"), ("pod-9", "lora-1-trainer-00000000", "RUNNING"))),
+        (200, DEPLOYED),
+    ]
+    stats = GpuPlacementStats()
+    with StubRunPod(responses) as stub:
+        assert create_pod(stub, monkeypatch, stats) == "pod-1"
+    assert deploys(stub) == ["A40", "A100"]
+
+    # The failed type is tried last next time, like one that answered with a capacity error
+    assert [g["id"] for g in stats.rank(GPUS, min_memory_gb=40)] == ["A100", "A40"]
+    snapshot = stats.snapshot()
+    assert snapshot["placements"] == 1 and snapshot["avg_attempts"] == 2
+    assert snapshot["gpu_types"]["A40"]["failures"] == 1 and snapshot["gpu_types"]["A100"]["successes"] == 1
+
+def test_failed_pod_lookup_stops_placement(monkeypatch):
+    responses = [(200, TWO_GPU_TYPES), (503, UNAVAILABLE), (200, {"errors": [{"message": "unauthorized"}]})]
+    stats = GpuPlacementStats()
+    with StubRunPod(responses) as stub:
+        assert create_pod(stub, monkeypatch, stats) is None
+    assert deploys(stub) == ["A40"]
+
+    assert [g["id"] for g in stats.rank(GPUS, min_memory_gb=40)] == ["A100", "A40"]
+    snapshot = stats.snapshot()
+    assert snapshot["failed_placements"] == 1 and snapshot["gpu_types"]["A40"]["failures"] == 1
+
+def test_catalog_failure_counts_as_a_failed_placement(monkeypatch):
+    stats = GpuPlacementStats()
+    with StubRunPod([(503, UNAVAILABLE)]) as stub:
+        assert create_pod(stub, monkeypatch, stats) is None
+    assert deploys(stub) == []
+
+    snapshot = stats.snapshot()
+    assert snapshot["placements"] == 0 and snapshot["failed_placements"] == 1
+    assert snapshot["latency_ms"]["avg"] > 0
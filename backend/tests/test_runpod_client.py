@@ -0,0 +1,132 @@
+# test_runpod_client.py - RunPodClient against a local stub of the RunPod GraphQL and REST APIs: reads are retried,
+# a deploy mutation is only resent when RunPod certainly never ran it; only the clients of recent API keys are kept
+
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from backend import runpod_client
+from backend.runpod_client import RunPodClient, RunPodError, RunPodUnknownOutcome, get_runpod_client, runpod_metrics
+
+DEPLOY_MUTATION = "mutation { podFindAndDeployOnDemand(input: {gpuTypeId: \"A40\"}) { id } }"
+GPU_TYPES_QUERY = "query { gpuTypes { id displayName memoryInGb } }"
+
+class StubRunPod:
+    """
+    Serves RunPod's GraphQL endpoint on /graphql and its REST API under /v1 from 127.0.0.1.
+    Each request gets the next scripted (status, body) response, the last one repeating;
+    every request is recorded as (method, path, decoded JSON body or None).
+    """
+    def __init__(self, responses: list[tuple[int, dict]]):
+        self.responses = list(responses)
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _respond(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                stub.requests.append((self.command, self.path, json.loads(body) if body else None))
+                status, payload = stub.responses.pop(0) if len(stub.responses) > 1 else stub.responses[0]
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                if status == 429:
+                    self.send_header("Retry-After", "0")
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_POST = do_DELETE = _respond
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def client(self, **kwargs) -> RunPodClient:
+        return RunPodClient(
+            "rp_test", graphql_url=f"{self.url}/graphql", rest_url=f"{self.url}/v1", backoff_seconds=0, **kwargs
+        )
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+GPU_TYPES = {"data": {"gpuTypes": [{"id": "A40", "displayName": "A40", "memoryInGb": 48}]}}
+DEPLOYED = {"data": {"podFindAndDeployOnDemand": {"id": "pod-1"}}}
+UNAVAILABLE = {"error": "service unavailable"}
+
+def test_query_is_retried_on_5xx():
+    with StubRunPod([(503, UNAVAILABLE), (502, UNAVAILABLE), (200, GPU_TYPES)]) as stub:
+        client = stub.client()
+        assert client.graphql(GPU_TYPES_QUERY) == GPU_TYPES
+    assert len(stub.requests) == 3
+    assert stub.requests[0] == ("POST", "/graphql", {"query": GPU_TYPES_QUERY})
+    assert client.metrics()["retries"] == 2 and client.metrics()["failures"] == 0
+
+def test_mutation_is_not_resent_on_5xx():
+    # RunPod may have deployed the pod before failing; a resend would start a second, untracked one
+    with StubRunPod([(503, UNAVAILABLE), (200, DEPLOYED)]) as stub:
+        client = stub.client()
+        with pytest.raises(RunPodUnknownOutcome):
+            client.graphql(DEPLOY_MUTATION)
+    assert len(stub.requests) == 1
+    assert client.metrics()["retries"] == 0 and client.metrics()["failures"] == 1
+
+def test_mutation_is_resent_on_429():
+    with StubRunPod([(429, UNAVAILABLE), (200, DEPLOYED)]) as stub:
+        assert stub.client().graphql(DEPLOY_MUTATION) == DEPLOYED
+    assert len(stub.requests) == 2
+
+def test_mutation_rate_limited_to_the_end_was_never_run():
+    with StubRunPod([(429, UNAVAILABLE)]) as stub:
+        with pytest.raises(RunPodError) as raised:
+            stub.client(max_retries=1).graphql(DEPLOY_MUTATION)
+    assert not isinstance(raised.value, RunPodUnknownOutcome)
+    assert len(stub.requests) == 2
+
+def test_async_mutation_is_not_resent_on_5xx():
+    async def deploy(stub: StubRunPod):
+        client = stub.client()
+        try:
+            return await client.graphql_async(DEPLOY_MUTATION)
+        finally:
+            await client.aclose()
+
+    with StubRunPod([(502, UNAVAILABLE), (200, DEPLOYED)]) as stub:
+        with pytest.raises(RunPodUnknownOutcome):
+            asyncio.run(deploy(stub))
+    assert len(stub.requests) == 1
+
+def test_delete_pod_gives_up_after_max_retries():
+    with StubRunPod([(503, UNAVAILABLE)]) as stub:
+        client = stub.client(max_retries=2)
+        with pytest.raises(RunPodError):
+            client.delete_pod("pod-1")
+    assert stub.requests == [("DELETE", "/v1/pods/pod-1", None)] * 3
+    assert client.metrics()["failures"] == 1
+
+def test_only_recent_api_keys_keep_a_client(monkeypatch):
+    monkeypatch.setattr(runpod_client, "_clients", runpod_client.OrderedDict())
+    monkeypatch.setattr(runpod_client, "_retired_metrics", {"requests": 0, "retries": 0, "failures": 0, "status_counts": {}})
+    monkeypatch.setattr(runpod_client, "RUNPOD_MAX_CLIENTS", 2)
+
+    first = get_runpod_client("rp_1")
+    first._record(200, 0.1)
+    assert get_runpod_client("rp_2") is not first and get_runpod_client("rp_1") is first
+    get_runpod_client("rp_3")  # rp_2 is the least recently used
+
+    assert list(runpod_client._clients) == ["rp_1", "rp_3"]
+    get_runpod_client("rp_4")
+    assert list(runpod_client._clients) == ["rp_3", "rp_4"]
+    # The evicted client's requests still count
+    assert runpod_metrics()["clients"] == 2 and runpod_metrics()["requests"] == 1
@@ -0,0 +1,82 @@
+# test_train_lora.py - the dataset goes to the Hub as gzip JSONL plus a sha256 manifest in a single commit,
+# and is not pushed again while the manifest lists the same contents
+
+import gzip
+import hashlib
+import json
+import os
+
+from backend.train_lora import DATASET_MANIFEST_FILE, TRAIN_DATA_FILE, VAL_DATA_FILE, upload_datasets_to_hf
+
+REPO_ID = "creator/lora-1-dataset"
+
+class FakeHfApi:
+    """ One dataset repo: commits land in files (path_in_repo -> bytes) and are recorded as lists of operations. """
+    def __init__(self, download_dir: str):
+        self.download_dir = download_dir
+        self.files = {}
+        self.commits = []
+        self.created = 0
+
+    def create_repo(self, repo_id: str, repo_type: str, exist_ok: bool = False):
+        assert (repo_id, repo_type, exist_ok) == (REPO_ID, "dataset", True)
+        self.created += 1
+
+    def create_commit(self, repo_id: str, repo_type: str, operations: list, commit_message: str):
+        assert (repo_id, repo_type) == (REPO_ID, "dataset")
+        for operation in operations:
+            content = operation.path_or_fileobj
+            if isinstance(content, str):
+                with open(content, "rb") as f:
+                    content = f.read()
+            self.files[operation.path_in_repo] = content
+        self.commits.append([operation.path_in_repo for operation in operations])
+
+    def hf_hub_download(self, repo_id: str, filename: str, repo_type: str) -> str:
+        assert (repo_id, repo_type) == (REPO_ID, "dataset")
+        if filename not in self.files:
+            raise FileNotFoundError(filename)
+        path = os.path.join(self.download_dir, filename)
+        with open(path, "wb") as f:
+            f.write(self.files[filename])
+        return path
+
+def write(path, text: str) -> str:
+    path.write_text(text, encoding="utf-8")
+    return str(path)
+
+def test_dataset_goes_up_in_one_commit(tmp_path):
+    hf_api = FakeHfApi(str(tmp_path))
+    train = '{"messages": [{"role": "user", "content": "hi"}]}\n{"messages": [{"role": "user", "content": "ok"}]}'
+    val = '{"messages": [{"role": "assistant", "content": "yes"}]}'
+    train_path, val_path = write(tmp_path / "train.jsonl", train), write(tmp_path / "val.jsonl", val)
+
+    assert upload_datasets_to_hf(hf_api, REPO_ID, train_path, val_path) is True
+    assert hf_api.commits == [[TRAIN_DATA_FILE, VAL_DATA_FILE, DATASET_MANIFEST_FILE]]
+    assert gzip.decompress(hf_api.files[TRAIN_DATA_FILE]).decode() == train
+    assert gzip.decompress(hf_api.files[VAL_DATA_FILE]).decode() == val
+    assert json.loads(hf_api.files[DATASET_MANIFEST_FILE]) == {
+        TRAIN_DATA_FILE: hashlib.sha256(train.encode()).hexdigest(),
+        VAL_DATA_FILE: hashlib.sha256(val.encode()).hexdigest(),
+    }
+    # The gzip copies are temporary
+    assert not os.path.exists(f"{train_path}.gz") and not os.path.exists(f"{val_path}.gz")
+
+def test_unchanged_dataset_is_not_uploaded_again(tmp_path):
+    hf_api = FakeHfApi(str(tmp_path))
+    train_path, val_path = write(tmp_path / "train.jsonl", "train"), write(tmp_path / "val.jsonl", "val")
+    assert upload_datasets_to_hf(hf_api, REPO_ID, train_path, val_path) is True
+    uploaded = dict(hf_api.files)
+
+    # Same contents, written again by the next retrain
+    train_path, val_path = write(tmp_path / "train2.jsonl", "train"), write(tmp_path / "val2.jsonl", "val")
+    assert upload_datasets_to_hf(hf_api, REPO_ID, train_path, val_path) is False
+    assert len(hf_api.commits) == 1 and hf_api.created == 1
+    assert not os.path.exists(f"{train_path}.gz") and not os.path.exists(f"{val_path}.gz")
+
+    # One changed file pushes both again; the unchanged one compresses to the same bytes
+    val_path = write(tmp_path / "val2.jsonl", "val, edited")
+    assert upload_datasets_to_hf(hf_api, REPO_ID, train_path, val_path) is True
+    assert len(hf_api.commits) == 2
+    assert hf_api.files[TRAIN_DATA_FILE] == uploaded[TRAIN_DATA_FILE]
+    assert hf_api.files[VAL_DATA_FILE] != uploaded[VAL_DATA_FILE]
@@ -0,0 +1,338 @@
+# test_training_scheduler.py - jobs move through the persisted state machine and resume from any state; a failed
+# job always tries to delete the pod and HF dataset recorded on it; a pod callback that reaches a worker without the
+# job's claim is finalized by the claim holder; two stores on one directory never hold the same claim
+
+import asyncio
+import os
+import tempfile
+
+import pytest
+
+from backend import train_lora as steps
+from backend.training_scheduler import JobState, TrainingJob, TrainingJobStore, TrainingScheduler
+
+ENV_VARS = {"hf_token": "hf_test", "hf_username": "creator", "runpod_api_key": "rp_test"}
+
+class FakeSteps:
+    """ Replaces the remote calls of backend.train_lora and records them. """
+    def __init__(self):
+        self.deleted_pods = []
+        self.deleted_datasets = []
+        self.statuses = []
+        self.uploads = []
+        self.started_pods = []
+        self.created_loras = []
+        self.pod_waits = []  # one event per pending wait_for_pod_ready, set by end_pod_wait
+        self.originals = {}
+
+    def __enter__(self):
+        async def delete_pod(runpod_api_key: str, pod_id: str):
+            self.deleted_pods.append((runpod_api_key, pod_id))
+
+        async def start_training_pod(env_vars: dict, lora_id: str, dataset_repo_id: str, yaml_config_path: str) -> str:
+            self.started_pods.append(lora_id)
+            return f"pod-{len(self.started_pods)}"
+
+        async def wait_for_pod_ready(runpod, pod_id: str) -> bool:
+            event = asyncio.Event()
+            self.pod_waits.append(event)
+            try:
+                await event.wait()
+            except asyncio.CancelledError:
+                self.pod_waits.remove(event)
+                raise
+            return event.ready
+
+        fakes = {
+            "add_created_lora_to_user": self.created_loras.append,
+            "check_lora_model_uploaded": lambda hf_api, hf_username, lora_id: True,
+            "delete_pod": delete_pod,
+            "delete_hf_dataset": lambda hf_api, hf_username, lora_id: self.deleted_datasets.append((hf_username, lora_id)),
+            "get_hf_api": lambda env_vars: None,
+            "get_runpod_client": lambda runpod_api_key: None,
+            "save_pod_id": lambda lora_id, pod_id: None,
+            "start_training_pod": start_training_pod,
+            "update_lora_status": lambda lora_id, status: self.statuses.append((lora_id, status)),
+            "upload_datasets_to_hf": lambda hf_api, dataset_repo_id, train_path, val_path: self.uploads.append(dataset_repo_id),
+            "wait_for_pod_ready": wait_for_pod_ready,
+        }
+        for name, fake in fakes.items():
+            self.originals[name] = getattr(steps, name)
+            setattr(steps, name, fake)
+        return self
+
+    def __exit__(self, *exc):
+        for name, original in self.originals.items():
+            setattr(steps, name, original)
+
+    def end_pod_wait(self, ready: bool):
+        """ Lets the pending wait_for_pod_ready return ready. """
+        event = self.pod_waits.pop()
+        event.ready = ready
+        event.set()
+
+def flaky_loader(failures: int):
+    """ env_vars_loader that raises on its first failures calls, like a Supabase outage. """
+    calls = []
+
+    def load(lora_id: str) -> dict:
+        calls.append(lora_id)
+        if len(calls) <= failures:
+            raise ConnectionError("Supabase unavailable")
+        return ENV_VARS
+    return load
+
+def fail_while_finalizing(loader) -> TrainingJob:
+    with tempfile.TemporaryDirectory() as directory:
+        scheduler = TrainingScheduler(env_vars_loader=loader, store=TrainingJobStore(directory))
+        job = TrainingJob("lora-1", state=JobState.FINALIZING, pod_id="pod-1")
+        scheduler.jobs[job.lora_id] = job
+        asyncio.run(scheduler._finalize(job))
+        return job
+
+def test_failed_env_var_load_still_releases_the_recorded_pod():
+    with FakeSteps() as fake:
+        job = fail_while_finalizing(flaky_loader(failures=1))
+    assert job.state == JobState.FAILED
+    assert fake.deleted_pods == [("rp_test", "pod-1")]
+    assert fake.deleted_datasets == [("creator", "lora-1")]
+
+def test_job_still_fails_when_keys_stay_unavailable():
+    with FakeSteps() as fake:
+        job = fail_while_finalizing(flaky_loader(failures=2))
+    assert job.state == JobState.FAILED
+    assert fake.deleted_pods == [] and fake.deleted_datasets == []
+    assert fake.statuses == [("lora-1", steps.LoraStatus.TRAINING_FAILED)]
+
+def test_failed_upload_deletes_the_partial_dataset_repo():
+    def failing_upload(hf_api, dataset_repo_id, train_path, val_path):
+        raise ConnectionError("upload interrupted")
+
+    async def scenario(directory: str):
+        scheduler = TrainingScheduler(env_vars_loader=lambda lora_id: ENV_VARS, store=TrainingJobStore(directory))
+        train_path, val_path = dataset_files(directory)
+        job = TrainingJob("lora-1", CONFIG, train_path, val_path)
+        scheduler.jobs[job.lora_id] = job
+        await scheduler._run(job, ENV_VARS)
+        return job
+
+    with FakeSteps() as fake, tempfile.TemporaryDirectory() as directory:
+        steps.upload_datasets_to_hf = failing_upload
+        job = asyncio.run(scenario(directory))
+    assert job.state == JobState.FAILED
+    assert fake.deleted_datasets == [("creator", "lora-1")] and fake.deleted_pods == []
+
+def test_callback_to_another_worker_is_finalized_by_the_owner():
+    async def scenario(directory: str, fake: FakeSteps) -> tuple:
+        owner = TrainingScheduler(env_vars_loader=lambda lora_id: ENV_VARS, store=TrainingJobStore(directory))
+        other = TrainingScheduler(env_vars_loader=lambda lora_id: ENV_VARS, store=TrainingJobStore(directory))
+        job = TrainingJob("lora-1", state=JobState.PROVISIONING, pod_id="pod-1")
+        assert owner.store.claim(job.lora_id)
+        owner.store.save(job)
+        owner.jobs[job.lora_id] = job
+        owner._spawn(job, owner._run(job, ENV_VARS))
+        await asyncio.sleep(0)  # the owner is now waiting for the pod
+
+        # The pod found no CUDA and called back at once; the callback is answered without waiting for the claim
+        recorded = await asyncio.wait_for(other.notify_finished("lora-1", "pod-1", cuda_not_available=True), 1)
+        # The pod exits, which ends the owner's wait
+        fake.end_pod_wait(ready=False)
+        while owner.tasks:
+            await asyncio.gather(*owner.tasks.values())
+        return recorded, job
+
+    with FakeSteps() as fake, tempfile.TemporaryDirectory() as directory:
+        recorded, job = asyncio.run(scenario(directory, fake))
+        assert not TrainingJobStore(directory).has_finish_request("lora-1")
+    assert recorded.state == JobState.PROVISIONING
+    assert job.state == JobState.FAILED and job.cuda_not_available
+    assert job.error == "LoRA model not found on Hugging Face"
+    assert fake.statuses == [("lora-1", steps.LoraStatus.TRAINING_FAILED)]
+    assert fake.deleted_pods == [("rp_test", "pod-1")]
+
+CONFIG = "lora_training_configs/lora_training_config_phi2.yaml"
+
+def scheduler_on(directory) -> TrainingScheduler:
+    return TrainingScheduler(env_vars_loader=lambda lora_id: ENV_VARS, store=TrainingJobStore(str(directory)))
+
+def dataset_files(directory, lora_id: str = "lora-1") -> tuple[str, str]:
+    paths = []
+    for split in ("train", "val"):
+        path = os.path.join(directory, f"{lora_id}.{split}.upload.jsonl")
+        with open(path, "w") as f:
+            f.write('{"messages": []}\n')
+        paths.append(path)
+    return tuple(paths)
+
+async def settle(scheduler: TrainingScheduler, fake: FakeSteps):
+    """ Lets the scheduler's tasks run until each one has finished or is waiting for its pod. """
+    for _ in range(500):
+        await asyncio.sleep(0.01)  # first lets cancelled tasks unwind
+        if len([task for task in scheduler.tasks.values() if not task.done()]) == len(fake.pod_waits):
+            return
+    raise TimeoutError("training job tasks did not settle")
+
+def test_submit_runs_the_job_until_the_pod_is_up(tmp_path):
+    async def scenario(fake: FakeSteps):
+        scheduler = scheduler_on(tmp_path / "jobs")
+        job = await scheduler.submit("lora-1", ENV_VARS, *dataset_files(tmp_path), CONFIG)
+        await settle(scheduler, fake)
+        waiting = scheduler.store.load("lora-1")
+        fake.end_pod_wait(ready=True)
+        await settle(scheduler, fake)
+        return scheduler, job, waiting
+
+    with FakeSteps() as fake:
+        scheduler, job, waiting = asyncio.run(scenario(fake))
+    assert waiting.state == JobState.PROVISIONING and waiting.pod_id == "pod-1"
+    assert job.state == JobState.RUNNING and scheduler.store.load("lora-1").state == JobState.RUNNING
+    assert fake.uploads == ["creator/lora-1-dataset"] and fake.started_pods == ["lora-1"]
+    assert fake.statuses == [("lora-1", steps.LoraStatus.TRAINING)]
+    # Running jobs are let go: the datasets are gone and any worker can take the callback
+    assert not os.path.exists(job.train_path) and not os.path.exists(job.val_path)
+    assert scheduler.jobs == {} and TrainingJobStore(str(tmp_path / "jobs")).claim("lora-1")
+
+def test_duplicate_submit_is_rejected_while_another_worker_holds_the_job(tmp_path):
+    async def scenario(fake: FakeSteps):
+        owner, other = scheduler_on(tmp_path / "jobs"), scheduler_on(tmp_path / "jobs")
+        await owner.submit("lora-1", ENV_VARS, *dataset_files(tmp_path), CONFIG)
+        await settle(owner, fake)
+        with pytest.raises(ValueError):
+            await other.submit("lora-1", ENV_VARS, *dataset_files(tmp_path / "again"), CONFIG)
+
+    (tmp_path / "again").mkdir()
+    with FakeSteps() as fake:
+        asyncio.run(scenario(fake))
+    # The rejected submit leaves its datasets where they were
+    assert sorted(os.listdir(tmp_path / "again")) == ["lora-1.train.upload.jsonl", "lora-1.val.upload.jsonl"]
+    assert fake.started_pods == ["lora-1"]
+
+def test_callback_for_own_provisioning_job_finalizes_it(tmp_path):
+    async def scenario(fake: FakeSteps):
+        scheduler = scheduler_on(tmp_path / "jobs")
+        job = await scheduler.submit("lora-1", ENV_VARS, *dataset_files(tmp_path), CONFIG)
+        await settle(scheduler, fake)
+        assert await scheduler.notify_finished("lora-1", "pod-1") is job
+        # A repeated callback while finalizing is acknowledged without starting over
+        assert await scheduler.notify_finished("lora-1", "pod-1") is None
+        await settle(scheduler, fake)
+        return job
+
+    with FakeSteps() as fake:
+        job = asyncio.run(scenario(fake))
+    assert job.state == JobState.COMPLETED
+    assert fake.created_loras == ["lora-1"]
+    assert fake.statuses[-1] == ("lora-1", steps.LoraStatus.TRAINING_COMPLETED)
+    assert fake.deleted_pods == [("rp_test", "pod-1")] and fake.deleted_datasets == [("creator", "lora-1")]
+
+def test_callback_for_running_job_is_finalized_by_the_receiving_worker(tmp_path):
+    async def scenario(fake: FakeSteps):
+        scheduler = scheduler_on(tmp_path)
+        scheduler.store.save(TrainingJob("lora-1", state=JobState.RUNNING, pod_id="pod-1"))
+        job = await scheduler.notify_finished("lora-1", "pod-1")
+        await settle(scheduler, fake)
+        return job
+
+    with FakeSteps() as fake:
+        job = asyncio.run(scenario(fake))
+    assert job.state == JobState.COMPLETED and fake.deleted_pods == [("rp_test", "pod-1")]
+
+def test_callback_while_the_pod_is_being_created_is_rejected(tmp_path):
+    async def scenario(fake: FakeSteps):
+        pod_created = asyncio.Event()
+        start_training_pod = steps.start_training_pod
+
+        async def slow_start_training_pod(*args):
+            await pod_created.wait()
+            return await start_training_pod(*args)
+
+        steps.start_training_pod = slow_start_training_pod
+        owner, other = scheduler_on(tmp_path / "jobs"), scheduler_on(tmp_path / "jobs")
+        job = await owner.submit("lora-1", ENV_VARS, *dataset_files(tmp_path), CONFIG)
+        while job.state != JobState.PROVISIONING:
+            await asyncio.sleep(0.01)
+
+        # A stale pod id must not cancel the job while create_pod runs, on this worker or another
+        for scheduler in (owner, other):
+            with pytest.raises(ValueError):
+                await scheduler.notify_finished("lora-1", "old-pod")
+        assert not other.store.has_finish_request("lora-1")
+
+        pod_created.set()
+        await settle(owner, fake)
+        fake.end_pod_wait(ready=True)
+        await settle(owner, fake)
+        return job
+
+    with FakeSteps() as fake:
+        job = asyncio.run(scenario(fake))
+    assert job.state == JobState.RUNNING and job.pod_id == "pod-1"
+    assert fake.deleted_pods == []
+
+@pytest.mark.parametrize("state", [JobState.COMPLETED, JobState.FAILED])
+def test_callback_for_finished_job_is_ignored(tmp_path, state):
+    scheduler = scheduler_on(tmp_path)
+    scheduler.store.save(TrainingJob("lora-1", state=state, pod_id="pod-1"))
+    with FakeSteps() as fake:
+        assert asyncio.run(scheduler.notify_finished("lora-1", "pod-1")) is None
+    assert scheduler.store.load("lora-1").state == state
+    assert not scheduler.store.has_finish_request("lora-1") and fake.deleted_pods == []
+
+@pytest.mark.parametrize("state", [JobState.QUEUED, JobState.UPLOADING])
+def test_callback_before_the_job_has_a_pod_is_rejected(tmp_path, state):
+    scheduler = scheduler_on(tmp_path)
+    scheduler.store.save(TrainingJob("lora-1", state=state))
+    with pytest.raises(ValueError):
+        asyncio.run(scheduler.notify_finished("lora-1", "pod-1"))
+    assert not scheduler.store.has_finish_request("lora-1")
+
+# (state, pod_id) on disk when the previous process died -> state after resume, datasets uploaded, pods started
+RESUMED = {
+    "queued": (JobState.QUEUED, None, JobState.RUNNING, 1, 1),
+    "uploading": (JobState.UPLOADING, None, JobState.RUNNING, 1, 1),
+    "provisioning without pod": (JobState.PROVISIONING, None, JobState.RUNNING, 0, 1),
+    "provisioning with pod": (JobState.PROVISIONING, "pod-0", JobState.RUNNING, 0, 0),
+    "running": (JobState.RUNNING, "pod-0", JobState.RUNNING, 0, 0),
+    "finalizing": (JobState.FINALIZING, "pod-0", JobState.COMPLETED, 0, 0),
+}
+
+@pytest.mark.parametrize("crashed_in", list(RESUMED))
+def test_resume_continues_from_the_persisted_state(tmp_path, crashed_in):
+    state, pod_id, resumed_state, uploads, started_pods = RESUMED[crashed_in]
+
+    async def scenario(fake: FakeSteps):
+        train_path, val_path = dataset_files(tmp_path)
+        TrainingJobStore(str(tmp_path)).save(TrainingJob("lora-1", CONFIG, train_path, val_path, state=state, pod_id=pod_id))
+        scheduler = scheduler_on(tmp_path)
+        await scheduler.resume()
+        await settle(scheduler, fake)
+        while fake.pod_waits:
+            fake.end_pod_wait(ready=True)
+            await settle(scheduler, fake)
+        return scheduler.store.load("lora-1")
+
+    with FakeSteps() as fake:
+        job = asyncio.run(scenario(fake))
+    assert job.state == resumed_state
+    assert len(fake.uploads) == uploads and len(fake.started_pods) == started_pods
+
+@pytest.mark.parametrize("state", [JobState.COMPLETED, JobState.FAILED])
+def test_resume_drops_finished_job_records(tmp_path, state):
+    store = TrainingJobStore(str(tmp_path))
+    store.save(TrainingJob("lora-1", state=state))
+    with FakeSteps():
+        asyncio.run(scheduler_on(tmp_path).resume())
+    assert store.load("lora-1") is None
+
+def test_claim_is_exclusive_across_stores(tmp_path):
+    first, second = TrainingJobStore(str(tmp_path)), TrainingJobStore(str(tmp_path))
+    assert first.claim("lora-1") and first.claim("lora-1")  # a store's own claim is taken again
+    assert not second.claim("lora-1")
+    assert second.claim("lora-2")
+
+    first.release("lora-1")
+    assert second.claim("lora-1") and not first.claim("lora-1")
+
+    # A worker that dies drops its lock without unlinking the lock file
+    os.close(second._claims.pop("lora-1"))
+    assert first.claim("lora-1")
@@ -0,0 +1,64 @@
+# test_ttl_cache.py - entries expire ttl_seconds after they were set, however often they are read, and the least
+# recently used entry goes first once max_entries is reached
+
+from backend import ttl_cache
+from backend.ttl_cache import TTLCache
+
+class FakeClock:
+    """ Stands in for the time module: monotonic() only moves when the test advances it. """
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+def fake_clock(monkeypatch) -> FakeClock:
+    clock = FakeClock()
+    monkeypatch.setattr(ttl_cache, "time", clock)
+    return clock
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    cache = TTLCache(max_entries=8, ttl_seconds=300)
+    cache.set("a", 1)
+
+    clock.now += 299
+    # Reading an entry does not extend its life
+    assert cache.get("a") == 1
+    clock.now += 1
+    assert cache.get("a") is None
+    assert cache.get("a", "default") == "default"
+    assert cache.stats()["size"] == 0
+
+    # Setting it again starts a new ttl
+    cache.set("a", 2)
+    clock.now += 299
+    cache.set("a", 3)
+    clock.now += 299
+    assert cache.get("a") == 3
+    assert (cache.hits, cache.misses) == (2, 2)
+
+def test_least_recently_used_entry_goes_first(monkeypatch):
+    fake_clock(monkeypatch)
+    cache = TTLCache(max_entries=3, ttl_seconds=300)
+    for key in "abc":
+        cache.set(key, key)
+    assert cache.get("a") == "a"
+
+    cache.set("d", "d")
+    assert cache.get("b") is None
+    cache.set("c", "c2")
+    cache.set("e", "e")
+    assert [cache.get(key) for key in "acde"] == [None, "c2", "d", "e"]
+    assert cache.stats()["size"] == 3
+
+def test_invalidate_and_clear(monkeypatch):
+    fake_clock(monkeypatch)
+    cache = TTLCache(max_entries=8, ttl_seconds=300)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.invalidate("a")
+    cache.invalidate("missing")
+    assert cache.get("a") is None and cache.get("b") == 2
+    cache.clear()
+    assert cache.get("b") is None
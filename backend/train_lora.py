@@ -1,13 +1,21 @@
-# The python training script (starting a pod, training, closing the pod, ... , checking hf)
+# The python training steps (uploading datasets, starting a pod, waiting for it, closing the pod, ... , checking hf)
+# Every step takes the creator's credentials explicitly; training_scheduler.py runs them in order per job.
 
+import asyncio
+import gzip
+import hashlib
+import json
 import os
+import secrets
 import time
-import requests
 from dotenv import load_dotenv
-from huggingface_hub import HfApi
-from supabase import create_client
+from huggingface_hub import CommitOperationAdd, HfApi
 from enum import Enum
 
+from backend.gpu_placement import get_gpu_catalog, placement_stats
+from backend.runpod_client import RunPodClient, RunPodError, RunPodUnknownOutcome, get_runpod_client
+from backend.supabase_client import get_supabase
+
 class LoraStatus(str, Enum):
     TRAINING = "training"
     TRAINING_COMPLETED = "training completed"
@@ -21,6 +29,7 @@ TABLE_PROFILES = "profiles"
 COL_LORA_ID = "id"
 COL_LORA_STATUS = "training_status"
 COL_CREATOR_ID = "creator_id"
+COL_POD_ID = "pod_id"
 
 # Column names in 'profiles' table
 COL_PROFILE_ID = "id"
@@ -34,107 +43,115 @@ BASE_MODEL_MAP = {
 # Load environment variables
 env_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.env.local'))
 load_dotenv(dotenv_path=env_path)
-supabase = create_client(os.getenv('NEXT_PUBLIC_SUPABASE_URL'), os.getenv('SUPABASE_SERVICE_ROLE_KEY'))
-
-HF_API = None
-HF_TOKEN = None
-HF_USERNAME = None
-RUNPOD_API_KEY = None
-
-def train_lora(env_vars: dict, lora_id: str, train_file_path: str, val_file_path: str, yaml_config_path: str):
-    """
-    Launch LoRA training pipeline using RunPod with optional validation dataset.
-    """
-    
-    # Setting gloal env vars
-    global HF_API, HF_TOKEN, HF_USERNAME, RUNPOD_API_KEY
-    HF_TOKEN = env_vars["hf_token"]
-    HF_API = HfApi(token=HF_TOKEN)
-    HF_USERNAME = env_vars["hf_username"]
-    RUNPOD_API_KEY = env_vars["runpod_api_key"]
-    
-    if BASE_MODEL_MAP.get(yaml_config_path) is None:
-        print(f"❌ No base model mapping found for config {yaml_config_path}")
-        update_lora_status(lora_id, LoraStatus.TRAINING_FAILED)
-        return
-
-    dataset_repo_id = get_hf_dataset_repo_id(lora_id)
-    update_lora_status(lora_id, LoraStatus.TRAINING)
 
-    try:
-        # Upload training dataset to Hugging Face
-        upload_dataset_to_hf(train_file_path, dataset_repo_id)
-
-        # Upload validation dataset
-        val_repo_id = f"{dataset_repo_id}-val"
-        upload_dataset_to_hf(val_file_path, val_repo_id)
-
-        # Start pod with dataset repo
-        pod_id = start_training_pipeline(lora_id, dataset_repo_id, val_repo_id, yaml_config_path)
+# Train and val go to one dataset repo as gzip JSONL (read natively by Axolotl / datasets' json loader),
+# next to a manifest of the uncompressed contents' sha256 so an unchanged dataset is not pushed again
+TRAIN_DATA_FILE = "train.jsonl.gz"
+VAL_DATA_FILE = "val.jsonl.gz"
+DATASET_MANIFEST_FILE = "manifest.json"
+COPY_CHUNK_BYTES = 1024 * 1024
+
+MIN_GPU_MEMORY_GB = 40
+
+# Pod readiness: poll the one pod by id, backing off from the initial to the max interval
+POD_POLL_INITIAL_SECONDS = float(os.getenv("POD_POLL_INITIAL_SECONDS", "10"))
+POD_POLL_MAX_SECONDS = float(os.getenv("POD_POLL_MAX_SECONDS", "120"))
+POD_READY_TIMEOUT_SECONDS = float(os.getenv("POD_READY_TIMEOUT_SECONDS", "3000"))
+
+POD_QUERY = """
+query Pod($input: PodFilter) {
+    pod(input: $input) {
+        id
+        desiredStatus
+        runtime { uptimeInSeconds }
+    }
+}
+"""
 
-        if not pod_id:
-            print("❌ Failed to start training pipeline.")
-            update_lora_status(lora_id, LoraStatus.TRAINING_FAILED)
-            cleanup(train_file_path)
-            cleanup(val_file_path)
-            return
+PODS_QUERY = """
+query Pods {
+    myself {
+        pods { id name desiredStatus }
+    }
+}
+"""
 
-        _ = supabase.table(TABLE_LORAS).update({"pod_id": pod_id}).eq(COL_LORA_ID, lora_id).execute()
-        print(f"✅ Pod ID {pod_id} saved to database for LoRA {lora_id}.")
+def get_hf_api(env_vars: dict) -> HfApi:
+    return HfApi(token=env_vars["hf_token"])
 
-    except Exception as e:
-        print(f"❌ Training pipeline error: {e}")
-        update_lora_status(lora_id, LoraStatus.TRAINING_FAILED)
-        cleanup(train_file_path)
-        cleanup(val_file_path)
-
-def finalize_training(runpod_api_key: str, lora_id: str, pod_id: str, cuda_not_available: bool = False):
-    """ Finalize the training process based on the status received from the pod """
-
-    if cuda_not_available:
-        update_lora_status(lora_id, LoraStatus.TRAINING_FAILED)
-        print(f"❌ LoRA {lora_id} pod had no CUDA, marked as failed")
-        return {"status": "failed", "message": "CUDA not available"}
-    
-    print("⏳ Checking if LoRA model is available on Hugging Face...")
-    if check_lora_model_uploaded(lora_id):
-        print(f"✅ LoRA model {lora_id} found on Hugging Face.")
-        add_created_lora_to_user(lora_id)
-        update_lora_status(lora_id, LoraStatus.TRAINING_COMPLETED)
-    else:
-        print(f"❌ LoRA model {lora_id} not found on Hugging Face.")
-        update_lora_status(lora_id, LoraStatus.TRAINING_FAILED)
-    
-    # delete HF dataset
-    delete_hf_dataset(lora_id)
-
-    if pod_id:
-        delete_pod(runpod_api_key, pod_id)
-
-def upload_dataset_to_hf(dataset_file_path: str, dataset_repo_id: str):
+def upload_datasets_to_hf(hf_api: HfApi, dataset_repo_id: str, train_file_path: str, val_file_path: str) -> bool:
+    """
+    Pushes train and val as gzip JSONL in a single commit to one dataset repo.
+    Skipped when the repo's manifest already lists the same content hashes.
+    Returns True if a commit was made.
+    """
+    compressed = []
     try:
-        HF_API.create_repo(repo_id=dataset_repo_id, repo_type="dataset", exist_ok=True)
-        HF_API.upload_file(
-            path_or_fileobj=dataset_file_path,
-            path_in_repo="data.jsonl",
+        manifest = {}
+        for file_path, path_in_repo in ((train_file_path, TRAIN_DATA_FILE), (val_file_path, VAL_DATA_FILE)):
+            gz_path = f"{file_path}.gz"
+            manifest[path_in_repo] = gzip_file(file_path, gz_path)
+            compressed.append((gz_path, path_in_repo))
+
+        if read_dataset_manifest(hf_api, dataset_repo_id) == manifest:
+            print(f"⏭️ Dataset in {dataset_repo_id} is unchanged, skipping upload")
+            return False
+
+        hf_api.create_repo(repo_id=dataset_repo_id, repo_type="dataset", exist_ok=True)
+        operations = [
+            CommitOperationAdd(path_in_repo=path_in_repo, path_or_fileobj=gz_path)
+            for gz_path, path_in_repo in compressed
+        ]
+        operations.append(CommitOperationAdd(
+            path_in_repo=DATASET_MANIFEST_FILE,
+            path_or_fileobj=json.dumps(manifest, sort_keys=True).encode()
+        ))
+        hf_api.create_commit(
             repo_id=dataset_repo_id,
-            repo_type="dataset"
+            repo_type="dataset",
+            operations=operations,
+            commit_message="Upload training dataset"
         )
         print(f"✅ Uploaded dataset to {dataset_repo_id}")
+        return True
     except Exception as e:
         print(f"❌ Failed to upload dataset: {e}")
         raise
+    finally:
+        for gz_path, _ in compressed:
+            cleanup(gz_path)
+
+def gzip_file(src_path: str, dst_path: str) -> str:
+    """ Streams src into a reproducible gzip file (no name / mtime in the header); returns the sha256 of src. """
+    digest = hashlib.sha256()
+    with open(src_path, "rb") as src, open(dst_path, "wb") as raw_dst, \
+         gzip.GzipFile(filename="", mode="wb", fileobj=raw_dst, mtime=0) as dst:
+        while chunk := src.read(COPY_CHUNK_BYTES):
+            digest.update(chunk)
+            dst.write(chunk)
+    return digest.hexdigest()
+
+def read_dataset_manifest(hf_api: HfApi, dataset_repo_id: str) -> dict | None:
+    """ The manifest of the last upload, or None if the repo or the manifest doesn't exist. """
+    try:
+        manifest_path = hf_api.hf_hub_download(
+            repo_id=dataset_repo_id, filename=DATASET_MANIFEST_FILE, repo_type="dataset"
+        )
+        with open(manifest_path, "r") as f:
+            return json.load(f)
+    except Exception:
+        return None
 
-def delete_hf_dataset(lora_id: str):
-    dataset_repo_id = get_hf_dataset_repo_id(lora_id)
+def delete_hf_dataset(hf_api: HfApi, hf_username: str, lora_id: str):
+    dataset_repo_id = get_hf_dataset_repo_id(hf_username, lora_id)
     try:
-        HF_API.delete_repo(repo_id=dataset_repo_id, repo_type="dataset")
+        hf_api.delete_repo(repo_id=dataset_repo_id, repo_type="dataset")
         print(f"🗑️ Deleted Hugging Face dataset: {dataset_repo_id}")
     except Exception as e:
         print(f"⚠️ Failed to delete HF dataset {dataset_repo_id}: {e}")
 
-def get_hf_dataset_repo_id(lora_id: str) -> str:
-    return f"{HF_USERNAME}/{lora_id}-dataset"
+def get_hf_dataset_repo_id(hf_username: str, lora_id: str) -> str:
+    return f"{hf_username}/{lora_id}-dataset"
 
 def cleanup(temp_path: str):
     print("🧹 Cleaning up...")
@@ -143,8 +160,8 @@ def cleanup(temp_path: str):
         print(f"🧹 Deleted local dataset: {temp_path}")
     except Exception as e:
         print(f"⚠️ Failed to delete local file: {e}")
-    
-def start_training_pipeline(lora_id: str, dataset_repo_id: str, val_repo_id: str, yaml_config_path: str) -> str | None:
+
+async def start_training_pod(env_vars: dict, lora_id: str, dataset_repo_id: str, yaml_config_path: str) -> str | None:
 
     if not os.path.exists(yaml_config_path):
         print(f"❌ ERROR: No config template file at {yaml_config_path}")
@@ -155,32 +172,26 @@ def start_training_pipeline(lora_id: str, dataset_repo_id: str, val_repo_id: str
 
     # Get base model id from mapping
     hf_base_model_id = BASE_MODEL_MAP.get(yaml_config_path)
-    
-    # Generate YAML config dynamically with validation dataset if provided
-    config_content = generate_config(yaml_config_path, hf_base_model_id, dataset_repo_id, model_output_path, val_repo_id)
-    pod_id = create_pod(lora_id, model_output_path, config_content, hf_base_model_id)
-    if not pod_id:
-        return None
-
-    if not wait_for_pod_ready(lora_id):
-        return pod_id
 
-    print(f"✅ Pod {pod_id} is ready and training has started.")
-    return pod_id
+    # Generate YAML config dynamically with the train / validation files of the dataset repo
+    config_content = generate_config(yaml_config_path, hf_base_model_id, dataset_repo_id, model_output_path)
+    return await create_pod(env_vars, lora_id, model_output_path, config_content, hf_base_model_id)
 
-def create_pod(lora_id: str, model_output_path: str, config_content: str, hf_base_model_id: str) -> str:
-    headers = runpod_headers(RUNPOD_API_KEY)
-    pod_name = f"{lora_id}-trainer"
+async def create_pod(env_vars: dict, lora_id: str, model_output_path: str, config_content: str, hf_base_model_id: str) -> str | None:
+    runpod = get_runpod_client(env_vars["runpod_api_key"])
+    pod_name = trainer_pod_name(lora_id)
+    started = time.perf_counter()
 
-    query = {"query": "query { gpuTypes { id displayName memoryInGb } }"}
-    resp = requests.post("https://api.runpod.io/graphql", json=query, headers=headers).json()
-    if "errors" in resp:
-        print("❌ Failed to fetch GPU types:", resp["errors"])
+    catalog = await get_gpu_catalog(runpod)
+    if catalog is None:
+        placement_stats.record_placement(False, time.perf_counter() - started)
         return None
 
-    gpus = sorted([g for g in resp["data"]["gpuTypes"] if g["memoryInGb"] >= 40], key=lambda x: x["memoryInGb"])
+    # Types that recently had no capacity go last, otherwise smallest memory first
+    gpus = placement_stats.rank(catalog, MIN_GPU_MEMORY_GB)
     if not gpus:
         print("❌ No eligible GPUs found.")
+        placement_stats.record_placement(False, time.perf_counter() - started)
         return None
 
     for gpu in gpus:
@@ -200,8 +211,8 @@ def create_pod(lora_id: str, model_output_path: str, config_content: str, hf_bas
                 "ports": "8888/http",
                 "volumeMountPath": "/data",
                 "env": [
-                    {"key": "HF_TOKEN", "value": HF_TOKEN},
-                    {"key": "HF_USERNAME", "value": HF_USERNAME},
+                    {"key": "HF_TOKEN", "value": env_vars["hf_token"]},
+                    {"key": "HF_USERNAME", "value": env_vars["hf_username"]},
                     {"key": "BASE_MODEL", "value": hf_base_model_id},
                     {"key": "LORA_ID", "value": lora_id},
                     {"key": "CONFIG_CONTENT", "value": config_content},
@@ -211,70 +222,100 @@ def create_pod(lora_id: str, model_output_path: str, config_content: str, hf_bas
             }
         }
 
-        create_resp = requests.post("https://api.runpod.io/graphql", headers=headers, json={
-            "query": """
-            mutation PodFindAndDeployOnDemand($input: PodFindAndDeployOnDemandInput!) {
-                podFindAndDeployOnDemand(input: $input) { id }
-            }
-            """,
-            "variables": {"input": payload["input"]}
-        }).json()
-
-        if "errors" in create_resp:
-            print(f"❌ Pod creation failed for {gpu['displayName']}: {create_resp['errors']}")
+        try:
+            create_resp = await runpod.graphql_async("""
+                mutation PodFindAndDeployOnDemand($input: PodFindAndDeployOnDemandInput!) {
+                    podFindAndDeployOnDemand(input: $input) { id }
+                }
+                """,
+                {"input": payload["input"]},
+                idempotent=False
+            )
+            pod_id = ((create_resp.get("data") or {}).get("podFindAndDeployOnDemand") or {}).get("id")
+            error = create_resp.get("errors") or create_resp
+        except RunPodUnknownOutcome as e:
+            # A 5xx or a timeout does not mean RunPod did not deploy the pod; deploying on the next type
+            # without checking could leave this one running untracked. pod_name is unique to this call,
+            # so a pod of an earlier attempt is never adopted.
+            error = str(e)
+            try:
+                pod_id = await find_live_pod(runpod, pod_name)
+            except RunPodError as lookup_error:
+                print(f"❌ Could not check whether {pod_name} was deployed, not deploying another: {lookup_error}")
+                placement_stats.record_attempt(gpu["id"], succeeded=False)
+                placement_stats.record_placement(False, time.perf_counter() - started)
+                return None
+            if pod_id is not None:
+                print(f"♻️ Pod creation on {gpu['displayName']} reported a failure, but {pod_name} is up: {pod_id}")
+        except RunPodError as e:
+            pod_id, error = None, str(e)
+
+        if pod_id is None:
+            print(f"❌ Pod creation failed for {gpu['displayName']}: {error}")
+            placement_stats.record_attempt(gpu["id"], succeeded=False)
             continue
 
-        pod_id = create_resp["data"]["podFindAndDeployOnDemand"]["id"]
-        print(f"✅ Pod created: {pod_id}")
+        placement_stats.record_attempt(gpu["id"], succeeded=True)
+        placement_stats.record_placement(True, time.perf_counter() - started)
+        print(f"✅ Pod created: {pod_id} ({time.perf_counter() - started:.1f}s)")
         return pod_id
 
+    placement_stats.record_placement(False, time.perf_counter() - started)
     return None
 
-def wait_for_pod_ready(lora_id: str, interval=100, retries=30) -> bool:
-    headers = runpod_headers(RUNPOD_API_KEY)
-    pod_name = f"{lora_id}-trainer"
-
-    print("⏳ Waiting for pod to be listed...")
-    pod_id = None
-    while not pod_id:
-        resp = requests.post("https://api.runpod.io/graphql", headers=headers, json={
-            "query": "query { myself { pods { id name } } }"
-        }).json()
-        for pod in resp.get("data", {}).get("myself", {}).get("pods", []):
-            if pod["name"] == pod_name:
-                pod_id = pod["id"]
-                break
-        if not pod_id:
-            print(f"🔄 Pod not found. Retrying in {interval}s...")
-            time.sleep(interval)
-
-    print(f"✅ Pod found: {pod_id}\n⏳ Waiting for runtime...")
-
-    for i in range(retries):
-        print(f"🔄 Runtime check ({i+1}/{retries})")
-        resp = requests.post("https://api.runpod.io/graphql", headers=headers, json={
-            "query": """
-            query {
-                myself {
-                    pods {
-                        name
-                        runtime { uptimeInSeconds }
-                    }
-                }
-            }
-            """
-        }).json()
-        pods = resp.get("data", {}).get("myself", {}).get("pods", [])
-        for pod in pods:
-            if pod["name"] == pod_name and pod.get("runtime"):
-                print("✅ Runtime is ready.")
-                return True
-        time.sleep(interval)
+def trainer_pod_name(lora_id: str) -> str:
+    """ Name of the pod one create_pod call deploys; the suffix tells its pods apart from those of earlier attempts. """
+    return f"{lora_id}-trainer-{secrets.token_hex(4)}"
+
+async def find_live_pod(runpod: RunPodClient, pod_name: str) -> str | None:
+    """ Id of the account's pod called pod_name that has not stopped, if any. Raises RunPodError if RunPod cannot tell. """
+    resp = await runpod.graphql_async(PODS_QUERY)
+    if "errors" in resp:
+        raise RunPodError(f"pod lookup failed: {resp['errors']}")
+    pods = ((resp.get("data") or {}).get("myself") or {}).get("pods") or []
+    return next(
+        (pod["id"] for pod in pods if pod.get("name") == pod_name and pod.get("desiredStatus") not in ("EXITED", "TERMINATED")),
+        None
+    )
+
+async def wait_for_pod_ready(runpod: RunPodClient, pod_id: str, timeout: float = POD_READY_TIMEOUT_SECONDS) -> bool:
+    """
+    Polls the one pod by id until its runtime is up, backing off exponentially between checks.
+    Returns False if the pod stops or the timeout passes first. Waiting costs a timer, not a thread.
+    A failed status check (after the client's own retries) is logged and polling continues until the deadline,
+    so a RunPod hiccup never tears down a pod that is training fine.
+    """
+    deadline = time.monotonic() + timeout
+    interval = POD_POLL_INITIAL_SECONDS
+    check = 0
+
+    print(f"⏳ Waiting for pod {pod_id} runtime...")
+    while True:
+        check += 1
+        try:
+            resp = await runpod.graphql_async(POD_QUERY, {"input": {"podId": pod_id}})
+        except RunPodError as e:
+            print(f"⚠️ Pod status check {check} failed: {e}")
+            resp = {}
+        pod = (resp.get("data") or {}).get("pod")
+        if pod and pod.get("runtime"):
+            print(f"✅ Runtime is ready (check {check}).")
+            return True
+        if pod and pod.get("desiredStatus") in ("EXITED", "TERMINATED"):
+            print(f"❌ Pod {pod_id} stopped before its runtime came up ({pod['desiredStatus']}).")
+            return False
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        print(f"🔄 Runtime not ready (check {check}). Retrying in {min(interval, remaining):.0f}s...")
+        await asyncio.sleep(min(interval, remaining))
+        interval = min(interval * 2, POD_POLL_MAX_SECONDS)
 
     print("❌ Runtime not ready in time.")
     return False
 
-def generate_config(template_path: str, hf_base_model_id: str,  dataset_repo_id: str, model_output_path: str, val_repo_id: str) -> str:
+def generate_config(template_path: str, hf_base_model_id: str,  dataset_repo_id: str, model_output_path: str) -> str:
     with open(template_path, "r") as f:
         content = f.read()
 
@@ -283,7 +324,8 @@ def generate_config(template_path: str, hf_base_model_id: str,  dataset_repo_id:
         "--BASE_MODEL--": hf_base_model_id,
         "--DATASET_REPO_ID--": dataset_repo_id,
         "--OUTPUT_DIR--": model_output_path,
-        "--VAL_DATASET_PATH--": val_repo_id
+        "--TRAIN_DATA_FILE--": TRAIN_DATA_FILE,
+        "--VAL_DATA_FILE--": VAL_DATA_FILE
     }
 
     for placeholder, value in replacements.items():
@@ -291,64 +333,46 @@ def generate_config(template_path: str, hf_base_model_id: str,  dataset_repo_id:
 
     return content
 
-def check_lora_model_uploaded(lora_id: str) -> bool:
-    model_repo_id = f"{HF_USERNAME}/{lora_id}-model"  # DO NOT CHANGE THIS -> the docker image will create this repo
+def check_lora_model_uploaded(hf_api: HfApi, hf_username: str, lora_id: str) -> bool:
+    """ One check; the scheduler retries it without holding a thread in between. """
+    model_repo_id = f"{hf_username}/{lora_id}-model"  # DO NOT CHANGE THIS -> the docker image will create this repo
     print(f"🔍 Checking if LoRA model {model_repo_id} exists on HuggingFace...")
 
-    for attempt in range(2):
-        try:
-            files = HF_API.list_repo_files(repo_id=model_repo_id, repo_type="model")
-            found = any(
-                "adapter" in f or 
-                "pytorch_model" in f or 
-                f.endswith(".safetensors") 
-                for f in files
-            )
-            if found:
-                print(f"✅ LoRA model {lora_id} found on HuggingFace.")
-                return True
-            else:
-                print(f"⚠️ LoRA model not found on attempt {attempt + 1}.")
-        except Exception as e:
-            print(f"❌ Error checking LoRA model on attempt {attempt + 1}: {e}")
-
-        if attempt == 0:
-            print("⏳ Waiting 60 seconds before retrying...")
-            time.sleep(60)
-
-    print(f"❌ LoRA model {lora_id} not found after 2 attempts.")
+    try:
+        files = hf_api.list_repo_files(repo_id=model_repo_id, repo_type="model")
+        found = any(
+            "adapter" in f or
+            "pytorch_model" in f or
+            f.endswith(".safetensors")
+            for f in files
+        )
+        if found:
+            print(f"✅ LoRA model {lora_id} found on HuggingFace.")
+            return True
+        print(f"⚠️ LoRA model {lora_id} not found on HuggingFace.")
+    except Exception as e:
+        print(f"❌ Error checking LoRA model: {e}")
     return False
 
-def delete_pod(runpod_api_key: str, pod_id: str):
-    url = f"https://rest.runpod.io/v1/pods/{pod_id}"
-    headers = {
-        "Authorization": f"Bearer {runpod_api_key}"
-    }
-
+async def delete_pod(runpod_api_key: str, pod_id: str):
     try:
-        response = requests.delete(url, headers=headers)
-        if response.status_code in (200, 204):
+        status_code, body = await get_runpod_client(runpod_api_key).delete_pod_async(pod_id)
+        if status_code in (200, 204):
             print(f"🗑️ Pod deleted successfully: {pod_id}")
         else:
-            print(f"⚠️ Failed to delete pod: {response.status_code} - {response.text}")
+            print(f"⚠️ Failed to delete pod: {status_code} - {body}")
     except Exception as e:
         print(f"⚠️ Exception while deleting pod: {e}")
 
-def runpod_headers(runpod_api_key: str):
-    return {
-        "Authorization": f"Bearer {runpod_api_key}",
-        "Content-Type": "application/json"
-    }
-
 def add_created_lora_to_user(lora_id: str):
-    
+
     try :
         # 1. Get the creator_id for this lora_id from loras table
-        creator_resp = supabase.table(TABLE_LORAS).select(COL_CREATOR_ID).eq(COL_LORA_ID, lora_id).single().execute()
+        creator_resp = get_supabase().table(TABLE_LORAS).select(COL_CREATOR_ID).eq(COL_LORA_ID, lora_id).single().execute()
         creator_id = creator_resp.data[COL_CREATOR_ID]
 
         # 2. Fetch current loras_created array from profiles table for the creator
-        profile_resp = supabase.table(TABLE_PROFILES).select(COL_LORAS_CREATED).eq(COL_PROFILE_ID, creator_id).single().execute()
+        profile_resp = get_supabase().table(TABLE_PROFILES).select(COL_LORAS_CREATED).eq(COL_PROFILE_ID, creator_id).single().execute()
 
         current_array = profile_resp.data.get(COL_LORAS_CREATED, []) or []
 
@@ -360,10 +384,14 @@ def add_created_lora_to_user(lora_id: str):
             return
 
         # 4. Update the profile with the new array
-        update_resp = supabase.table(TABLE_PROFILES).update({COL_LORAS_CREATED: new_array}).eq(COL_PROFILE_ID, creator_id).execute()
+        update_resp = get_supabase().table(TABLE_PROFILES).update({COL_LORAS_CREATED: new_array}).eq(COL_PROFILE_ID, creator_id).execute()
     except Exception as e:
         print(f"⚠️ Error adding LoRA {lora_id} to user profile: {e}")
         return
 
+def save_pod_id(lora_id: str, pod_id: str):
+    _ = get_supabase().table(TABLE_LORAS).update({COL_POD_ID: pod_id}).eq(COL_LORA_ID, lora_id).execute()
+    print(f"✅ Pod ID {pod_id} saved to database for LoRA {lora_id}.")
+
 def update_lora_status(lora_id: str, new_status: str):
-    _ = supabase.table(TABLE_LORAS).update({COL_LORA_STATUS: new_status}).eq(COL_LORA_ID, lora_id).execute()
+    _ = get_supabase().table(TABLE_LORAS).update({COL_LORA_STATUS: new_status}).eq(COL_LORA_ID, lora_id).execute()
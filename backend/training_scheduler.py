@@ -0,0 +1,560 @@
+# training_scheduler.py - asyncio orchestration of LoRA training jobs with a persisted state machine
+
+import asyncio
+import fcntl
+import json
+import os
+import shutil
+import time
+import traceback
+from collections import Counter
+from enum import Enum
+
+# Job records (and the job's dataset files until they are uploaded) live here, so jobs survive restarts
+TRAINING_JOBS_DIR = os.getenv(
+    "TRAINING_JOBS_DIR",
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".training_jobs"))
+)
+# Jobs uploading datasets or provisioning a pod at the same time; waiting jobs hold no slot
+TRAINING_CONCURRENCY_LIMIT = int(os.getenv("TRAINING_CONCURRENCY_LIMIT", "4"))
+MODEL_CHECK_ATTEMPTS = int(os.getenv("MODEL_CHECK_ATTEMPTS", "2"))
+MODEL_CHECK_RETRY_SECONDS = float(os.getenv("MODEL_CHECK_RETRY_SECONDS", "60"))
+
+class JobState(str, Enum):
+    QUEUED = "queued"
+    UPLOADING = "uploading"
+    PROVISIONING = "provisioning"
+    RUNNING = "running"
+    FINALIZING = "finalizing"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+TERMINAL_STATES = {JobState.COMPLETED, JobState.FAILED}
+
+# The pod may report back before its runtime was seen by the poller, hence PROVISIONING -> FINALIZING
+ALLOWED_TRANSITIONS = {
+    JobState.QUEUED: {JobState.UPLOADING, JobState.FAILED},
+    JobState.UPLOADING: {JobState.PROVISIONING, JobState.FAILED},
+    JobState.PROVISIONING: {JobState.RUNNING, JobState.FINALIZING, JobState.FAILED},
+    JobState.RUNNING: {JobState.FINALIZING, JobState.FAILED},
+    JobState.FINALIZING: {JobState.COMPLETED, JobState.FAILED},
+}
+
+class TrainingJob:
+    """ One LoRA training run. Holds no credentials; those are re-read from Supabase when needed. """
+    def __init__(
+        self,
+        lora_id: str,
+        yaml_config_path: str | None = None,
+        train_path: str | None = None,
+        val_path: str | None = None,
+        state: str = JobState.QUEUED,
+        pod_id: str | None = None,
+        cuda_not_available: bool = False,
+        error: str | None = None,
+        created_at: float | None = None,
+        updated_at: float | None = None,
+    ):
+        self.lora_id = lora_id
+        self.yaml_config_path = yaml_config_path
+        self.train_path = train_path
+        self.val_path = val_path
+        self.state = JobState(state)
+        self.pod_id = pod_id
+        self.cuda_not_available = cuda_not_available
+        self.error = error
+        self.created_at = created_at or time.time()
+        self.updated_at = updated_at or self.created_at
+
+    def has_pod(self) -> bool:
+        """ True once the job's pod was created and recorded, so a pod callback can be about this job. """
+        return bool(self.pod_id) and self.state in (JobState.PROVISIONING, JobState.RUNNING, JobState.FINALIZING)
+
+    def to_dict(self) -> dict:
+        return {
+            "lora_id": self.lora_id,
+            "yaml_config_path": self.yaml_config_path,
+            "train_path": self.train_path,
+            "val_path": self.val_path,
+            "state": self.state.value,
+            "pod_id": self.pod_id,
+            "cuda_not_available": self.cuda_not_available,
+            "error": self.error,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+class TrainingJobStore:
+    """
+    One JSON file per job, replaced atomically on every state change. Finished jobs keep their
+    record (so a repeated pod callback is recognised) until the next startup.
+    Several uvicorn workers share the directory: a worker drives a job only while it holds the
+    job's claim, an exclusive flock on <lora_id>.lock that the OS drops if the worker dies.
+    A pod callback that reaches a worker without the claim is left in <lora_id>.finish for the
+    claim holder; it is a file of its own because the holder rewrites the job record as it goes.
+    """
+    def __init__(self, directory: str = TRAINING_JOBS_DIR):
+        self.directory = directory
+        self._claims = {}  # lora_id -> fd of the locked lock file
+
+    def path(self, lora_id: str) -> str:
+        return os.path.join(self.directory, f"{lora_id}.json")
+
+    def lock_path(self, lora_id: str) -> str:
+        return os.path.join(self.directory, f"{lora_id}.lock")
+
+    def finish_request_path(self, lora_id: str) -> str:
+        return os.path.join(self.directory, f"{lora_id}.finish")
+
+    def claim(self, lora_id: str) -> bool:
+        """ Takes the job's claim without blocking. False if another process holds it. """
+        if lora_id in self._claims:
+            return True
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.lock_path(lora_id)
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return False
+            # The previous holder unlinks the file before unlocking; a lock on that old file means nothing
+            try:
+                if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                    self._claims[lora_id] = fd
+                    return True
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    def release(self, lora_id: str):
+        fd = self._claims.pop(lora_id, None)
+        if fd is None:
+            return
+        try:
+            os.remove(self.lock_path(lora_id))
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+    def load(self, lora_id: str) -> TrainingJob | None:
+        try:
+            with open(self.path(lora_id), encoding="utf-8") as f:
+                return TrainingJob(**json.load(f))
+        except FileNotFoundError:
+            return None
+
+    def save(self, job: TrainingJob):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = self.path(job.lora_id) + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(job.to_dict(), f)
+        os.replace(tmp_path, self.path(job.lora_id))
+
+    def delete(self, lora_id: str):
+        for path in (self.path(lora_id), self.finish_request_path(lora_id)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def request_finish(self, lora_id: str, pod_id: str | None, cuda_not_available: bool):
+        """ Records the pod's completion callback for whichever worker holds the job's claim now or next. """
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{self.finish_request_path(lora_id)}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"pod_id": pod_id, "cuda_not_available": cuda_not_available}, f)
+        os.replace(tmp_path, self.finish_request_path(lora_id))
+
+    def has_finish_request(self, lora_id: str) -> bool:
+        return os.path.exists(self.finish_request_path(lora_id))
+
+    def take_finish_request(self, lora_id: str) -> dict | None:
+        """ Reads and removes the recorded callback, if any. Only the claim holder takes it. """
+        path = self.finish_request_path(lora_id)
+        try:
+            with open(path, encoding="utf-8") as f:
+                request = json.load(f)
+            os.remove(path)
+        except FileNotFoundError:
+            return None
+        return request
+
+    def load_all(self) -> list[TrainingJob]:
+        if not os.path.isdir(self.directory):
+            return []
+        jobs = []
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), encoding="utf-8") as f:
+                    jobs.append(TrainingJob(**json.load(f)))
+            except Exception as e:
+                print(f"⚠️ Skipping unreadable training job record {name}: {e}")
+        return jobs
+
+class TrainingScheduler:
+    """
+    Runs training jobs as asyncio tasks: queued -> uploading -> provisioning -> running -> finalizing.
+    Only uploading and provisioning hold one of the max_concurrent slots (and briefly a worker thread
+    for the sync HF / Supabase calls); waiting for a pod is a timer, so idle jobs cost no threads.
+    Every transition is persisted, and resume() picks unfinished jobs up again after a restart.
+    env_vars_loader(lora_id) returns the creator's decrypted keys (or None); it is called in a thread.
+    """
+    def __init__(self, env_vars_loader, store: TrainingJobStore | None = None, max_concurrent: int = TRAINING_CONCURRENCY_LIMIT):
+        self.env_vars_loader = env_vars_loader
+        self.store = store or TrainingJobStore()
+        self.slots = asyncio.Semaphore(max_concurrent)
+        self.max_concurrent = max_concurrent
+        self.jobs = {}   # lora_id -> unfinished TrainingJob this process holds the claim of
+        self.tasks = {}  # lora_id -> asyncio.Task driving that job
+        self.outcomes = Counter()
+
+    # -------------------- Public API --------------------
+    async def submit(self, lora_id: str, env_vars: dict, train_path: str, val_path: str, yaml_config_path: str) -> TrainingJob:
+        """
+        Takes ownership of the dataset files and queues the job; returns without waiting for any step.
+        Raises ValueError if another worker is still uploading or provisioning this LoRA.
+        """
+        from backend import train_lora as steps
+
+        if not self.store.claim(lora_id):
+            raise ValueError(f"LoRA {lora_id} is already being set up by another worker")
+        # A callback recorded for the job being replaced is not about the new one
+        self.store.take_finish_request(lora_id)
+
+        previous = self.jobs.get(lora_id) or self.store.load(lora_id)
+        if previous is not None and previous.state not in TERMINAL_STATES:
+            print(f"⚠️ LoRA {lora_id} resubmitted while {previous.state.value}; replacing the previous job.")
+            self._cancel_task(lora_id)
+            if previous.pod_id:
+                asyncio.create_task(steps.delete_pod(env_vars["runpod_api_key"], previous.pod_id))
+
+        # Move the datasets next to the job record so a restart before the upload still finds them
+        owned_train = os.path.join(self.store.directory, f"{lora_id}.train.jsonl")
+        owned_val = os.path.join(self.store.directory, f"{lora_id}.val.jsonl")
+        try:
+            await asyncio.to_thread(shutil.move, train_path, owned_train)
+            await asyncio.to_thread(shutil.move, val_path, owned_val)
+        except BaseException:
+            if lora_id not in self.jobs:
+                self.store.release(lora_id)
+            raise
+
+        job = TrainingJob(lora_id, yaml_config_path, owned_train, owned_val)
+        self.jobs[lora_id] = job
+        self.store.save(job)
+        print(f"📥 Training job queued for LoRA {lora_id}")
+
+        self._spawn(job, self._run(job, env_vars))
+        return job
+
+    async def notify_finished(self, lora_id: str, pod_id: str | None, cuda_not_available: bool = False) -> TrainingJob | None:
+        """
+        Handles the pod's completion callback: moves the job to finalizing and returns right away,
+        the HF check (with its retry delay) and the clean-up run in the background.
+        If another worker holds the job (still provisioning it), the callback is recorded next to the
+        job record and that worker finalizes the job as soon as its pod wait ends; the job is returned
+        as that worker last saved it.
+        Returns None if the job is already being finalized or finished.
+        Raises ValueError if the job has no pod yet, so the callback cannot be about it: cancelling a job
+        while its pod is being created would leave that pod running untracked.
+        """
+        job = self.jobs.get(lora_id)
+        if job is not None:
+            if job.state == JobState.FINALIZING:
+                return None
+            if not job.has_pod():
+                raise ValueError(f"LoRA {lora_id} has no pod yet ({job.state.value})")
+            self._cancel_task(lora_id)
+            self._transition(job, JobState.FINALIZING, cuda_not_available=cuda_not_available)
+            self._spawn(job, self._finalize(job))
+            return job
+
+        # The callback can reach any worker
+        record = self.store.load(lora_id)
+        if record is not None and record.state in TERMINAL_STATES:
+            return None
+        if record is not None and not record.has_pod():
+            raise ValueError(f"LoRA {lora_id} has no pod yet ({record.state.value})")
+        # Recorded before trying the claim, so a worker letting go of the job right now still sees it
+        self.store.request_finish(lora_id, pod_id, cuda_not_available)
+        if not self.store.claim(lora_id):
+            print(f"📌 LoRA {lora_id} is held by another worker, which finalizes it from the recorded callback")
+            return record
+        job = self._finalize_if_requested(lora_id)
+        if job is None:
+            self.store.release(lora_id)
+        return job
+
+    async def resume(self):
+        """
+        Restarts every unfinished job persisted by a previous process from the step it was in.
+        Each job is claimed first, so when several workers start together exactly one resumes it.
+        """
+        for job in self.store.load_all():
+            if job.state in TERMINAL_STATES:
+                self.store.delete(job.lora_id)
+                continue
+            if job.state == JobState.RUNNING:
+                # Running jobs only wait for the pod's callback, unless it was recorded and never picked up
+                self._adopt_finish_request(job.lora_id)
+                continue
+            if not self.store.claim(job.lora_id):
+                print(f"⏭️ Training job for LoRA {job.lora_id} is owned by another worker")
+                continue
+            # Re-read under the claim: the owner may have moved the job on before letting go
+            lora_id = job.lora_id
+            if self._finalize_if_requested(lora_id) is not None:
+                continue
+            job = self.store.load(lora_id)
+            if job is None or job.state in TERMINAL_STATES or job.state == JobState.RUNNING:
+                self.store.release(lora_id)
+                continue
+            self.jobs[job.lora_id] = job
+            print(f"🔁 Resuming training job for LoRA {job.lora_id} ({job.state.value})")
+            if job.state == JobState.FINALIZING:
+                self._spawn(job, self._finalize(job))
+            else:
+                self._spawn(job, self._run(job, None))
+
+    def stats(self) -> dict:
+        return {
+            "active": dict(Counter(job.state.value for job in self.jobs.values())),
+            "finished": dict(self.outcomes),
+            "max_concurrent": self.max_concurrent,
+        }
+
+    # -------------------- Job steps --------------------
+    async def _run(self, job: TrainingJob, env_vars: dict | None):
+        from backend import train_lora as steps
+
+        try:
+            if env_vars is None:
+                env_vars = await self._load_env_vars(job)
+
+            if job.state in (JobState.QUEUED, JobState.UPLOADING):
+                if steps.BASE_MODEL_MAP.get(job.yaml_config_path) is None:
+                    raise RuntimeError(f"No base model mapping found for config {job.yaml_config_path}")
+                async with self.slots:
+                    await asyncio.to_thread(steps.update_lora_status, job.lora_id, steps.LoraStatus.TRAINING)
+                    if job.state == JobState.QUEUED:
+                        self._transition(job, JobState.UPLOADING)
+                    await self._upload(job, env_vars)
+
+            if job.state == JobState.PROVISIONING and not job.pod_id:
+                async with self.slots:
+                    await self._provision(job, env_vars)
+
+            # Slot released: polling the pod is a timer, not a thread
+            if job.state == JobState.PROVISIONING:
+                runpod = steps.get_runpod_client(env_vars["runpod_api_key"])
+                ready = await steps.wait_for_pod_ready(runpod, job.pod_id)
+                # The pod may already have called back (e.g. no CUDA) to a worker that could not claim the job
+                if self._finalize_if_requested(job.lora_id) is not None:
+                    return
+                if not ready:
+                    raise RuntimeError(f"Pod {job.pod_id} runtime not ready in time")
+                self._transition(job, JobState.RUNNING)
+                print(f"✅ Pod {job.pod_id} is ready and training has started.")
+                # Nothing left to drive until the pod calls back, which may reach any worker
+                self._let_go(job)
+                # A callback recorded while the claim was still held is picked up here
+                self._adopt_finish_request(job.lora_id)
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ Training pipeline error for LoRA {job.lora_id}: {e}")
+            traceback.print_exc()
+            await self._fail(job, env_vars, str(e))
+
+    async def _upload(self, job: TrainingJob, env_vars: dict):
+        from backend import train_lora as steps
+
+        for path in (job.train_path, job.val_path):
+            if not path or not os.path.exists(path):
+                raise RuntimeError(f"Dataset file missing for LoRA {job.lora_id}: {path}")
+
+        hf_api = steps.get_hf_api(env_vars)
+        dataset_repo_id = steps.get_hf_dataset_repo_id(env_vars["hf_username"], job.lora_id)
+        await asyncio.to_thread(steps.upload_datasets_to_hf, hf_api, dataset_repo_id, job.train_path, job.val_path)
+
+        self._transition(job, JobState.PROVISIONING)
+        self._remove_dataset_files(job)
+
+    async def _provision(self, job: TrainingJob, env_vars: dict):
+        from backend import train_lora as steps
+
+        dataset_repo_id = steps.get_hf_dataset_repo_id(env_vars["hf_username"], job.lora_id)
+        pod_id = await steps.start_training_pod(env_vars, job.lora_id, dataset_repo_id, job.yaml_config_path)
+        if not pod_id:
+            raise RuntimeError("Failed to start training pipeline")
+
+        self._transition(job, JobState.PROVISIONING, pod_id=pod_id)
+        await asyncio.to_thread(steps.save_pod_id, job.lora_id, pod_id)
+
+    async def _finalize(self, job: TrainingJob):
+        from backend import train_lora as steps
+
+        env_vars = None
+        try:
+            env_vars = await self._load_env_vars(job)
+
+            succeeded = False
+            if job.cuda_not_available:
+                print(f"❌ LoRA {job.lora_id} pod had no CUDA, marked as failed")
+            else:
+                print("⏳ Checking if LoRA model is available on Hugging Face...")
+                hf_api = steps.get_hf_api(env_vars)
+                for attempt in range(MODEL_CHECK_ATTEMPTS):
+                    if await asyncio.to_thread(steps.check_lora_model_uploaded, hf_api, env_vars["hf_username"], job.lora_id):
+                        succeeded = True
+                        break
+                    if attempt + 1 < MODEL_CHECK_ATTEMPTS:
+                        print(f"⏳ Waiting {MODEL_CHECK_RETRY_SECONDS:.0f} seconds before retrying...")
+                        await asyncio.sleep(MODEL_CHECK_RETRY_SECONDS)
+
+            if succeeded:
+                await asyncio.to_thread(steps.add_created_lora_to_user, job.lora_id)
+                await asyncio.to_thread(steps.update_lora_status, job.lora_id, steps.LoraStatus.TRAINING_COMPLETED)
+            else:
+                print(f"❌ LoRA model {job.lora_id} not found after {MODEL_CHECK_ATTEMPTS} attempts.")
+                await asyncio.to_thread(steps.update_lora_status, job.lora_id, steps.LoraStatus.TRAINING_FAILED)
+
+            await self._release_resources(job, env_vars)
+            self._finish(job, JobState.COMPLETED if succeeded else JobState.FAILED,
+                         None if succeeded else "LoRA model not found on Hugging Face")
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ Error finalizing LoRA {job.lora_id}: {e}")
+            traceback.print_exc()
+            await self._fail(job, env_vars, str(e))
+
+    async def _fail(self, job: TrainingJob, env_vars: dict | None, reason: str):
+        from backend import train_lora as steps
+
+        try:
+            await asyncio.to_thread(steps.update_lora_status, job.lora_id, steps.LoraStatus.TRAINING_FAILED)
+        except Exception as e:
+            print(f"⚠️ Failed to mark LoRA {job.lora_id} as failed: {e}")
+        self._remove_dataset_files(job)
+        await self._release_resources(job, env_vars)
+        self._finish(job, JobState.FAILED, reason)
+
+    async def _release_resources(self, job: TrainingJob, env_vars: dict | None):
+        """
+        Deletes the HF dataset repos and the pod recorded on the job (both best-effort).
+        Without env_vars (loading them may be what failed) they are loaded once more here, since
+        the creator's keys are needed for both deletions.
+        """
+        from backend import train_lora as steps
+
+        # Nothing exists remotely before the upload step starts; a failed upload may leave a partial dataset repo
+        if job.state == JobState.QUEUED and not job.pod_id:
+            return
+        if env_vars is None:
+            try:
+                env_vars = await self._load_env_vars(job)
+            except Exception as e:
+                print(f"⚠️ Cannot clean up LoRA {job.lora_id} (pod {job.pod_id}, HF dataset) without the creator's keys: {e}")
+                return
+
+        await asyncio.to_thread(steps.delete_hf_dataset, steps.get_hf_api(env_vars), env_vars["hf_username"], job.lora_id)
+        if job.pod_id:
+            await steps.delete_pod(env_vars["runpod_api_key"], job.pod_id)
+
+    # -------------------- State bookkeeping --------------------
+    async def _load_env_vars(self, job: TrainingJob) -> dict:
+        env_vars = await asyncio.to_thread(self.env_vars_loader, job.lora_id)
+        if not env_vars:
+            raise RuntimeError(f"Creator env vars not found for LoRA {job.lora_id}")
+        return env_vars
+
+    def _transition(self, job: TrainingJob, state: JobState, **fields):
+        if state != job.state and state not in ALLOWED_TRANSITIONS.get(job.state, ()):
+            raise RuntimeError(f"Invalid training job transition {job.state.value} -> {state.value}")
+        for name, value in fields.items():
+            setattr(job, name, value)
+        if state != job.state:
+            print(f"🔀 LoRA {job.lora_id}: {job.state.value} -> {state.value}")
+        job.state = state
+        job.updated_at = time.time()
+        self.store.save(job)
+
+    def _finish(self, job: TrainingJob, state: JobState, error: str | None):
+        if job.state != state:
+            job.state = state
+            job.error = error
+            job.updated_at = time.time()
+            print(f"🏁 LoRA {job.lora_id}: {state.value}" + (f" ({error})" if error else ""))
+        self.outcomes[state.value] += 1
+        self.store.save(job)
+        self.store.take_finish_request(job.lora_id)
+        self._let_go(job)
+
+    def _let_go(self, job: TrainingJob):
+        """ Stops tracking the job in this process and releases its claim; the record stays on disk. """
+        if self.jobs.get(job.lora_id) is job:
+            del self.jobs[job.lora_id]
+            self.store.release(job.lora_id)
+
+    def _finalize_if_requested(self, lora_id: str) -> TrainingJob | None:
+        """
+        Moves the job to finalizing if a pod callback was recorded for it. Caller holds the job's claim.
+        Returns the job being finalized, or None if nothing was recorded or the job cannot take it.
+        """
+        request = self.store.take_finish_request(lora_id)
+        if request is None:
+            return None
+        job = self.jobs.get(lora_id) or self.store.load(lora_id)
+        if job is None:
+            # Started before this scheduler existed: finalize it anyway
+            job = TrainingJob(lora_id, state=JobState.RUNNING, pod_id=request["pod_id"])
+        if not job.has_pod():
+            print(f"⚠️ Dropping the recorded callback for LoRA {lora_id}, which has no pod yet ({job.state.value})")
+            return None
+        if job.pod_id and request["pod_id"] and job.pod_id != request["pod_id"]:
+            print(f"⚠️ Dropping the recorded callback of pod {request['pod_id']}, LoRA {lora_id} runs on {job.pod_id}")
+            return None
+
+        self.jobs[lora_id] = job
+        self._cancel_task(lora_id)
+        if job.state != JobState.FINALIZING:
+            self._transition(
+                job, JobState.FINALIZING, pod_id=job.pod_id or request["pod_id"], cuda_not_available=request["cuda_not_available"]
+            )
+        # else its previous owner died while finalizing
+        self._spawn(job, self._finalize(job))
+        return job
+
+    def _adopt_finish_request(self, lora_id: str):
+        """ Finalizes a job nobody holds if its pod's callback was recorded while someone did. """
+        if self.store.has_finish_request(lora_id) and self.store.claim(lora_id):
+            if self._finalize_if_requested(lora_id) is None:
+                self.store.release(lora_id)
+
+    def _remove_dataset_files(self, job: TrainingJob):
+        from backend import train_lora as steps
+
+        for path in (job.train_path, job.val_path):
+            if path and os.path.exists(path):
+                steps.cleanup(path)
+
+    def _spawn(self, job: TrainingJob, coro):
+        task = asyncio.create_task(coro)
+        self.tasks[job.lora_id] = task
+
+        def forget(done_task):
+            if self.tasks.get(job.lora_id) is done_task:
+                del self.tasks[job.lora_id]
+        task.add_done_callback(forget)
+
+    def _cancel_task(self, lora_id: str):
+        task = self.tasks.pop(lora_id, None)
+        if task is not None and not task.done() and task is not asyncio.current_task():
+            task.cancel()